@@ -0,0 +1,684 @@
+"""Статистический анализ результатов запросов generate_sql_queries_for_metrics.
+
+Принимает либо поюзерные строки (exp_name, magnit_id, group_label, metric_type,
+metric_name, numerator, denominator), либо достаточные статистики по группам
+(output="aggregate"), и считает эффект, доверительный интервал и p-value сразу
+для всех метрик: Welch t-тест для basic и дельта-метод для ratio. Для A/B/n
+(больше двух плеч) — analyze_arms с поправкой на множественные сравнения.
+Квантильные метрики (t-digest скетчи) — analyze_quantiles. Поюзерные строки,
+которые не помещаются в память, сворачиваются порциями через OnlineStatistics.
+Статистики по стратам (колонка stratum, опция strata эксперимента) —
+analyze_stratified с пост-стратифицированной оценкой.
+
+Все вычисления векторизованы по метрикам — никаких циклов по метрикам нет.
+На вход подходит pandas.DataFrame или dict колонок.
+"""
+import math
+import warnings
+from statistics import NormalDist
+
+import numpy as np
+
+from tdigest import decode_sketch, sketch_quantiles
+
+ROW_COLUMNS = ["exp_name", "magnit_id", "group_label", "metric_type", "metric_name", "numerator", "denominator"]
+STAT_COLUMNS = ["n", "sum_x", "sum_x2", "sum_y", "sum_y2", "sum_xy"]
+COVARIATE_COLUMNS = ["sum_c", "sum_c2", "sum_xc"]
+KEY_COLUMNS = ["exp_name", "metric_type", "metric_name"]
+
+
+# Колонка считается идущей блоками, если блоков одинаковых значений меньше 1/RUN_FACTOR строк
+RUN_FACTOR = 8
+RUN_PROBE_ROWS = 4096
+
+
+def _factorize_flat(values):
+    try:
+        import pandas as pd
+    except Exception:
+        pd = None
+    if pd is not None:
+        codes, uniques = pd.factorize(values)
+        return codes, np.asarray(uniques, dtype=object)
+    uniques, codes = np.unique(values, return_inverse=True)
+    return codes, np.asarray(uniques, dtype=object)
+
+
+def _factorize(values):
+    """Коды и уникальные значения колонки.
+
+    Категориальные колонки (pandas category, см. ChdbExecutor.stream) отдают готовые
+    коды. Колонки ключей в результатах запросов идут блоками — метрика за метрикой,
+    поэтому сначала ищутся границы блоков одинаковых значений и разбираются только
+    первые значения блоков. Колонки без длинных блоков (group_label) разбираются целиком.
+    """
+    if hasattr(values, "cat"):
+        return np.asarray(values.cat.codes), np.asarray(values.cat.categories, dtype=object)
+    values = np.asarray(values)
+    probe = values[:RUN_PROBE_ROWS]
+    if len(values) > RUN_PROBE_ROWS and np.count_nonzero(probe[1:] != probe[:-1]) * RUN_FACTOR < len(probe):
+        starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+        if len(starts) * RUN_FACTOR < len(values):
+            heads = np.concatenate([[0], starts])
+            head_codes, uniques = _factorize_flat(values[heads])
+            return np.repeat(head_codes, np.diff(np.append(heads, len(values)))), uniques
+    return _factorize_flat(values)
+
+
+def _combine_codes(columns, mask=None):
+    """Один целочисленный ключ по нескольким колонкам + значения колонок для каждого ключа.
+
+    mask — строки, которые участвуют в результате: колонки разбираются целиком
+    (без копирования отфильтрованных строк), а ключи строятся только по этим строкам.
+    """
+    codes = None
+    total = 1
+    factorized = [_factorize(c) for c in columns]
+    for col_codes, uniques in factorized:
+        col_codes = col_codes.astype(np.int64)
+        codes = col_codes if codes is None else codes * len(uniques) + col_codes
+        total *= len(uniques)
+    if mask is not None:
+        codes = codes[mask]
+    if total <= 1 << 24:
+        # Плотная перенумерация за O(n) вместо сортировки
+        present = np.bincount(codes, minlength=total) > 0
+        key_codes = np.flatnonzero(present)
+        inverse = (np.cumsum(present) - 1)[codes]
+    else:
+        key_codes, inverse = np.unique(codes, return_inverse=True)
+    # Восстанавливаем значения исходных колонок для каждого ключа
+    key_values = []
+    rest = key_codes
+    for col_codes, uniques in reversed(factorized):
+        key_values.append(uniques[rest % len(uniques)])
+        rest = rest // len(uniques)
+    return inverse, key_values[::-1]
+
+
+def _row_key_columns(rows) -> list:
+    return ["exp_name", "metric_type", "metric_name", "group_label"] + (["stratum"] if "stratum" in rows else [])
+
+
+def sufficient_statistics_from_rows(rows) -> dict:
+    """Сворачивает поюзерные строки в достаточные статистики по (эксперимент, метрика, группа).
+
+    Результат имеет ту же схему, что и запросы с output="aggregate".
+    Строки с NULL в numerator/denominator отбрасываются. Если есть колонка
+    covariate (CUPED), дополнительно считаются Σc, Σc² и Σxc; если есть колонка
+    stratum — статистики считаются по (метрика, группа, страта).
+    """
+    x = np.asarray(rows["numerator"], dtype=np.float64)
+    y = np.asarray(rows["denominator"], dtype=np.float64)
+    c = np.asarray(rows["covariate"], dtype=np.float64) if "covariate" in rows else None
+    valid = np.isfinite(x) & np.isfinite(y)
+    key_columns = _row_key_columns(rows)
+    mask = None
+    if not valid.all():
+        x, y = x[valid], y[valid]
+        c = c[valid] if c is not None else None
+        mask = valid
+
+    codes, key_values = _combine_codes([rows[col] for col in key_columns], mask)
+    size = len(key_values[0])
+    result = dict(zip(key_columns, key_values))
+    result["n"] = np.bincount(codes, minlength=size).astype(np.float64)
+    result["sum_x"] = np.bincount(codes, weights=x, minlength=size)
+    result["sum_x2"] = np.bincount(codes, weights=x * x, minlength=size)
+    result["sum_y"] = np.bincount(codes, weights=y, minlength=size)
+    result["sum_y2"] = np.bincount(codes, weights=y * y, minlength=size)
+    result["sum_xy"] = np.bincount(codes, weights=x * y, minlength=size)
+    if c is not None:
+        # Пользователь без активности в предпериоде — ковариата 0
+        c = np.nan_to_num(c)
+        result["sum_c"] = np.bincount(codes, weights=c, minlength=size)
+        result["sum_c2"] = np.bincount(codes, weights=c * c, minlength=size)
+        result["sum_xc"] = np.bincount(codes, weights=x * c, minlength=size)
+    return result
+
+
+class OnlineStatistics:
+    """Онлайн-аккумуляторы по (эксперимент, метрика, группа) для потокового чтения строк.
+
+    update принимает порцию поюзерных строк (dict колонок или DataFrame) и вливает её
+    в средние, центральные моменты M2 и ко-моменты числитель×знаменатель (и
+    числитель×ковариата) по формулам Уэлфорда/Чана, после чего порция не нужна.
+    Память не зависит от числа пользователей — только от числа метрик и групп.
+    result() отдаёт ту же схему, что sufficient_statistics_from_rows.
+    """
+
+    # Индексы моментов: x — numerator, y — denominator, c — covariate
+    _X, _Y, _C = 0, 1, 2
+
+    def __init__(self):
+        self._positions = {}
+        self._keys = []
+        self._n = np.zeros(0)
+        self._mean = np.zeros((0, 3))
+        self._m2 = np.zeros((0, 3))
+        self._comoment = np.zeros((0, 2))  # (x, y) и (x, c)
+        self._has_covariate = False
+        self._key_columns = None
+
+    def _grow(self, size: int):
+        extra = size - len(self._n)
+        if extra > 0:
+            self._n = np.concatenate([self._n, np.zeros(extra)])
+            self._mean = np.vstack([self._mean, np.zeros((extra, 3))])
+            self._m2 = np.vstack([self._m2, np.zeros((extra, 3))])
+            self._comoment = np.vstack([self._comoment, np.zeros((extra, 2))])
+
+    def update(self, chunk):
+        x = np.asarray(chunk["numerator"], dtype=np.float64)
+        y = np.asarray(chunk["denominator"], dtype=np.float64)
+        has_covariate = "covariate" in chunk
+        self._has_covariate |= has_covariate
+        # Пользователь без активности в предпериоде — ковариата 0
+        c = np.nan_to_num(np.asarray(chunk["covariate"], dtype=np.float64)) if has_covariate else np.zeros(len(x))
+        valid = np.isfinite(x) & np.isfinite(y)
+        if self._key_columns is None:
+            self._key_columns = _row_key_columns(chunk)
+        x, y, c = x[valid], y[valid], c[valid]
+        if not len(x):
+            return
+
+        codes, key_values = _combine_codes([chunk[col] for col in self._key_columns], valid)
+        positions = np.empty(len(key_values[0]), dtype=np.int64)
+        for i, key in enumerate(zip(*key_values)):
+            if key not in self._positions:
+                self._positions[key] = len(self._keys)
+                self._keys.append(key)
+            positions[i] = self._positions[key]
+        self._grow(len(self._keys))
+
+        # Моменты порции в два прохода, затем слияние с накопленными (Chan et al.)
+        size = len(positions)
+        n_b = np.bincount(codes, minlength=size).astype(np.float64)
+        values = np.column_stack([x, y, c])
+        mean_b = np.column_stack([np.bincount(codes, weights=values[:, j], minlength=size) for j in range(3)]) / n_b[:, None]
+        centered = values - mean_b[codes]
+        m2_b = np.column_stack([np.bincount(codes, weights=centered[:, j] ** 2, minlength=size) for j in range(3)])
+        comoment_b = np.column_stack([
+            np.bincount(codes, weights=centered[:, self._X] * centered[:, j], minlength=size) for j in (self._Y, self._C)
+        ])
+
+        n_a = self._n[positions]
+        mean_a = self._mean[positions]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        weight = (n_a * n_b / n)[:, None]
+        self._mean[positions] = mean_a + delta * (n_b / n)[:, None]
+        self._m2[positions] += m2_b + delta ** 2 * weight
+        self._comoment[positions] += comoment_b + delta[:, [self._X]] * delta[:, [self._Y, self._C]] * weight
+        self._n[positions] = n
+
+    def result(self) -> dict:
+        n, mean, m2, comoment = self._n, self._mean, self._m2, self._comoment
+        key_columns = self._key_columns or _row_key_columns({})
+        keys = list(zip(*self._keys)) if self._keys else [[] for _ in key_columns]
+        result = {col: np.asarray(values, dtype=object) for col, values in zip(key_columns, keys)}
+        result["n"] = n.copy()
+        result["sum_x"] = n * mean[:, self._X]
+        result["sum_x2"] = m2[:, self._X] + n * mean[:, self._X] ** 2
+        result["sum_y"] = n * mean[:, self._Y]
+        result["sum_y2"] = m2[:, self._Y] + n * mean[:, self._Y] ** 2
+        result["sum_xy"] = comoment[:, 0] + n * mean[:, self._X] * mean[:, self._Y]
+        if self._has_covariate:
+            result["sum_c"] = n * mean[:, self._C]
+            result["sum_c2"] = m2[:, self._C] + n * mean[:, self._C] ** 2
+            result["sum_xc"] = comoment[:, 1] + n * mean[:, self._X] * mean[:, self._C]
+        return result
+
+
+def sufficient_statistics_from_stream(chunks) -> dict:
+    """Достаточные статистики по итератору порций поюзерных строк (см. OnlineStatistics)"""
+    statistics = OnlineStatistics()
+    for chunk in chunks:
+        statistics.update(chunk)
+    return statistics.result()
+
+
+def _pivot_groups(stats, control_label, test_label):
+    """Раскладывает статистики по метрикам: для каждой метрики строка control и test"""
+    labels = np.asarray(stats["group_label"], dtype=object)
+    metric_codes, key_values = _combine_codes([stats[c] for c in KEY_COLUMNS])
+    size = len(key_values[0])
+
+    pivoted = {}
+    for label, prefix in ((control_label, "c"), (test_label, "t")):
+        mask = labels == label
+        present = np.zeros(size, dtype=bool)
+        present[metric_codes[mask]] = True
+        pivoted[prefix + "_present"] = present
+        for col in STAT_COLUMNS:
+            values = np.zeros(size, dtype=np.float64)
+            values[metric_codes[mask]] = np.asarray(stats[col], dtype=np.float64)[mask]
+            pivoted[prefix + "_" + col] = values
+    return dict(zip(KEY_COLUMNS, key_values)), pivoted
+
+
+def _group_moments(n, sum_x, sum_x2, sum_y, sum_y2, sum_xy):
+    """Оценка отношения mean(x)/mean(y) и её дисперсии дельта-методом.
+
+    Для basic метрик y = 1, и формула сводится к обычной var(x) / n.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = sum_x / n
+        mean_y = sum_y / n
+        var_x = (sum_x2 - n * mean_x * mean_x) / (n - 1)
+        var_y = (sum_y2 - n * mean_y * mean_y) / (n - 1)
+        cov_xy = (sum_xy - n * mean_x * mean_y) / (n - 1)
+        ratio = mean_x / mean_y
+        var_ratio = (var_x - 2 * ratio * cov_xy + ratio * ratio * var_y) / (mean_y * mean_y * n)
+    # Отрицательные значения возможны только из-за ошибок округления
+    return ratio, np.maximum(var_ratio, 0.0)
+
+
+def _normal_sf(z):
+    return np.array([0.5 * math.erfc(v / math.sqrt(2)) if np.isfinite(v) else np.nan for v in np.ravel(z)])
+
+
+def _t_sf(t, df):
+    """Хвост распределения Стьюдента; без scipy — нормальное приближение"""
+    try:
+        from scipy import stats
+    except Exception:
+        return _normal_sf(t)
+    return stats.t.sf(t, df)
+
+
+def _t_quantile(q, df):
+    try:
+        from scipy import stats
+    except Exception:
+        return np.full(np.shape(df), NormalDist().inv_cdf(q))
+    return stats.t.ppf(q, df)
+
+
+def compare_groups(metric_types, control: dict, test: dict, alpha: float = 0.05) -> dict:
+    """Сравнение test с control по массивам достаточных статистик (по одной позиции на метрику).
+
+    Для basic — Welch t-тест (степени свободы Уэлча–Саттертуэйта), для ratio —
+    z-тест с дисперсией по дельта-методу. Относительный эффект (lift) и его
+    интервал тоже считаются дельта-методом.
+    """
+    c_ratio, c_var = _group_moments(*(control[c] for c in STAT_COLUMNS))
+    t_ratio, t_var = _group_moments(*(test[c] for c in STAT_COLUMNS))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        welch_df = (c_var + t_var) ** 2 / (
+            c_var ** 2 / (control["n"] - 1) + t_var ** 2 / (test["n"] - 1)
+        )
+    df = np.where(np.asarray(metric_types, dtype=object) == "basic", welch_df, np.inf)
+    return _compare_estimates(c_ratio, c_var, t_ratio, t_var, df, alpha)
+
+
+def _compare_estimates(c_ratio, c_var, t_ratio, t_var, df, alpha: float) -> dict:
+    """Разница и lift с интервалами по оценкам групп и их дисперсиям; df = inf — z-тест"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diff = t_ratio - c_ratio
+        se = np.sqrt(c_var + t_var)
+        stat = diff / se
+
+        q = _t_quantile(1 - alpha / 2, df)
+        p_value = 2 * _t_sf(np.abs(stat), df)
+
+        lift = diff / c_ratio
+        lift_se = np.sqrt(t_var / c_ratio ** 2 + t_ratio ** 2 * c_var / c_ratio ** 4)
+
+    return {
+        "control": c_ratio,
+        "test": t_ratio,
+        "diff": diff,
+        "ci_low": diff - q * se,
+        "ci_high": diff + q * se,
+        "lift": lift,
+        "lift_ci_low": lift - q * lift_se,
+        "lift_ci_high": lift + q * lift_se,
+        "statistic": stat,
+        "p_value": p_value,
+    }
+
+
+def analyze_sufficient_statistics(stats, alpha: float = 0.05,
+                                  control_label: str = "control", test_label: str = "test",
+                                  sample_fraction: float = None) -> dict:
+    """Результаты по всем метрикам из достаточных статистик (output="aggregate").
+
+    Возвращает dict колонок (удобно передать в pandas.DataFrame): ключ метрики,
+    размеры групп, средние/отношения по группам, разница с CI, lift с CI и p-value.
+    Метрики, для которых нет одной из групп, получают NaN.
+
+    Для запроса по выборке (sample_fraction или колонка sample_fraction в stats)
+    средние и интервалы считаются по выборке — их ширина и есть погрешность быстрой
+    оценки, — а размеры групп дополнительно пересчитываются на полную аудиторию
+    (n_control_total, n_test_total).
+
+    Статистики по стратам (колонка stratum) суммируются — это оценка без
+    стратификации; пост-стратифицированная — analyze_stratified.
+    """
+    if "stratum" in stats:
+        stats = collapse_strata(stats)
+    keys, pivoted = _pivot_groups(stats, control_label, test_label)
+    control = {c: pivoted["c_" + c] for c in STAT_COLUMNS}
+    test = {c: pivoted["t_" + c] for c in STAT_COLUMNS}
+    missing = ~(pivoted["c_present"] & pivoted["t_present"])
+    for group in (control, test):
+        group["n"] = np.where(missing, np.nan, group["n"])
+
+    result = dict(keys)
+    result["n_control"] = pivoted["c_n"]
+    result["n_test"] = pivoted["t_n"]
+    result.update(compare_groups(keys["metric_type"], control, test, alpha))
+
+    if sample_fraction is None and "sample_fraction" in stats:
+        sample_fraction = float(np.asarray(stats["sample_fraction"], dtype=np.float64)[0])
+    if sample_fraction is not None and sample_fraction != 1:
+        result["sample_fraction"] = np.full(len(result["n_control"]), sample_fraction)
+        result["n_control_total"] = result["n_control"] / sample_fraction
+        result["n_test_total"] = result["n_test"] / sample_fraction
+    return result
+
+
+def analyze_rows(rows, alpha: float = 0.05, control_label: str = "control", test_label: str = "test",
+                 sample_fraction: float = None) -> dict:
+    """Результаты по всем метрикам из поюзерных строк (output="rows")"""
+    return analyze_sufficient_statistics(sufficient_statistics_from_rows(rows), alpha, control_label, test_label,
+                                         sample_fraction)
+
+
+def adjust_p_values(p_values, families, method: str = "holm"):
+    """Поправка на множественные сравнения внутри каждой семьи гипотез (например, плечи одной метрики).
+
+    method: "holm" (Холм–Бонферрони), "bonferroni" или "bh" (Бенджамини–Хохберг).
+    Считается одной сортировкой по (семья, p-value) без циклов по семьям; NaN остаются NaN.
+    """
+    p = np.asarray(p_values, dtype=np.float64)
+    family_codes, _ = _combine_codes([families])
+    valid = np.isfinite(p)
+    adjusted = np.full(len(p), np.nan)
+    p, family_codes = p[valid], family_codes[valid]
+    if not len(p):
+        return adjusted
+
+    order = np.lexsort((p, family_codes))
+    sorted_p, sorted_family = p[order], family_codes[order]
+    size = np.bincount(sorted_family)[sorted_family]
+    starts = np.flatnonzero(np.r_[True, sorted_family[1:] != sorted_family[:-1]])
+    rank = np.arange(len(p)) - np.repeat(starts, np.diff(np.r_[starts, len(p)]))
+
+    # Значения обрезаются до 1 ещё до накопленных max/min: тогда смещение на 2·семья
+    # гарантированно отделяет семьи, и максимум одной семьи не переходит в следующую
+    offset = 2.0 * sorted_family
+    if method == "bonferroni":
+        values = np.minimum(sorted_p * size, 1.0)
+    elif method == "holm":
+        values = np.maximum.accumulate(np.minimum(sorted_p * (size - rank), 1.0) + offset) - offset
+    elif method == "bh":
+        values = np.minimum.accumulate((np.minimum(sorted_p * size / (rank + 1), 1.0) + offset)[::-1])[::-1] - offset
+    else:
+        raise ValueError(f"Неизвестная поправка: {method}")
+
+    result = np.empty(len(p))
+    result[order] = values
+    adjusted[valid] = result
+    return adjusted
+
+
+def analyze_arms(stats, alpha: float = 0.05, control_label: str = "control", correction: str = "holm",
+                 sample_fraction: float = None) -> dict:
+    """Результаты A/B/n: каждое плечо против контроля по всем метрикам.
+
+    Колонка arm — метка тестового плеча. p_value_adjusted — p-value с поправкой на
+    множественные сравнения между плечами одной метрики (см. adjust_p_values).
+    """
+    labels = np.asarray(stats["group_label"], dtype=object)
+    arms = [label for label in dict.fromkeys(labels.tolist()) if label != control_label]
+    parts = [analyze_sufficient_statistics(stats, alpha, control_label, arm, sample_fraction) for arm in arms]
+    if not parts:
+        raise ValueError(f"Нет тестовых плеч кроме {control_label!r}")
+
+    result = {column: np.concatenate([np.asarray(part[column]) for part in parts]) for column in parts[0]}
+    result["arm"] = np.concatenate([np.full(len(part["metric_name"]), arm, dtype=object) for arm, part in zip(arms, parts)])
+    families = [f"{e}\x00{t}\x00{m}" for e, t, m in zip(*(result[c] for c in KEY_COLUMNS))]
+    result["p_value_adjusted"] = adjust_p_values(result["p_value"], families, correction)
+    return result
+
+
+def cuped_adjust_statistics(stats) -> dict:
+    """Переводит статистики с ковариатой в статистики CUPED-скорректированной метрики.
+
+    θ = cov(x, c) / var(c) оценивается по объединённым группам каждой метрики,
+    скорректированное значение x' = x − θ·(c − mean(c)). Для x' пересчитываются Σx и Σx²,
+    так что дальше подходит обычный analyze_sufficient_statistics. В результат
+    добавляются колонки theta и variance_reduction (доля снижения дисперсии).
+    """
+    metric_codes, _ = _combine_codes([stats[c] for c in KEY_COLUMNS])
+    columns = {c: np.asarray(stats[c], dtype=np.float64) for c in STAT_COLUMNS + COVARIATE_COLUMNS}
+    pooled = {c: np.bincount(metric_codes, weights=v)[metric_codes] for c, v in columns.items()}
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_c = pooled["sum_c"] / pooled["n"]
+        cov_xc = pooled["sum_xc"] - pooled["sum_x"] * mean_c
+        var_c = pooled["sum_c2"] - pooled["sum_c"] * mean_c
+        var_x = pooled["sum_x2"] - pooled["sum_x"] ** 2 / pooled["n"]
+        theta = np.where(var_c > 0, cov_xc / var_c, 0.0)
+        variance_reduction = np.where(var_x > 0, cov_xc * theta / var_x, 0.0)
+
+    n, sum_x, sum_x2 = columns["n"], columns["sum_x"], columns["sum_x2"]
+    sum_c, sum_c2, sum_xc = columns["sum_c"], columns["sum_c2"], columns["sum_xc"]
+    # Σ(c − m)  и  Σ(c − m)² по группе
+    centered_c = sum_c - n * mean_c
+    centered_c2 = sum_c2 - 2 * mean_c * sum_c + n * mean_c ** 2
+    centered_xc = sum_xc - mean_c * sum_x
+
+    adjusted = {c: stats[c] for c in KEY_COLUMNS + ["group_label"]}
+    adjusted.update(columns)
+    adjusted["sum_x"] = sum_x - theta * centered_c
+    adjusted["sum_x2"] = sum_x2 - 2 * theta * centered_xc + theta ** 2 * centered_c2
+    adjusted["sum_xy"] = adjusted["sum_x"] * columns["sum_y"] / n
+    adjusted["theta"] = theta
+    adjusted["variance_reduction"] = variance_reduction
+    return adjusted
+
+
+def analyze_cuped(stats, alpha: float = 0.05, control_label: str = "control", test_label: str = "test") -> dict:
+    """Результаты по basic метрикам с CUPED: статистики с sum_c/sum_c2/sum_xc или поюзерные строки с covariate"""
+    if "sum_c" not in stats:
+        stats = sufficient_statistics_from_rows(stats)
+    adjusted = cuped_adjust_statistics(stats)
+    result = analyze_sufficient_statistics(adjusted, alpha, control_label, test_label)
+
+    metric_codes, _ = _combine_codes([adjusted[c] for c in KEY_COLUMNS])
+    for column in ("theta", "variance_reduction"):
+        values = np.full(len(result["metric_name"]), np.nan)
+        values[metric_codes] = adjusted[column]
+        result[column] = values
+    return result
+
+
+def collapse_strata(stats) -> dict:
+    """Статистики по (метрика, группа) из статистик по стратам: суммы по всем стратам"""
+    key_columns = KEY_COLUMNS + ["group_label"]
+    codes, key_values = _combine_codes([stats[c] for c in key_columns])
+    size = len(key_values[0])
+    result = dict(zip(key_columns, key_values))
+    for column in STAT_COLUMNS + COVARIATE_COLUMNS:
+        if column in stats:
+            result[column] = np.bincount(codes, weights=np.asarray(stats[column], dtype=np.float64), minlength=size)
+    if "sample_fraction" in stats and size:
+        result["sample_fraction"] = np.full(size, float(np.asarray(stats["sample_fraction"], dtype=np.float64)[0]))
+    return result
+
+
+def _stratified_estimate(group: dict, weight, used):
+    """Пост-стратифицированное отношение Σw·mean(x) / Σw·mean(y) и его дисперсия дельта-методом"""
+    n = group["n"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = np.where(used, group["sum_x"] / n, 0.0)
+        mean_y = np.where(used, group["sum_y"] / n, 0.0)
+        # Страта с одним пользователем группы в дисперсию не вкладывается
+        scale = np.where(used & (n > 1), 1 / ((n - 1) * n), 0.0)
+        var_x = (group["sum_x2"] - n * mean_x * mean_x) * scale
+        var_y = (group["sum_y2"] - n * mean_y * mean_y) * scale
+        cov_xy = (group["sum_xy"] - n * mean_x * mean_y) * scale
+        x = np.sum(weight * mean_x, axis=1)
+        y = np.sum(weight * mean_y, axis=1)
+        var_x, var_y, cov_xy = (np.sum(weight ** 2 * v, axis=1) for v in (var_x, var_y, cov_xy))
+        ratio = x / y
+        var_ratio = (var_x - 2 * ratio * cov_xy + ratio * ratio * var_y) / (y * y)
+    return ratio, np.maximum(var_ratio, 0.0)
+
+
+def analyze_stratified(stats, alpha: float = 0.05, control_label: str = "control", test_label: str = "test") -> dict:
+    """Пост-стратификация: статистики по (метрика, группа, страта) или поюзерные строки с колонкой stratum.
+
+    Оценка группы — Σ_h W_h·mean_h(x) / Σ_h W_h·mean_h(y), где W_h — доля страты
+    среди пользователей обеих групп; для basic знаменатель равен 1 и это взвешенное
+    среднее по стратам. Дисперсия — Σ W_h²·var_h / n_h (с дельта-методом для ratio),
+    сравнение — z-тест. Страты, где есть только одна группа, не используются
+    (excluded_share — доля их пользователей). variance_reduction — снижение
+    дисперсии разницы относительно оценки без стратификации.
+    """
+    if "n" not in stats:
+        stats = sufficient_statistics_from_rows(stats)
+    labels = np.asarray(stats["group_label"], dtype=object)
+    metric_codes, key_values = _combine_codes([stats[c] for c in KEY_COLUMNS])
+    stratum_codes, strata = _factorize(stats["stratum"])
+    size, width = len(key_values[0]), len(strata)
+    cells = metric_codes * width + stratum_codes
+
+    groups = {}
+    for label in (control_label, test_label):
+        mask = labels == label
+        groups[label] = {
+            c: np.bincount(cells[mask], weights=np.asarray(stats[c], dtype=np.float64)[mask],
+                           minlength=size * width).reshape(size, width)
+            for c in STAT_COLUMNS
+        }
+    control, test = groups[control_label], groups[test_label]
+
+    used = (control["n"] > 0) & (test["n"] > 0)
+    stratum_n = np.where(used, control["n"] + test["n"], 0.0)
+    total_n = (control["n"] + test["n"]).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = stratum_n / stratum_n.sum(axis=1, keepdims=True)
+    c_ratio, c_var = _stratified_estimate(control, weight, used)
+    t_ratio, t_var = _stratified_estimate(test, weight, used)
+
+    result = dict(zip(KEY_COLUMNS, key_values))
+    result["n_control"] = control["n"].sum(axis=1)
+    result["n_test"] = test["n"].sum(axis=1)
+    result.update(_compare_estimates(c_ratio, c_var, t_ratio, t_var, np.full(size, np.inf), alpha))
+
+    _, pooled_c_var = _group_moments(*(control[c].sum(axis=1) for c in STAT_COLUMNS))
+    _, pooled_t_var = _group_moments(*(test[c].sum(axis=1) for c in STAT_COLUMNS))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["variance_reduction"] = 1 - (c_var + t_var) / (pooled_c_var + pooled_t_var)
+        result["excluded_share"] = 1 - stratum_n.sum(axis=1) / total_n
+    result["strata"] = used.sum(axis=1)
+    return result
+
+
+def analyze_bootstrap_replicates(replicates, alpha: float = 0.05,
+                                 control_label: str = "control", test_label: str = "test") -> dict:
+    """Перцентильные бутстреп-интервалы по результатам запросов с опцией bootstrap.
+
+    На входе строки (exp_name, group_label, metric_type, metric_name, replicate,
+    n, sum_x, sum_y), где replicate = 0 — исходная выборка. Оценка в реплике —
+    sum_x / sum_y (для basic sum_y = n). Все метрики обрабатываются одной матрицей
+    «метрика × реплика».
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        estimate = np.asarray(replicates["sum_x"], dtype=np.float64) / np.asarray(replicates["sum_y"], dtype=np.float64)
+    metric_codes, key_values = _combine_codes([replicates[c] for c in KEY_COLUMNS])
+    return _bootstrap_intervals(
+        metric_codes, key_values, np.asarray(replicates["group_label"], dtype=object),
+        np.asarray(replicates["replicate"], dtype=np.int64), estimate, alpha, control_label, test_label
+    )
+
+
+def _bootstrap_intervals(metric_codes, key_values, labels, replicate, estimate, alpha, control_label, test_label) -> dict:
+    """Перцентильные интервалы по оценкам (метрика, группа, реплика); replicate = 0 — исходная выборка"""
+    size = len(key_values[0])
+    width = int(replicate.max()) + 1 if len(replicate) else 1
+
+    matrices = {}
+    for label in (control_label, test_label):
+        mask = labels == label
+        matrix = np.full((size, width), np.nan)
+        matrix[metric_codes[mask], replicate[mask]] = estimate[mask]
+        matrices[label] = matrix
+
+    control, test = matrices[control_label], matrices[test_label]
+    diff = test - control
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lift = diff / control
+    # Без реплик интервалы не определены
+    boot_diff = diff[:, 1:] if width > 1 else np.full((size, 1), np.nan)
+    boot_lift = lift[:, 1:] if width > 1 else np.full((size, 1), np.nan)
+
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        share_below = np.nanmean(np.where(np.isnan(boot_diff), np.nan, boot_diff <= 0), axis=1)
+        share_above = np.nanmean(np.where(np.isnan(boot_diff), np.nan, boot_diff >= 0), axis=1)
+        ci = np.nanpercentile(boot_diff, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+        lift_ci = np.nanpercentile(boot_lift, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+
+    result = dict(zip(KEY_COLUMNS, key_values))
+    result.update({
+        "control": control[:, 0],
+        "test": test[:, 0],
+        "diff": diff[:, 0],
+        "ci_low": ci[0],
+        "ci_high": ci[1],
+        "lift": lift[:, 0],
+        "lift_ci_low": lift_ci[0],
+        "lift_ci_high": lift_ci[1],
+        "p_value": np.minimum(1.0, 2 * np.minimum(share_below, share_above)),
+        "replicates": np.sum(~np.isnan(boot_diff), axis=1),
+    })
+    return result
+
+
+def quantiles_from_sketches(rows) -> dict:
+    """Сливает t-digest скетчи по дням и считает квантили по (метрика, группа, реплика).
+
+    На входе строки output="rows" запроса build_quantile_sketch_query: exp_name,
+    group_label, metric_type, metric_name, level, replicate, n, sketch. Возвращает
+    dict колонок тех же ключей с n и value — как у output="aggregate".
+    """
+    key_columns = KEY_COLUMNS + ["group_label", "replicate"]
+    codes, key_values = _combine_codes([rows[c] for c in key_columns])
+    size = len(key_values[0])
+    levels = np.zeros(size)
+    levels[codes] = np.asarray(rows["level"], dtype=np.float64)
+
+    decoded = [decode_sketch(s) for s in rows["sketch"]]
+    lengths = np.fromiter((len(m) for m, _ in decoded), dtype=np.int64, count=len(decoded))
+    means = np.concatenate([m for m, _ in decoded]) if decoded else np.empty(0)
+    counts = np.concatenate([c for _, c in decoded]) if decoded else np.empty(0)
+
+    result = dict(zip(key_columns, key_values))
+    result["level"] = levels
+    result["n"] = np.bincount(codes, weights=np.asarray(rows["n"], dtype=np.float64), minlength=size)
+    result["value"] = sketch_quantiles(np.repeat(codes, lengths), means, counts, levels, size)
+    return result
+
+
+def analyze_quantiles(rows, alpha: float = 0.05, control_label: str = "control", test_label: str = "test") -> dict:
+    """Разница квантилей тест − контроль с бутстреп-интервалами по результатам квантильных метрик.
+
+    Принимает строки со скетчами (output="rows", сливаются через quantiles_from_sketches)
+    или готовые квантили (output="aggregate", колонка value). Интервалы и p-value —
+    перцентильные по репликам, как в analyze_bootstrap_replicates; без опции
+    bootstrap возвращаются только оценки.
+    """
+    if "sketch" in rows:
+        rows = quantiles_from_sketches(rows)
+    metric_codes, key_values = _combine_codes([rows[c] for c in KEY_COLUMNS])
+    return _bootstrap_intervals(
+        metric_codes, key_values, np.asarray(rows["group_label"], dtype=object),
+        np.asarray(rows["replicate"], dtype=np.int64), np.asarray(rows["value"], dtype=np.float64),
+        alpha, control_label, test_label
+    )
@@ -0,0 +1,459 @@
+"""Пакетный запуск всех экспериментов из experiments_config.yaml без Streamlit.
+
+Конфиг загружается один раз, SQL генерируется generate_sql_queries_for_metrics,
+а запросы выполняются через подключаемый executor в ограниченном пуле потоков:
+с лимитом одновременных запросов на эксперимент, повторами и приёмниками
+результатов (sinks).
+
+Executor — любой callable(sql) -> список строк-словарей. Для локальных прогонов
+и тестов есть ChdbExecutor: встроенный ClickHouse (chdb) поверх Parquet-файла.
+
+При stream=True поюзерные строки (output="rows") читаются порциями через
+executor.stream(sql, chunk_rows) и сразу сворачиваются в достаточные статистики
+(analysis.OnlineStatistics), так что в sinks попадают статистики по группам, а
+память не растёт с числом пользователей.
+
+С store (result_store.ResultStore, флаг --store-dir) результаты запросов одного
+эксперимента сохраняются в Arrow IPC по хэшу конфигурации, и повторный запуск
+выполняет только запросы, у которых изменились конфигурация или период.
+
+Ежедневное обновление (run_daily_refresh, флаг --daily-cache-dir) считает только
+точечные оценки метрик по группам через дневной кэш result_cache.py: запрашиваются
+только дни, которых ещё нет в кэше.
+
+Пример:
+    python batch_runner.py --executor chdb --parquet data.parquet --output-dir results
+    python batch_runner.py --daily-cache-dir daily_cache --output-dir daily
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+
+import yaml
+
+from analysis import OnlineStatistics
+from config_store import load_config, load_presets
+from preaggregation import build_preaggregated_view
+from profiling import enable as enable_profiling, log_query, timed, write_metrics
+from result_cache import DailyResultCache, fetch_metric_totals
+from result_store import ResultStore, columns_from_rows, experiment_config_hash
+from shared_scan import generate_shared_scan_queries, split_results_by_experiment
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+# Строк в одной порции при потоковом чтении
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+# --- Executors
+
+class ClickHouseExecutor:
+    """Выполнение запросов в ClickHouse через clickhouse_connect (HTTP).
+
+    Параметры подключения по умолчанию берутся из CLICKHOUSE_HOST, CLICKHOUSE_PORT,
+    CLICKHOUSE_USER и CLICKHOUSE_PASSWORD.
+    """
+
+    def __init__(self, host: str = None, port: int = None, username: str = None, password: str = None, **settings):
+        try:
+            import clickhouse_connect
+        except Exception as e:
+            raise RuntimeError("Для ClickHouseExecutor нужен пакет clickhouse-connect") from e
+        self._local = threading.local()
+        self._connect = lambda: clickhouse_connect.get_client(
+            host=host or os.getenv("CLICKHOUSE_HOST", "localhost"),
+            port=int(port or os.getenv("CLICKHOUSE_PORT", "8123")),
+            username=username or os.getenv("CLICKHOUSE_USER", "default"),
+            password=password or os.getenv("CLICKHOUSE_PASSWORD", ""),
+            settings=settings or None,
+        )
+
+    def __call__(self, sql: str) -> list:
+        # Клиент clickhouse_connect не потокобезопасен — держим по одному на поток
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._connect()
+        result = client.query(sql)
+        return [dict(zip(result.column_names, row)) for row in result.result_rows]
+
+    def stream(self, sql: str, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+        """Порции результата в Native формате: dict колонок на каждый блок"""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._connect()
+        with client.query_column_block_stream(sql, settings={"max_block_size": chunk_rows}) as blocks:
+            names = blocks.source.column_names
+            for block in blocks:
+                yield dict(zip(names, block))
+
+
+class ChdbExecutor:
+    """Встроенный ClickHouse (chdb) поверх Parquet: локальная замена кластера для тестов.
+
+    Имя исходной таблицы в запросах подменяется на file(<parquet_path>, Parquet).
+    """
+
+    def __init__(self, parquet_path: str, source_table: str = SOURCE_TABLE):
+        try:
+            import chdb
+        except Exception as e:
+            raise RuntimeError("Для ChdbExecutor нужен пакет chdb") from e
+        self._chdb = chdb
+        self.source_table = source_table
+        self.table_function = f"file('{os.path.abspath(parquet_path)}', Parquet)"
+
+    def __call__(self, sql: str) -> list:
+        sql = sql.replace(self.source_table, self.table_function)
+        text = self._chdb.query(sql, "JSONEachRow").bytes().decode("utf-8")
+        return [json.loads(line) for line in text.splitlines() if line]
+
+    def stream(self, sql: str, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+        """Порции результата как Arrow record batches: dict колонок на каждую порцию (см. _arrow_column)"""
+        sql = sql.replace(self.source_table, self.table_function)
+        connection = self._chdb.connect(":memory:")
+        try:
+            result = connection.send_query(sql, "Arrow")
+            for batch in result.record_batch(rows_per_batch=chunk_rows):
+                yield {name: _arrow_column(column) for name, column in zip(batch.schema.names, batch.columns)}
+        finally:
+            connection.close()
+
+
+def _arrow_column(column):
+    """Колонка Arrow -> numpy; строковые колонки — pandas category, если pandas установлен.
+
+    Строковые колонки результата — ключи (эксперимент, метрика, группа) с несколькими
+    значениями на порцию: словарное кодирование в Arrow не создаёт строку Python на
+    каждую строку результата, а analysis берёт готовые коды категорий.
+    """
+    import pyarrow as pa
+
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        try:
+            return column.dictionary_encode().to_pandas()
+        except ImportError:
+            pass
+    return column.to_numpy(zero_copy_only=False)
+
+
+# --- Sinks
+
+class MemorySink:
+    """Собирает результаты в памяти: {experiment_name: {query_name: rows}}"""
+
+    def __init__(self):
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, experiment_name: str, query_name: str, rows: list):
+        with self._lock:
+            self.results.setdefault(experiment_name, {})[query_name] = rows
+
+
+class JsonlSink:
+    """Пишет результат каждого запроса в <directory>/<experiment_name>/<query_name>.jsonl (с перезаписью)"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, experiment_name: str, query_name: str, rows: list):
+        experiment_dir = os.path.join(self.directory, _safe_filename(experiment_name))
+        os.makedirs(experiment_dir, exist_ok=True)
+        path = os.path.join(experiment_dir, f"{_safe_filename(query_name)}.jsonl")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "_"
+
+
+def stream_statistics(execute, sql: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> list:
+    """Читает результат запроса порциями и сворачивает поюзерные строки в достаточные статистики.
+
+    Порции без колонки numerator (бутстреп, скетчи квантилей, уже агрегированные
+    запросы) возвращаются как есть.
+    """
+    statistics = OnlineStatistics()
+    rows = []
+    for chunk in execute.stream(sql, chunk_rows):
+        if "numerator" in chunk:
+            statistics.update(chunk)
+        else:
+            rows += _rows_from_columns(chunk)
+    return rows + _rows_from_columns(statistics.result())
+
+
+def _rows_from_columns(columns: dict) -> list:
+    names = list(columns)
+    values = [list(columns[name]) if not hasattr(columns[name], "tolist") else columns[name].tolist() for name in names]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+# --- Запуск
+
+@timed()
+def plan_queries(config_data: dict, source_table: str = SOURCE_TABLE, fused: bool = False, output: str = "rows",
+                 experiment_names: list = None, shared_scan: bool = False, preaggregated=None,
+                 optimize: bool = False, prewhere: bool = True) -> list:
+    """Список задач (experiment_name, query_name, sql, experiments) для всех экспериментов конфига.
+
+    experiments — эксперименты, чьи строки возвращает запрос (больше одного для общего
+    прохода shared_scan). Задачи разных экспериментов чередуются, чтобы лимит на
+    эксперимент не простаивал пул. preaggregated — таблица предагрегатов для обычных
+    (не shared_scan) запросов, см. preaggregation.py. optimize и prewhere передаются
+    генераторам, см. sql_optimizer.py.
+    """
+    experiments = [
+        e for e in config_data.get("experiments", [])
+        if not experiment_names or e["experiment_name"] in experiment_names
+    ]
+    per_experiment = {}
+    if shared_scan:
+        for name, sql, names in generate_shared_scan_queries(experiments, source_table, output=output,
+                                                            optimize=optimize, prewhere=prewhere):
+            label = " + ".join(names)
+            per_experiment.setdefault(label, []).append((label, name, sql, names))
+    else:
+        for experiment in experiments:
+            queries = generate_sql_queries_for_metrics(
+                experiment, source_table, fused=fused, output=output, preaggregated=preaggregated,
+                optimize=optimize, prewhere=prewhere
+            )
+            per_experiment[experiment["experiment_name"]] = [
+                (experiment["experiment_name"], name, sql, [experiment["experiment_name"]]) for name, sql in queries
+            ]
+    per_experiment = list(per_experiment.values())
+
+    tasks = []
+    while any(per_experiment):
+        for queue in per_experiment:
+            if queue:
+                tasks.append(queue.pop(0))
+    return tasks
+
+
+def run_batch(config_data: dict, execute, sinks: list, source_table: str = SOURCE_TABLE, fused: bool = False,
+              output: str = "rows", experiment_names: list = None, max_workers: int = 8,
+              per_experiment_limit: int = 2, retries: int = 2, retry_backoff: float = 1.0,
+              shared_scan: bool = False, preaggregated=None, optimize: bool = False,
+              prewhere: bool = True, stream: bool = False, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+              store: ResultStore = None) -> list:
+    """Выполняет запросы всех экспериментов и отдаёт результаты в sinks.
+
+    При shared_scan=True эксперименты с пересекающимися датами и одинаковыми фильтрами
+    читаются общим запросом (см. shared_scan.py), а строки раскладываются по
+    экспериментам перед передачей в sinks.
+
+    При stream=True результат читается порциями по chunk_rows строк через
+    execute.stream и сворачивается в достаточные статистики (см. stream_statistics).
+
+    store — хранилище результатов (см. result_store.py): запросы одного эксперимента
+    с сохранённым результатом для того же SQL не выполняются, а новые результаты
+    сохраняются. Запросы общего прохода через хранилище не идут.
+
+    Возвращает сводку по задачам: experiment_name, query_name, status ("ok"/"error"/"stored"),
+    rows, attempts, seconds и error. Время каждой задачи попадает в журнал запросов
+    profiling.log_query (если профилирование включено).
+    """
+    tasks = plan_queries(config_data, source_table, fused, output, experiment_names, shared_scan, preaggregated,
+                         optimize, prewhere)
+    limits = {}
+    for experiment_name, _, _, _ in tasks:
+        limits.setdefault(experiment_name, threading.BoundedSemaphore(per_experiment_limit))
+    config_hashes = {}
+    if store is not None:
+        for experiment in config_data.get("experiments", []):
+            config_hashes[experiment["experiment_name"]] = experiment_config_hash(
+                experiment, source_table, fused=fused, output=output, preaggregated=preaggregated,
+                optimize=optimize, prewhere=prewhere, stream=stream,
+            )
+
+    def run_task(experiment_name, query_name, sql, experiments):
+        started = time.monotonic()
+        attempt = 0
+        config_hash = config_hashes.get(experiment_name) if len(experiments) == 1 else None
+        if config_hash is not None:
+            columns = store.get(experiment_name, config_hash, query_name, sql)
+            if columns is not None:
+                rows = _rows_from_columns(columns)
+                for sink in sinks:
+                    sink(experiment_name, query_name, rows)
+                return {
+                    "experiment_name": experiment_name, "query_name": query_name, "status": "stored",
+                    "rows": len(rows), "attempts": 0, "seconds": time.monotonic() - started, "error": None,
+                }
+        with limits[experiment_name]:
+            while True:
+                attempt += 1
+                try:
+                    rows = stream_statistics(execute, sql, chunk_rows) if stream else execute(sql)
+                    break
+                except Exception as e:
+                    if attempt > retries:
+                        return {
+                            "experiment_name": experiment_name, "query_name": query_name, "status": "error",
+                            "rows": 0, "attempts": attempt, "seconds": time.monotonic() - started, "error": str(e),
+                        }
+                    time.sleep(retry_backoff * 2 ** (attempt - 1))
+        try:
+            if config_hash is not None:
+                experiment = next(e for e in config_data["experiments"] if e["experiment_name"] == experiment_name)
+                store.put(experiment_name, config_hash, query_name, sql, columns_from_rows(rows),
+                          experiment.get("start_date"), experiment.get("end_date"))
+            if len(experiments) == 1:
+                parts = {experiments[0]: rows}
+            else:
+                parts = split_results_by_experiment(rows, experiments)
+            for sink in sinks:
+                for name, part in parts.items():
+                    sink(name, query_name, part)
+        except Exception as e:
+            return {
+                "experiment_name": experiment_name, "query_name": query_name, "status": "error",
+                "rows": len(rows), "attempts": attempt, "seconds": time.monotonic() - started,
+                "error": f"sink: {e}",
+            }
+        return {
+            "experiment_name": experiment_name, "query_name": query_name, "status": "ok",
+            "rows": len(rows), "attempts": attempt, "seconds": time.monotonic() - started, "error": None,
+        }
+
+    summary = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_task, *task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            log_query(result["experiment_name"], result["query_name"], result["seconds"], result["rows"],
+                      result["status"])
+            summary.append(result)
+    if store is not None:
+        store.evict()
+    return summary
+
+
+def run_daily_refresh(config_data: dict, execute, sinks: list, cache: DailyResultCache,
+                      source_table: str = SOURCE_TABLE, experiment_names: list = None, today: date = None) -> list:
+    """Точечные оценки метрик всех экспериментов через дневной кэш (см. result_cache.py).
+
+    Для каждой метрики запрашиваются только отсутствующие в кэше дни. Результат
+    эксперимента уходит в sinks запросом daily_totals: строка на (метрика, группа) с
+    users, numerator, denominator и value. Метрики, которые не раскладываются по дням
+    (HAVING, cap_quantile, квантили, неаддитивные агрегаты), пропускаются со статусом
+    "skipped". Сводка — в том же формате, что у run_batch, по метрикам.
+    """
+    summary = []
+    for experiment in config_data.get("experiments", []):
+        if experiment_names and experiment["experiment_name"] not in experiment_names:
+            continue
+        rows = []
+        for m in experiment["metrics"]:
+            started = time.monotonic()
+            status, error = "ok", None
+            try:
+                totals = fetch_metric_totals(experiment, m, source_table, execute, cache, today)
+            except ValueError as e:
+                status, error, totals = "skipped", str(e), {}
+            except Exception as e:
+                status, error, totals = "error", str(e), {}
+            metric_rows = [
+                dict(metric_type=m["type"], metric_name=m["name"], group_label=group_label, **values)
+                for group_label, values in totals.items()
+            ]
+            rows += metric_rows
+            result = {
+                "experiment_name": experiment["experiment_name"], "query_name": m["name"], "status": status,
+                "rows": len(metric_rows), "attempts": 1, "seconds": time.monotonic() - started, "error": error,
+            }
+            log_query(result["experiment_name"], result["query_name"], result["seconds"], result["rows"], status)
+            summary.append(result)
+        for sink in sinks:
+            sink(experiment["experiment_name"], "daily_totals", rows)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетный запуск SQL по всем экспериментам конфига")
+    parser.add_argument("--config", help="Локальный YAML конфиг (по умолчанию — S3, затем experiments_config.yaml)")
+    parser.add_argument("--experiment", action="append", help="Запустить только указанные эксперименты")
+    parser.add_argument("--source-table", default=SOURCE_TABLE)
+    parser.add_argument("--executor", choices=["clickhouse", "chdb"], default="clickhouse")
+    parser.add_argument("--parquet", help="Parquet-файл для --executor chdb")
+    parser.add_argument("--fused", action="store_true", help="Один запрос на все метрики эксперимента")
+    parser.add_argument("--shared-scan", action="store_true",
+                        help="Общий проход для экспериментов с пересекающимися датами и одинаковыми фильтрами")
+    parser.add_argument("--preaggregated-table",
+                        help="Таблица предагрегатов по пресетам (см. preaggregation.py) для покрытых ею метрик")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Оптимизировать SQL: PREWHERE, hasAny, удаление лишних условий (sql_optimizer.py)")
+    parser.add_argument("--output", choices=["rows", "aggregate"], default="aggregate")
+    parser.add_argument("--stream", action="store_true",
+                        help="Читать поюзерные строки порциями и сворачивать в статистики (с --output rows)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-experiment", type=int, default=2, help="Одновременных запросов на эксперимент")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--output-dir", default="batch_results")
+    parser.add_argument("--store-dir",
+                        help="Хранилище результатов Arrow IPC (result_store.py): повторно выполняются только изменённые запросы")
+    parser.add_argument("--daily-cache-dir",
+                        help="Только точечные оценки через дневной кэш (result_cache.py): запрашиваются только новые дни")
+    parser.add_argument("--profile",
+                        help="Записать таймеры, счётчики и время запросов (profiling.py): *.json или формат Prometheus")
+    args = parser.parse_args(argv)
+    if args.profile:
+        enable_profiling()
+
+    if args.config:
+        with open(args.config, "r") as f:
+            config_data = yaml.safe_load(f) or {"experiments": []}
+    else:
+        config_data = load_config()
+
+    if args.executor == "chdb":
+        if not args.parquet:
+            parser.error("--executor chdb требует --parquet")
+        execute = ChdbExecutor(args.parquet, args.source_table)
+    else:
+        execute = ClickHouseExecutor()
+
+    preaggregated = None
+    if args.preaggregated_table:
+        preaggregated = build_preaggregated_view(load_presets(), args.preaggregated_table, args.source_table)
+
+    if args.daily_cache_dir:
+        summary = run_daily_refresh(config_data, execute, [JsonlSink(args.output_dir)],
+                                    DailyResultCache(args.daily_cache_dir), args.source_table, args.experiment)
+    else:
+        summary = run_batch(
+            config_data, execute, [JsonlSink(args.output_dir)], source_table=args.source_table, fused=args.fused,
+            output=args.output, experiment_names=args.experiment, max_workers=args.workers,
+            per_experiment_limit=args.per_experiment, retries=args.retries, shared_scan=args.shared_scan,
+            preaggregated=preaggregated, optimize=args.optimize, stream=args.stream, chunk_rows=args.chunk_rows,
+            # Табличная функция file() в chdb не поддерживает PREWHERE
+            prewhere=args.executor != "chdb",
+            store=ResultStore(args.store_dir) if args.store_dir else None,
+        )
+    if args.profile:
+        write_metrics(args.profile)
+    failed = [s for s in summary if s["status"] == "error"]
+    for s in failed:
+        print(f"❌ {s['experiment_name']} / {s['query_name']}: {s['error']}")
+    print(f"Готово: {len(summary) - len(failed)} из {len(summary)} запросов, результаты в {args.output_dir}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
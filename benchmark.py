@@ -0,0 +1,362 @@
+"""Сквозной бенчмарк: генерация SQL, выполнение во встроенном ClickHouse (chdb) и анализ.
+
+Синтетические данные повторяют схему SOURCE_TABLE: magnit_id, event_date, массив
+групп ab и колонки AVAILABLE_METRICS. Данные генерируются самим chdb в Parquet
+(детерминированно по seed) и переиспользуются между запусками. Для каждого размера
+измеряются:
+- generate — generate_sql_queries_for_metrics / generate_shared_scan_queries по конфигу;
+- execute — выполнение полученных запросов через batch_runner.ChdbExecutor;
+- analyze — analysis по результатам запросов.
+
+Время — лучшее из repeat повторов; пиковая память Python (tracemalloc) меряется
+отдельным прогоном, чтобы не искажать время, пиковый RSS процесса — по getrusage.
+Результаты дописываются в JSONL историю и сравниваются с предыдущим запуском с
+теми же параметрами.
+
+Пример:
+    python benchmark.py --users 10000 1000000 --metrics 20 100 --history benchmark_history.jsonl
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from analysis import analyze_rows, analyze_sufficient_statistics
+from batch_runner import ChdbExecutor
+from shared_scan import generate_shared_scan_queries
+from sql_generator import AVAILABLE_METRICS, SOURCE_TABLE, generate_sql_queries_for_metrics
+
+DEFAULT_HISTORY = "benchmark_history.jsonl"
+DEFAULT_DATA_DIR = "benchmark_data"
+START_DATE = date(2024, 1, 1)
+
+# Части названий колонок, по которым определяется тип синтетических значений
+MONEY_TOKENS = {"gmv", "revenue", "discount", "discounts", "bonus", "bonuses", "cm", "cm2", "gm", "pcpo", "lcpo", "amt"}
+FLAG_SUFFIXES = ("_flg", "_flag")
+TEST_LIFT = 1.02
+
+VARIANTS = ["separate", "fused", "shared_scan"]
+
+
+# --- Синтетические данные
+
+def column_type(name: str) -> str:
+    """ClickHouse тип синтетической колонки метрики"""
+    if name == "first_order_date":
+        return "Date"
+    if name.endswith(FLAG_SUFFIXES):
+        return "UInt8"
+    if MONEY_TOKENS & set(name.split("_")):
+        return "Float64"
+    return "UInt32"
+
+
+def _column_sql(name: str, index: int, seed: int) -> str:
+    uniform = f"(cityHash64(u, d, {index}, {seed}) / 18446744073709551616)"
+    kind = column_type(name)
+    if kind == "Date":
+        return f"toDate('2023-01-01') + cityHash64(u, {index}, {seed}) % 365 AS {name}"
+    if kind == "UInt8":
+        return f"toUInt8({uniform} < 0.2) AS {name}"
+    if kind == "Float64":
+        # Экспоненциальное распределение с небольшим эффектом в тестовой группе первого эксперимента
+        return f"-log(1 - {uniform}) * 500 * if(cityHash64(u, 0, {seed}) % 2 = 1, {TEST_LIFT!r}, 1) AS {name}"
+    return f"toUInt32(floor(-log(1 - {uniform}) * 2)) AS {name}"
+
+
+def synthetic_data_sql(users: int, days: int, experiments: int, path: str, activity: float = 0.3, seed: int = 0) -> str:
+    """Запрос chdb, который пишет синтетическую дневную таблицу в Parquet.
+
+    Строка (пользователь, день) есть с вероятностью activity. Каждый пользователь
+    участвует во всех experiments экспериментах: ab = ['exp<e>_c' или 'exp<e>_t', ...].
+    """
+    columns = [
+        "concat('u', toString(u)) AS magnit_id",
+        f"toDate('{START_DATE.isoformat()}') + d AS event_date",
+        f"arrayMap(e -> concat('exp', toString(e), if(cityHash64(u, e, {seed}) % 2 = 0, '_c', '_t')), "
+        f"range({experiments})) AS ab",
+    ] + [_column_sql(name, i + 1, seed) for i, name in enumerate(AVAILABLE_METRICS)]
+    select_clause = ",\n    ".join(columns)
+    return (
+        f"SELECT\n    {select_clause}\n"
+        f"FROM (SELECT intDiv(number, {days}) AS u, number % {days} AS d FROM numbers({users * days}))\n"
+        f"WHERE cityHash64(u, d, {seed}) % 1000 < {int(activity * 1000)}\n"
+        f"INTO OUTFILE '{path}' TRUNCATE\n"
+        f"FORMAT Parquet"
+    )
+
+
+def generate_synthetic_data(users: int, days: int, experiments: int, data_dir: str = DEFAULT_DATA_DIR,
+                            activity: float = 0.3, seed: int = 0) -> str:
+    """Путь к Parquet с синтетическими данными; файл создаётся, если его ещё нет"""
+    try:
+        import chdb
+    except Exception as e:
+        raise RuntimeError("Для бенчмарка нужен пакет chdb") from e
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.abspath(os.path.join(
+        data_dir, f"daily_u{users}_d{days}_e{experiments}_a{activity}_s{seed}.parquet"
+    ))
+    if not os.path.exists(path):
+        chdb.query(synthetic_data_sql(users, days, experiments, path + ".tmp", activity, seed))
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def synthetic_config(experiments: int, metrics: int, days: int) -> dict:
+    """Конфиг экспериментов по синтетическим данным: metrics метрик на эксперимент.
+
+    Метрики по очереди basic sum, ratio к orders_cnt и basic с индивидуальным фильтром.
+    """
+    columns = [name for name in AVAILABLE_METRICS if column_type(name) != "Date"]
+    end_date = (START_DATE + timedelta(days=days - 1)).isoformat()
+    config = {"experiments": []}
+    for e in range(experiments):
+        metric_list = []
+        for i in range(metrics):
+            column = columns[i % len(columns)]
+            kind = i % 3
+            if kind == 0:
+                metric = {"name": f"{column}_{i}", "type": "basic", "expression": f"sum({column})"}
+            elif kind == 1:
+                metric = {"name": f"{column}_per_order_{i}", "type": "ratio",
+                          "numerator": f"sum({column})", "denominator": "sum(orders_cnt)"}
+            else:
+                metric = {"name": f"{column}_buyers_{i}", "type": "basic", "expression": f"sum({column})",
+                          "where_filters": [{"field": "orders_cnt", "operator": ">", "value": "0",
+                                             "value_type": "число"}]}
+            metric_list.append(metric)
+        config["experiments"].append({
+            "experiment_name": f"bench_{e}",
+            "control_group_id": f"exp{e}_c",
+            "test_group_id": f"exp{e}_t",
+            "start_date": START_DATE.isoformat(),
+            "end_date": end_date,
+            "metrics": metric_list,
+            "filters": {"where": [], "having": []},
+        })
+    return config
+
+
+# --- Измерения
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+    except Exception:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def measure(fn, repeat: int = 3, trace_memory: bool = True) -> dict:
+    """Лучшее время из repeat запусков fn и пиковая память отдельного прогона под tracemalloc"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    python_peak = float("nan")
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            fn()
+            python_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        finally:
+            tracemalloc.stop()
+    return {
+        "seconds": min(timings),
+        "seconds_median": float(np.median(timings)),
+        "python_peak_mb": python_peak,
+        "rss_peak_mb": _peak_rss_mb(),
+        "result": result,
+    }
+
+
+def plan_variant(config: dict, variant: str, output: str) -> list:
+    """Список пар (название, sql) для варианта генерации"""
+    if variant == "shared_scan":
+        return [(name, sql) for name, sql, _ in generate_shared_scan_queries(config["experiments"], SOURCE_TABLE, output)]
+    queries = []
+    for experiment in config["experiments"]:
+        queries += generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, fused=variant == "fused", output=output)
+    return queries
+
+
+def _columns(rows: list) -> dict:
+    """Строки-словари -> dict колонок numpy для analysis"""
+    if not rows:
+        return {}
+    columns = {}
+    for key in rows[0]:
+        values = [row[key] for row in rows]
+        try:
+            columns[key] = np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            columns[key] = np.asarray(values, dtype=object)
+    return columns
+
+
+def execute_queries(queries: list, executor) -> dict:
+    """Выполняет запросы и склеивает результаты в колонки.
+
+    Строки каждого запроса сразу переводятся в колонки: список словарей по всем
+    запросам в режиме rows не помещается в память уже на сотнях метрик.
+    """
+    parts = [_columns(executor(sql)) for _, sql in queries]
+    parts = [p for p in parts if p]
+    if not parts:
+        return {}
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+
+def run_benchmark(users: int, days: int, experiments: int, metrics: int, variants: list = None,
+                  outputs: list = None, repeat: int = 3, data_dir: str = DEFAULT_DATA_DIR, seed: int = 0,
+                  execute: bool = True) -> list:
+    """Замеры для одного размера данных и конфига: список словарей stage/variant/output/метрики"""
+    variants = variants or VARIANTS
+    outputs = outputs or ["aggregate"]
+    config = synthetic_config(experiments, metrics, days)
+    base = {"users": users, "days": days, "experiments": experiments, "metrics": metrics}
+    results = []
+
+    executor = None
+    if execute:
+        started = time.perf_counter()
+        path = generate_synthetic_data(users, days, experiments, data_dir, seed=seed)
+        results.append(dict(base, stage="data", variant=None, output=None,
+                            seconds=time.perf_counter() - started, bytes=os.path.getsize(path)))
+        executor = ChdbExecutor(path, SOURCE_TABLE)
+
+    for output in outputs:
+        for variant in variants:
+            generated = measure(lambda: plan_variant(config, variant, output), repeat)
+            queries = generated.pop("result")
+            results.append(dict(base, stage="generate", variant=variant, output=output, queries=len(queries),
+                                **generated))
+            if executor is None:
+                continue
+
+            executed = measure(lambda: execute_queries(queries, executor), repeat, trace_memory=False)
+            columns = executed.pop("result")
+            rows = len(next(iter(columns.values()), []))
+            results.append(dict(base, stage="execute", variant=variant, output=output, rows=rows, **executed))
+
+            analyze = analyze_sufficient_statistics if output == "aggregate" else analyze_rows
+            analyzed = measure(lambda: analyze(columns), repeat)
+            analyzed.pop("result")
+            results.append(dict(base, stage="analyze", variant=variant, output=output, rows=rows, **analyzed))
+    return results
+
+
+# --- История
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def load_history(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(path: str, record: dict):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _result_key(result: dict) -> tuple:
+    return tuple(result.get(k) for k in ("stage", "variant", "output", "users", "days", "experiments", "metrics"))
+
+
+def find_regressions(history: list, results: list, threshold: float = 1.2, min_delta: float = 0.05) -> list:
+    """Замеры, ставшие медленнее последнего предыдущего замера с тем же ключом в threshold раз и больше.
+
+    Разница меньше min_delta секунд не считается регрессией: миллисекундные замеры шумят.
+    """
+    previous = {}
+    for record in history:
+        for result in record["results"]:
+            previous[_result_key(result)] = (record, result)
+    regressions = []
+    for result in results:
+        if _result_key(result) not in previous or result["stage"] == "data":
+            continue
+        record, before = previous[_result_key(result)]
+        if result["seconds"] - before["seconds"] < min_delta:
+            continue
+        if before["seconds"] > 0 and result["seconds"] / before["seconds"] >= threshold:
+            regressions.append({
+                "key": _result_key(result),
+                "commit": record.get("commit"),
+                "before": before["seconds"],
+                "after": result["seconds"],
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк генерации SQL, выполнения в chdb и анализа")
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000],
+                        help="Размеры по числу пользователей (например, 10000 1000000 10000000)")
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--experiments", type=int, default=3)
+    parser.add_argument("--metrics", type=int, nargs="+", default=[20], help="Метрик на эксперимент")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    parser.add_argument("--outputs", nargs="+", choices=["rows", "aggregate"], default=["aggregate"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--no-execute", action="store_true", help="Только генерация SQL, без chdb")
+    parser.add_argument("--regression-threshold", type=float, default=1.2)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = []
+    for users in args.users:
+        for metrics in args.metrics:
+            batch = run_benchmark(users, args.days, args.experiments, metrics, args.variants, args.outputs,
+                                  args.repeat, args.data_dir, args.seed, execute=not args.no_execute)
+            for r in batch:
+                peak = r.get("python_peak_mb", float("nan"))
+                memory = "" if math.isnan(peak) else f", python {peak:.1f} MB"
+                print(f"{r['stage']:<8} users={users:<9} metrics={metrics:<4} {r['variant'] or '':<11} "
+                      f"{r['output'] or '':<9} {r['seconds']:.3f} s{memory}")
+            results += batch
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    regressions = find_regressions(load_history(args.history), results, args.regression_threshold)
+    append_history(args.history, record)
+    for r in regressions:
+        print(f"⚠️ Регрессия {r['key']}: {r['before']:.3f} s -> {r['after']:.3f} s (было на {r['commit']})")
+    print(f"Результаты добавлены в {args.history}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,702 @@
+"""Хранение конфигурации экспериментов и пресетов метрик: S3 (Yandex Object Storage) с fallback на локальные файлы."""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from profiling import count, timed, timer
+
+CONFIG_FILE = "experiments_config.yaml"
+METRICS_PRESETS_FILE = "metrics_presets.yaml"
+
+# --- S3 (Yandex Object Storage) configuration ---
+BUCKET_NAME = os.getenv("S3_BUCKET", "wl2-data")
+PREFIX = os.getenv("S3_PREFIX", "AB_Library_Config")
+# Для локальной замены S3 (minio, moto) достаточно указать другой endpoint
+ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "https://storage.yandexcloud.net")
+# Сколько секунд считать закэшированный объект свежим без запроса в S3
+CACHE_TTL_SECONDS = float(os.getenv("S3_CACHE_TTL", "30"))
+
+_client_lock = threading.Lock()
+_client = None
+_client_key = None
+
+_local_lock = threading.Lock()
+_cache_lock = threading.Lock()
+# filename -> {"etag", "text", "data", "checked_at"}; text None — объекта нет (404)
+_object_cache = {}
+
+
+class ConfigConflictError(Exception):
+    """Объект изменён другим пользователем после того, как мы его прочитали"""
+
+
+def get_object_storage_session():
+    """Общий на процесс клиент S3; пересоздаётся только при смене ключей или endpoint"""
+    global _client, _client_key
+    try:
+        import boto3
+    except Exception:
+        return None
+
+    key_id = os.getenv('S3_KEY_ID')
+    access_key = os.getenv('S3_ACCESS_KEY')
+    if not key_id or not access_key:
+        return None
+
+    client_key = (key_id, access_key, ENDPOINT_URL)
+    with _client_lock:
+        if _client is None or _client_key != client_key:
+            session = boto3.session.Session(
+                aws_access_key_id=key_id,
+                aws_secret_access_key=access_key
+            )
+            _client = session.client(
+                service_name='s3',
+                endpoint_url=ENDPOINT_URL
+            )
+            _client_key = client_key
+        return _client
+
+
+def _s3_key(filename: str) -> str:
+    return f"{PREFIX}/{filename}" if PREFIX else filename
+
+
+def _is_not_modified(error: Exception) -> bool:
+    response = getattr(error, "response", None) or {}
+    code = str(response.get("Error", {}).get("Code", ""))
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in ("304", "NotModified") or status == 304
+
+
+def _is_not_found(error: Exception) -> bool:
+    response = getattr(error, "response", None) or {}
+    code = str(response.get("Error", {}).get("Code", ""))
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in ("404", "NoSuchKey", "NotFound") or status == 404
+
+
+def _cached_entry(filename: str):
+    """Запись кэша для объекта S3 с проверкой по ETag после истечения TTL; None, если объекта нет.
+
+    Отсутствие объекта (404) кэшируется на тот же TTL, чтобы не запрашивать его
+    при каждой перерисовке страницы; после TTL объект запрашивается снова.
+    None возвращается только для 404: при других ошибках S3 (5xx, троттлинг, таймаут)
+    отдаётся устаревшая запись кэша, а если её нет — бросается OSError, чтобы
+    недоступный объект не приняли за отсутствующий.
+    """
+    with _cache_lock:
+        entry = _object_cache.get(filename)
+    if entry and time.monotonic() - entry["checked_at"] < CACHE_TTL_SECONDS:
+        count("s3_cache_hits")
+        return entry if entry["text"] is not None else None
+
+    s3 = get_object_storage_session()
+    if not s3:
+        return None
+    params = {"Bucket": BUCKET_NAME, "Key": _s3_key(filename)}
+    if entry and entry["etag"]:
+        params["IfNoneMatch"] = entry["etag"]
+    count("s3_get_object")
+    try:
+        with timer("s3_get_object"):
+            obj = s3.get_object(**params)
+            body = obj['Body'].read()
+    except Exception as e:
+        if entry and entry["text"] is not None and _is_not_modified(e):
+            # 304: объект не менялся — тело и разобранный YAML берём из кэша
+            count("s3_not_modified")
+            entry["checked_at"] = time.monotonic()
+            return entry
+        if _is_not_found(e):
+            count("s3_not_found")
+            with _cache_lock:
+                _object_cache[filename] = {"etag": None, "text": None, "data": None, "checked_at": time.monotonic()}
+            return None
+        count("s3_errors")
+        if entry and entry["text"] is not None:
+            count("s3_stale_reads")
+            return entry
+        raise OSError(f"Не удалось прочитать {filename} из S3") from e
+
+    count("s3_bytes_read", len(body))
+    entry = {
+        "etag": obj.get("ETag"),
+        "text": body.decode('utf-8'),
+        "data": None,
+        "checked_at": time.monotonic(),
+    }
+    with _cache_lock:
+        _object_cache[filename] = entry
+    return entry
+
+
+def invalidate_cache(filename: str = None):
+    """Сбрасывает кэш объекта (или весь кэш), следующее чтение пойдёт в S3"""
+    with _cache_lock:
+        if filename is None:
+            _object_cache.clear()
+        else:
+            _object_cache.pop(filename, None)
+
+
+@timed()
+def s3_read_yaml_text(filename: str):
+    entry = _cached_entry(filename)
+    return entry["text"] if entry else None
+
+
+def s3_read_yaml(filename: str):
+    """Разобранный YAML из S3; разбор кэшируется вместе с ETag объекта.
+
+    Возвращает копию, чтобы изменения вызывающего кода не портили кэш.
+    None, если объекта нет или YAML некорректен; OSError, если S3 ответил ошибкой.
+    """
+    entry = _cached_entry(filename)
+    if not entry:
+        return None
+    if entry["data"] is None:
+        try:
+            entry["data"] = _load_yaml(entry["text"]) or {}
+        except Exception:
+            return None
+    else:
+        count("yaml_cache_hits")
+    return copy.deepcopy(entry["data"])
+
+
+@timed("yaml_safe_load")
+def _load_yaml(text: str):
+    return yaml.safe_load(text)
+
+
+def _is_precondition_failed(error: Exception) -> bool:
+    response = getattr(error, "response", None) or {}
+    code = str(response.get("Error", {}).get("Code", ""))
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in ("412", "PreconditionFailed") or status == 412
+
+
+def s3_write_yaml_text(filename: str, text: str, if_match: str = None, if_none_match: str = None) -> bool:
+    """Запись объекта в S3; False, если S3 недоступен.
+
+    if_match / if_none_match="*" делают запись условной: при несовпадении ETag
+    (или если объект уже существует) бросается ConfigConflictError.
+    """
+    s3 = get_object_storage_session()
+    if not s3:
+        return False
+    params = {"Bucket": BUCKET_NAME, "Key": _s3_key(filename), "Body": text.encode('utf-8')}
+    if if_match:
+        params["IfMatch"] = if_match
+    if if_none_match:
+        params["IfNoneMatch"] = if_none_match
+    count("s3_put_object")
+    try:
+        with timer("s3_put_object"):
+            response = s3.put_object(**params)
+    except Exception as e:
+        count("s3_errors")
+        invalidate_cache(filename)
+        if _is_precondition_failed(e):
+            raise ConfigConflictError(filename) from e
+        return False
+    count("s3_bytes_written", len(params["Body"]))
+    # Пишем сквозь кэш: следующее чтение не скачивает только что записанный объект
+    with _cache_lock:
+        _object_cache[filename] = {
+            "etag": response.get("ETag"),
+            "text": text,
+            "data": None,
+            "checked_at": time.monotonic(),
+        }
+    return True
+
+
+def s3_delete_object(filename: str) -> bool:
+    s3 = get_object_storage_session()
+    invalidate_cache(filename)
+    if not s3:
+        return False
+    count("s3_delete_object")
+    try:
+        with timer("s3_delete_object"):
+            s3.delete_object(Bucket=BUCKET_NAME, Key=_s3_key(filename))
+    except Exception:
+        count("s3_errors")
+        return False
+    return True
+
+
+# --- Раскладка экспериментов: объект на эксперимент + манифест ---
+# Манифест хранит только имена и пути к объектам, так что для списка экспериментов
+# не нужно читать их тела, а сохранение или удаление одного эксперимента
+# перезаписывает один объект (манифест — только при добавлении или удалении имени).
+# Пока манифеста нет, читается старый монолитный experiments_config.yaml;
+# первая запись переносит его в новую раскладку (см. migrate_monolithic_config).
+EXPERIMENTS_DIR = "experiments"
+MANIFEST_FILE = f"{EXPERIMENTS_DIR}/manifest.yaml"
+MANIFEST_VERSION = 1
+MANIFEST_RETRIES = 5
+
+
+def _local_etag(text: str) -> str:
+    # Совпадает с ETag S3 для объектов, записанных одним PUT
+    return '"' + hashlib.md5(text.encode('utf-8')).hexdigest() + '"'
+
+
+def _read_object(filename: str):
+    """(text, etag) объекта; (None, None), если его нет.
+
+    При настроенном S3 читается только S3, иначе — локальный файл с тем же путём.
+    """
+    if get_object_storage_session():
+        entry = _cached_entry(filename)
+        return (entry["text"], entry["etag"]) if entry else (None, None)
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None, None
+    return text, _local_etag(text)
+
+
+def _write_object(filename: str, text: str, if_match: str = None, if_none_match: str = None) -> str:
+    """Условная запись объекта в S3 (или локальный файл без S3); возвращает новый ETag"""
+    if get_object_storage_session():
+        if not s3_write_yaml_text(filename, text, if_match=if_match, if_none_match=if_none_match):
+            raise OSError(f"Не удалось записать {filename} в S3")
+        return _object_cache[filename]["etag"]
+
+    with _local_lock:
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                current = _local_etag(f.read())
+        except FileNotFoundError:
+            current = None
+        if (if_match and current != if_match) or (if_none_match == "*" and current is not None):
+            raise ConfigConflictError(filename)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+    return _local_etag(text)
+
+
+def _delete_object(filename: str):
+    if get_object_storage_session():
+        s3_delete_object(filename)
+        return
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _experiment_filename(name: str) -> str:
+    # Хэш в имени — чтобы разные названия с одинаковым «безопасным» видом не совпали
+    slug = re.sub(r"[^\w.-]+", "_", name).strip("_")[:80] or "experiment"
+    return f"{EXPERIMENTS_DIR}/{slug}-{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}.yaml"
+
+
+def _read_manifest():
+    """(manifest, etag); (None, None), если эксперименты ещё в монолитном файле"""
+    text, etag = _read_object(MANIFEST_FILE)
+    if text is None:
+        return None, None
+    manifest = _load_yaml(text) or {}
+    manifest.setdefault("experiments", {})
+    return manifest, etag
+
+
+def _update_manifest(update):
+    """Применяет update(experiments) к манифесту с условной записью и повтором при гонке"""
+    for _ in range(MANIFEST_RETRIES):
+        manifest, etag = _read_manifest()
+        if manifest is None:
+            raise RuntimeError("Манифест экспериментов не найден")
+        if not update(manifest["experiments"]):
+            return
+        text = yaml.dump(manifest, sort_keys=False, allow_unicode=True)
+        try:
+            _write_object(MANIFEST_FILE, text, if_match=etag)
+            return
+        except ConfigConflictError:
+            # Манифест поменял кто-то ещё — перечитываем и применяем изменение заново
+            invalidate_cache(MANIFEST_FILE)
+    raise ConfigConflictError(MANIFEST_FILE)
+
+
+def _load_monolithic_config() -> dict:
+    # Load config from S3 first, then fallback to local
+    data = s3_read_yaml(CONFIG_FILE)
+    if data:
+        return data
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            return _load_yaml(f.read()) or {"experiments": []}
+    except FileNotFoundError:
+        return {"experiments": []}
+
+
+def migrate_monolithic_config() -> int:
+    """Переносит эксперименты из experiments_config.yaml в раскладку «объект на эксперимент».
+
+    Старый файл не удаляется (на случай отката). Возвращает число перенесённых
+    экспериментов; 0, если манифест уже существует.
+
+    Миграция запускается только после того, как S3 ответил на чтение манифеста 404
+    (ошибки чтения пробрасываются из _cached_entry). Объекты экспериментов пишутся
+    условно: уже существующий объект — результат параллельной миграции или
+    сохранения — не перезаписывается содержимым старого файла.
+    """
+    if _read_manifest()[0] is not None:
+        return 0
+    # Закэшированный 404 мог устареть: перед записью проверяем отсутствие манифеста заново
+    invalidate_cache(MANIFEST_FILE)
+    if _read_manifest()[0] is not None:
+        return 0
+    experiments = _load_monolithic_config().get("experiments", [])
+    index = {}
+    for experiment in experiments:
+        filename = _experiment_filename(experiment["experiment_name"])
+        try:
+            _write_object(filename, yaml.dump(experiment, sort_keys=False, allow_unicode=True), if_none_match="*")
+        except ConfigConflictError:
+            pass
+        index[experiment["experiment_name"]] = {"file": filename}
+    manifest = {"version": MANIFEST_VERSION, "experiments": index}
+    try:
+        _write_object(MANIFEST_FILE, yaml.dump(manifest, sort_keys=False, allow_unicode=True), if_none_match="*")
+    except ConfigConflictError:
+        # Параллельная миграция успела раньше — её манифест и используем
+        return 0
+    return len(index)
+
+
+@timed()
+def list_experiment_names() -> list:
+    """Имена экспериментов без загрузки их тел"""
+    manifest, _ = _read_manifest()
+    if manifest is None:
+        return [e["experiment_name"] for e in _load_monolithic_config().get("experiments", [])]
+    return list(manifest["experiments"])
+
+
+@timed()
+def load_experiment(name: str):
+    """(эксперимент, etag) по имени; (None, None), если его нет.
+
+    etag передаётся в save_experiment, чтобы не перезаписать чужие изменения.
+    """
+    manifest, _ = _read_manifest()
+    if manifest is None:
+        experiment = next(
+            (e for e in _load_monolithic_config().get("experiments", []) if e["experiment_name"] == name), None
+        )
+        return experiment, None
+    entry = manifest["experiments"].get(name)
+    if entry is None:
+        return None, None
+    text, etag = _read_object(entry["file"])
+    if text is None:
+        return None, None
+    return _load_yaml(text), etag
+
+
+@timed()
+def save_experiment(experiment: dict, expected_etag: str = None, must_not_exist: bool = False) -> str:
+    """Сохраняет один эксперимент; возвращает новый etag.
+
+    expected_etag — etag из load_experiment: если объект с тех пор изменили,
+    бросается ConfigConflictError. must_not_exist=True — конфликт, если эксперимент
+    с таким именем уже создан. Без этих параметров запись безусловная.
+    """
+    migrate_monolithic_config()
+    name = experiment["experiment_name"]
+    manifest, _ = _read_manifest()
+    entry = manifest["experiments"].get(name)
+    if entry is not None and must_not_exist:
+        raise ConfigConflictError(name)
+    filename = entry["file"] if entry else _experiment_filename(name)
+
+    etag = _write_object(
+        filename,
+        yaml.dump(experiment, sort_keys=False, allow_unicode=True),
+        if_match=expected_etag,
+        if_none_match="*" if must_not_exist else None,
+    )
+    if entry is None:
+        def add(experiments):
+            if name in experiments:
+                return False
+            experiments[name] = {"file": filename}
+            return True
+        _update_manifest(add)
+    return etag
+
+
+@timed()
+def save_experiments(experiments: list, overwrite: bool = False, max_workers: int = 8) -> int:
+    """Сохраняет пачку экспериментов: объекты пишутся параллельно, манифест обновляется один раз.
+
+    Без overwrite ни один эксперимент не пишется, если хотя бы одно имя уже есть в
+    конфиге (ConfigConflictError с этими именами); новые объекты пишутся условно,
+    так что параллельное создание того же эксперимента тоже даёт конфликт.
+    Возвращает число сохранённых экспериментов.
+    """
+    migrate_monolithic_config()
+    manifest, _ = _read_manifest()
+    existing = manifest["experiments"]
+    names = [e["experiment_name"] for e in experiments]
+    if len(set(names)) != len(names):
+        raise ValueError("В пачке есть эксперименты с одинаковыми названиями")
+    conflicts = [name for name in names if name in existing]
+    if conflicts and not overwrite:
+        raise ConfigConflictError(", ".join(conflicts))
+
+    def write(experiment):
+        name = experiment["experiment_name"]
+        entry = existing.get(name)
+        filename = entry["file"] if entry else _experiment_filename(name)
+        _write_object(filename, yaml.dump(experiment, sort_keys=False, allow_unicode=True),
+                      if_none_match=None if entry else "*")
+        return name, filename
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        written = dict(pool.map(write, experiments))
+
+    added = {name: filename for name, filename in written.items() if name not in existing}
+    if added:
+        def add(experiments_index):
+            new = {name: filename for name, filename in added.items() if name not in experiments_index}
+            for name, filename in new.items():
+                experiments_index[name] = {"file": filename}
+            return bool(new)
+        _update_manifest(add)
+    return len(written)
+
+
+def delete_experiment(name: str) -> bool:
+    """Удаляет эксперимент из манифеста и его объект; False, если его не было"""
+    migrate_monolithic_config()
+    removed = {}
+
+    def remove(experiments):
+        entry = experiments.pop(name, None)
+        if entry is None:
+            return False
+        removed["file"] = entry["file"]
+        return True
+
+    _update_manifest(remove)
+    if not removed:
+        return False
+    _delete_object(removed["file"])
+    return True
+
+
+# --- Загрузка и сохранение конфига экспериментов ---
+@timed()
+def load_config() -> dict:
+    """Весь конфиг {"experiments": [...]} — для пакетного запуска; интерфейсу хватает list_experiment_names"""
+    manifest, _ = _read_manifest()
+    if manifest is None:
+        return _load_monolithic_config()
+    experiments = []
+    for name in manifest["experiments"]:
+        experiment, _ = load_experiment(name)
+        if experiment is not None:
+            experiments.append(experiment)
+    return {"experiments": experiments}
+
+
+def save_config(config_data: dict):
+    """Сохраняет все эксперименты конфига; отсутствующие в нём удаляются"""
+    experiments = config_data.get("experiments", [])
+    save_experiments(experiments, overwrite=True)
+    names = {experiment["experiment_name"] for experiment in experiments}
+    for name in list_experiment_names():
+        if name not in names:
+            delete_experiment(name)
+
+
+# --- Каталог пресетов метрик ---
+# Снимок metrics_presets.yaml (прежний формат) + журнал добавлений: каждый новый пресет —
+# отдельный объект в presets_log/, поэтому сохранение не перезаписывает весь файл.
+# Когда в журнале накапливается PRESETS_COMPACT_THRESHOLD записей, они переносятся
+# в снимок (compact_presets). При чтении побеждает первая запись с данным именем.
+PRESETS_LOG_DIR = "presets_log"
+PRESETS_COMPACT_THRESHOLD = int(os.getenv("PRESETS_COMPACT_THRESHOLD", "50"))
+
+
+class DuplicatePresetError(Exception):
+    """Пресет с таким именем или таким же определением уже есть в каталоге"""
+
+
+def preset_content_hash(preset: dict) -> str:
+    """Хэш определения пресета без названия — одинаковые метрики под разными именами совпадают"""
+    definition = {k: v for k, v in preset.items() if k != "name"}
+    return hashlib.sha1(json.dumps(definition, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class PresetCatalog:
+    """Пресеты с индексами по имени и по хэшу определения.
+
+    Сохранённые пресеты загружаются как есть, в том числе старые пресеты с
+    одинаковыми определениями: на них по имени ссылаются эксперименты. Дубликаты
+    отклоняются только при добавлении (add). Из записей с одним именем остаётся первая.
+    """
+
+    def __init__(self, presets=()):
+        self.presets = []
+        self.by_name = {}
+        self.by_hash = {}
+        for preset in presets:
+            if preset["name"] not in self.by_name:
+                self._index(preset)
+
+    def _index(self, preset: dict):
+        self.presets.append(preset)
+        self.by_name[preset["name"]] = preset
+        self.by_hash.setdefault(preset_content_hash(preset), preset)
+
+    def __len__(self):
+        return len(self.presets)
+
+    def get(self, name: str):
+        return self.by_name.get(name)
+
+    def find_duplicate(self, preset: dict):
+        """Существующий пресет с тем же именем или тем же определением; None, если такого нет"""
+        return self.by_name.get(preset["name"]) or self.by_hash.get(preset_content_hash(preset))
+
+    def add(self, preset: dict):
+        existing = self.find_duplicate(preset)
+        if existing is not None:
+            raise DuplicatePresetError(existing["name"])
+        self._index(preset)
+
+    def search(self, query: str = "", limit: int = None) -> list:
+        """Имена пресетов: сначала начинающиеся с query, затем содержащие его (без учёта регистра)"""
+        query = query.strip().lower()
+        if not query:
+            names = [p["name"] for p in self.presets]
+        else:
+            prefix = [p["name"] for p in self.presets if p["name"].lower().startswith(query)]
+            substring = [p["name"] for p in self.presets
+                         if query in p["name"].lower() and not p["name"].lower().startswith(query)]
+            names = prefix + substring
+        return names[:limit] if limit is not None else names
+
+
+def _list_objects(directory: str) -> list:
+    """Имена объектов в «каталоге» (S3 или локальном) в лексикографическом порядке"""
+    s3 = get_object_storage_session()
+    if s3:
+        prefix = _s3_key(directory) + "/"
+        names = []
+        try:
+            with timer("s3_list_objects"):
+                for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+                    count("s3_list_objects")
+                    names += [f"{directory}/{obj['Key'][len(prefix):]}" for obj in page.get("Contents", [])]
+        except Exception:
+            count("s3_errors")
+            return []
+        return sorted(names)
+    try:
+        return sorted(f"{directory}/{name}" for name in os.listdir(directory) if name.endswith(".yaml"))
+    except FileNotFoundError:
+        return []
+
+
+def _read_presets_snapshot():
+    """(пресеты, etag) снимка metrics_presets.yaml; etag None, если снимка нет"""
+    text, etag = _read_object(METRICS_PRESETS_FILE)
+    if text is None:
+        return [], None
+    return (_load_yaml(text) or {}).get("metrics_presets", []) or [], etag
+
+
+def _read_presets_log():
+    """[(имя объекта, пресет)] из журнала добавлений в порядке записи"""
+    entries = []
+    for filename in _list_objects(PRESETS_LOG_DIR):
+        # Записи журнала неизменяемы, так что кэш по ETag почти всегда попадает
+        text, _ = _read_object(filename)
+        if text:
+            entries.append((filename, _load_yaml(text)))
+    return entries
+
+
+@timed()
+def load_preset_catalog() -> PresetCatalog:
+    presets, _ = _read_presets_snapshot()
+    return PresetCatalog(presets + [preset for _, preset in _read_presets_log()])
+
+
+def load_presets():
+    return load_preset_catalog().presets
+
+
+def save_new_preset(new_preset, catalog: PresetCatalog = None):
+    """Добавляет пресет одной записью в журнал.
+
+    Бросает DuplicatePresetError, если пресет с таким именем или определением уже есть.
+    catalog — уже загруженный каталог, чтобы не читать его повторно.
+    """
+    catalog = catalog if catalog is not None else load_preset_catalog()
+    catalog.add(new_preset)
+    filename = f"{PRESETS_LOG_DIR}/{time.time_ns():020d}-{preset_content_hash(new_preset)[:12]}.yaml"
+    _write_object(filename, yaml.dump(new_preset, sort_keys=False, allow_unicode=True), if_none_match="*")
+    if len(_list_objects(PRESETS_LOG_DIR)) >= PRESETS_COMPACT_THRESHOLD:
+        compact_presets()
+
+
+def compact_presets() -> int:
+    """Переносит журнал добавлений в снимок metrics_presets.yaml; возвращает число перенесённых записей.
+
+    Снимок пишется условно по ETag: если его параллельно переписали, сжатие пропускается.
+    Записи, добавленные во время сжатия, остаются в журнале до следующего раза.
+    """
+    presets, etag = _read_presets_snapshot()
+    log = _read_presets_log()
+    if not log:
+        return 0
+    catalog = PresetCatalog(presets + [preset for _, preset in log])
+    text = yaml.dump({"metrics_presets": catalog.presets}, sort_keys=False, allow_unicode=True)
+    try:
+        _write_object(METRICS_PRESETS_FILE, text, if_match=etag, if_none_match=None if etag else "*")
+    except ConfigConflictError:
+        invalidate_cache(METRICS_PRESETS_FILE)
+        return 0
+    for filename, _ in log:
+        _delete_object(filename)
+    return len(log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обслуживание хранилища конфигурации экспериментов")
+    parser.add_argument("command", choices=["migrate", "compact-presets"],
+                        help="migrate — перенести experiments_config.yaml в раскладку «объект на эксперимент»; "
+                             "compact-presets — перенести журнал пресетов в metrics_presets.yaml")
+    args = parser.parse_args(argv)
+    if args.command == "compact-presets":
+        print(f"Перенесено записей журнала пресетов: {compact_presets()}")
+        return 0
+    count = migrate_monolithic_config()
+    print(f"Перенесено экспериментов: {count}" if count else "Манифест уже существует или экспериментов нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,305 @@
+"""Массовый импорт и экспорт экспериментов: CSV, YAML и JSON.
+
+Импорт разбирает файл, проверяет все эксперименты по той же схеме, что создаёт
+форма Streamlit (validate_experiment), и сохраняет их одной пачкой
+(config_store.save_experiments: объекты параллельно, манифест — один раз). Если
+хотя бы один эксперимент некорректен, ничего не сохраняется.
+
+YAML/JSON — список экспериментов, {"experiments": [...]} (как experiments_config.yaml)
+или один эксперимент. CSV — строка на эксперимент: простые поля колонками,
+вложенные (metrics, filters, arms, cuped, strata) — JSON в ячейке. Вместо metrics можно
+указать колонку presets с названиями пресетов через «;».
+
+Пример:
+    python experiment_io.py import seasonal.csv
+    python experiment_io.py export backup.yaml
+"""
+import argparse
+import csv
+import io
+import json
+import os
+from datetime import date
+
+import yaml
+
+from config_store import ConfigConflictError, load_config, load_preset_catalog, save_experiments
+from expression_parser import try_parse
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+FORMATS = ("csv", "yaml", "json")
+REQUIRED_FIELDS = ["experiment_name", "control_group_id", "test_group_id", "start_date", "end_date"]
+CSV_COLUMNS = REQUIRED_FIELDS + ["metrics", "filters", "arms", "cuped", "strata", "sample"]
+NESTED_FIELDS = ["metrics", "filters", "arms", "cuped", "strata"]
+OPERATORS = ["=", "!=", "IN", ">=", "<=", ">", "<"]
+VALUE_TYPES = ["строка", "число", "булево"]
+METRIC_TYPES = ["basic", "ratio", "quantile"]
+
+
+def detect_format(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lower().lstrip(".")
+    extension = "yaml" if extension == "yml" else extension
+    if extension not in FORMATS:
+        raise ValueError(f"Неизвестный формат файла: {filename} (ожидается .csv, .yaml или .json)")
+    return extension
+
+
+# --- Разбор
+
+def _csv_experiment(row: dict, catalog) -> dict:
+    experiment = {}
+    for key, value in row.items():
+        value = (value or "").strip()
+        if not key or not value:
+            continue
+        if key in NESTED_FIELDS:
+            experiment[key] = json.loads(value)
+        elif key == "sample":
+            experiment[key] = float(value)
+        elif key == "presets":
+            names = [name.strip() for name in value.split(";") if name.strip()]
+            presets = [catalog.get(name) for name in names]
+            missing = [name for name, preset in zip(names, presets) if preset is None]
+            if missing:
+                raise ValueError(f"Нет пресетов: {', '.join(missing)}")
+            experiment.setdefault("metrics", []).extend(dict(preset) for preset in presets)
+        else:
+            experiment[key] = value
+    experiment.setdefault("metrics", [])
+    experiment.setdefault("filters", {"where": [], "having": []})
+    return experiment
+
+
+def parse_experiments(text: str, fmt: str, catalog=None) -> list:
+    """Эксперименты из текста файла; catalog (PresetCatalog) нужен для колонки presets в CSV"""
+    if fmt == "csv":
+        rows = list(csv.DictReader(io.StringIO(text)))
+        if rows and "presets" in rows[0] and catalog is None:
+            catalog = load_preset_catalog()
+        experiments = []
+        for i, row in enumerate(rows, start=2):
+            try:
+                experiments.append(_csv_experiment(row, catalog))
+            except ValueError as e:
+                raise ValueError(f"Строка {i}: {e}") from e
+        return experiments
+    if fmt == "yaml":
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Некорректный YAML: {e}") from e
+    elif fmt == "json":
+        data = json.loads(text)
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    if isinstance(data, dict):
+        data = data["experiments"] if "experiments" in data else [data]
+    if not isinstance(data, list) or not all(isinstance(e, dict) for e in data):
+        raise ValueError("Ожидается список экспериментов")
+    return [_normalize(e) for e in data]
+
+
+def _normalize(experiment: dict) -> dict:
+    """Поля формы — строками: YAML сам превращает 2024-01-01 в date, а ID групп — в числа"""
+    experiment = dict(experiment)
+    for field in REQUIRED_FIELDS:
+        value = experiment.get(field)
+        if isinstance(value, date):
+            experiment[field] = value.isoformat()
+        elif value is not None and not isinstance(value, str):
+            experiment[field] = str(value)
+    experiment.setdefault("filters", {"where": [], "having": []})
+    return experiment
+
+
+# --- Проверка
+
+def _validate_filters(filters, where: str) -> list:
+    if not isinstance(filters, list):
+        return [f"{where}: фильтры должны быть списком: {filters!r}"]
+    errors = []
+    for f in filters:
+        if not isinstance(f, dict) or not f.get("field") or "value" not in f:
+            errors.append(f"{where}: фильтр должен содержать field, operator и value: {f}")
+            continue
+        if f.get("operator") not in OPERATORS:
+            errors.append(f"{where}: неизвестный оператор {f.get('operator')!r} в фильтре по {f['field']}")
+        elif f["operator"] == "IN" and not isinstance(f["value"], list):
+            errors.append(f"{where}: для IN значение должно быть списком ({f['field']})")
+        if f.get("value_type", "строка") not in VALUE_TYPES:
+            errors.append(f"{where}: неизвестный тип значения {f.get('value_type')!r} ({f['field']})")
+    return errors
+
+
+def _validate_metric(m) -> list:
+    if not isinstance(m, dict) or not m.get("name"):
+        return [f"Метрика без названия: {m}"]
+    where = f"Метрика '{m['name']}'"
+    if m.get("type") not in METRIC_TYPES:
+        return [f"{where}: неизвестный тип {m.get('type')!r}"]
+    errors = []
+    fields = ["numerator", "denominator"] if m["type"] == "ratio" else ["expression"]
+    for field in fields:
+        if not isinstance(m.get(field), str) or try_parse(m[field]) is None:
+            errors.append(f"{where}: выражение {field} не задано или не разбирается: {m.get(field)!r}")
+    if m["type"] == "quantile" and not 0 < float(m.get("level", 0.5)) < 1:
+        errors.append(f"{where}: уровень квантиля должен быть в (0, 1)")
+    bootstrap = m.get("bootstrap")
+    if bootstrap is not None and not (isinstance(bootstrap, dict) and int(bootstrap.get("replicates", 0)) > 0):
+        errors.append(f"{where}: bootstrap должен быть вида {{replicates: N}}, N > 0")
+    if "cap_quantile" in m and not 0 < float(m["cap_quantile"]) < 1:
+        errors.append(f"{where}: cap_quantile должен быть в (0, 1)")
+    errors += _validate_filters(m.get("where_filters", []), where)
+    return errors
+
+
+def validate_experiment(experiment: dict) -> list:
+    """Ошибки эксперимента (пустой список — корректен): поля формы, метрики, фильтры и генерация SQL"""
+    errors = []
+    for field in REQUIRED_FIELDS:
+        if not str(experiment.get(field) or "").strip():
+            errors.append(f"Не заполнено поле {field}")
+    try:
+        start = date.fromisoformat(str(experiment.get("start_date")))
+        end = date.fromisoformat(str(experiment.get("end_date")))
+        if start > end:
+            errors.append("Дата начала позже даты окончания")
+    except ValueError:
+        errors.append("Даты должны быть в формате YYYY-MM-DD")
+
+    metrics = experiment.get("metrics")
+    if not isinstance(metrics, list) or not metrics:
+        errors.append("Нужна хотя бы одна метрика")
+        metrics = []
+    names = [m.get("name") for m in metrics if isinstance(m, dict)]
+    duplicates = sorted({name for name in names if names.count(name) > 1 and name})
+    if duplicates:
+        errors.append(f"Повторяются названия метрик: {', '.join(duplicates)}")
+    for m in metrics:
+        try:
+            errors += _validate_metric(m)
+        except (TypeError, ValueError) as e:
+            errors.append(f"Метрика '{m.get('name')}': некорректное значение ({e})")
+
+    filters = experiment.get("filters", {})
+    if not isinstance(filters, dict):
+        errors.append(f"filters должен быть вида {{where: [...], having: [...]}}: {filters!r}")
+        filters = {}
+    errors += _validate_filters(filters.get("where", []), "WHERE")
+    having = filters.get("having", [])
+    if not isinstance(having, list):
+        errors.append(f"HAVING: условия должны быть списком: {having!r}")
+        having = []
+    for h in having:
+        if not isinstance(h, dict) or try_parse(str(h.get("expression", ""))) is None:
+            errors.append(f"HAVING: выражение не разбирается: {h}")
+    for arm in experiment.get("arms") or []:
+        if not isinstance(arm, dict) or not arm.get("label") or not arm.get("group_id"):
+            errors.append(f"Плечо должно содержать label и group_id: {arm}")
+    cuped = experiment.get("cuped")
+    if cuped is not None and not (isinstance(cuped, dict) and str(cuped.get("pre_period_days", "")).isdigit()
+                                  and int(cuped["pre_period_days"]) > 0):
+        errors.append("cuped должен быть вида {pre_period_days: N}, N > 0")
+    strata = experiment.get("strata") or []
+    for expr in [strata] if isinstance(strata, str) else strata:
+        if not isinstance(expr, str) or try_parse(expr) is None:
+            errors.append(f"Выражение страты не разбирается: {expr!r}")
+
+    if not errors:
+        # Последняя проверка — тот же генератор SQL, что и у формы
+        try:
+            generate_sql_queries_for_metrics(experiment, SOURCE_TABLE)
+        except (ValueError, KeyError, TypeError) as e:
+            errors.append(f"SQL не генерируется: {e}")
+    return errors
+
+
+def validate_experiments(experiments: list) -> dict:
+    """{название (или «#номер»): [ошибки]} для некорректных экспериментов пачки"""
+    problems = {}
+    names = [e.get("experiment_name") for e in experiments]
+    for i, experiment in enumerate(experiments, start=1):
+        key = experiment.get("experiment_name") or f"#{i}"
+        errors = validate_experiment(experiment)
+        if names.count(experiment.get("experiment_name")) > 1:
+            errors.append("Название повторяется в файле")
+        if errors:
+            problems[key] = errors
+    return problems
+
+
+# --- Импорт и экспорт
+
+def import_experiments(text: str, fmt: str, overwrite: bool = False, dry_run: bool = False, catalog=None) -> int:
+    """Разбирает, проверяет и сохраняет эксперименты одной пачкой; возвращает их число.
+
+    При ошибках проверки бросает ValueError со списком ошибок по экспериментам.
+    """
+    experiments = parse_experiments(text, fmt, catalog)
+    problems = validate_experiments(experiments)
+    if problems:
+        lines = [f"{name}: {error}" for name, errors in problems.items() for error in errors]
+        raise ValueError("Эксперименты не прошли проверку:\n" + "\n".join(lines))
+    if dry_run:
+        return len(experiments)
+    return save_experiments(experiments, overwrite=overwrite)
+
+
+def export_experiments(experiments: list, fmt: str) -> str:
+    """Текст файла с экспериментами в формате fmt (обратно читается parse_experiments)"""
+    if fmt == "yaml":
+        return yaml.dump({"experiments": experiments}, sort_keys=False, allow_unicode=True)
+    if fmt == "json":
+        return json.dumps({"experiments": experiments}, ensure_ascii=False, indent=2)
+    if fmt != "csv":
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for experiment in experiments:
+        writer.writerow({
+            key: json.dumps(value, ensure_ascii=False) if key in NESTED_FIELDS else value
+            for key, value in experiment.items() if value is not None
+        })
+    return out.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Массовый импорт и экспорт экспериментов (CSV, YAML, JSON)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Проверить и сохранить эксперименты из файла одной пачкой")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--overwrite", action="store_true", help="Перезаписать существующие эксперименты")
+    import_parser.add_argument("--dry-run", action="store_true", help="Только проверка, без сохранения")
+    export_parser = subparsers.add_parser("export", help="Выгрузить эксперименты конфига в файл")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--experiment", action="append", help="Выгрузить только указанные эксперименты")
+    args = parser.parse_args(argv)
+
+    fmt = detect_format(args.path)
+    if args.command == "export":
+        experiments = [
+            e for e in load_config().get("experiments", [])
+            if not args.experiment or e["experiment_name"] in args.experiment
+        ]
+        with open(args.path, "w", encoding="utf-8", newline="") as f:
+            f.write(export_experiments(experiments, fmt))
+        print(f"Выгружено экспериментов: {len(experiments)} в {args.path}")
+        return 0
+
+    with open(args.path, "r", encoding="utf-8-sig") as f:
+        text = f.read()
+    try:
+        saved = import_experiments(text, fmt, overwrite=args.overwrite, dry_run=args.dry_run)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    except ConfigConflictError as e:
+        print(f"❌ Эксперименты уже существуют (используй --overwrite): {e}")
+        return 1
+    print(f"{'Проверено' if args.dry_run else 'Сохранено'} экспериментов: {saved}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,510 @@
+"""Разбор выражений метрик (агрегации ClickHouse с -If комбинаторами) в AST.
+
+Поддерживается подмножество синтаксиса ClickHouse, которое встречается в метриках
+и фильтрах: вызовы функций (в том числе параметрические quantile(0.9)(x)),
+арифметика, сравнения, AND/OR/NOT, IN, LIKE, BETWEEN, IS [NOT] NULL, CASE,
+кортежи и массивы. Узлы AST неизменяемы и хэшируемы: одинаковые подвыражения
+равны, а to_sql даёт для них одинаковый канонический текст.
+
+Разбор и печать мемоизированы по строке/узлу, поэтому повторная генерация SQL
+для большого конфига не разбирает одни и те же выражения заново.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+import re
+
+# Агрегатные функции (в нижнем регистре), к которым применим комбинатор -If
+AGGREGATE_FUNCTIONS = {
+    "sum", "avg", "max", "min", "count", "any", "anylast", "uniq", "uniqexact", "uniqcombined",
+    "uniqhll12", "median", "quantile", "quantiles", "quantileexact", "quantiletdigest",
+    "varpop", "varsamp", "stddevpop", "stddevsamp", "argmin", "argmax", "grouparray",
+    "groupuniqarray", "sumwithoverflow",
+}
+
+
+# Стандартные SQL-агрегаты, имена которых ClickHouse принимает в любом регистре:
+# приводим их к нижнему, чтобы SUM(gmv) и sum(gmv) давали один узел
+_CASE_INSENSITIVE_AGGREGATES = {"sum", "avg", "min", "max", "count"}
+
+
+def _canonical_function_name(name: str) -> str:
+    lowered = name.lower()
+    if lowered in _CASE_INSENSITIVE_AGGREGATES:
+        return lowered
+    if lowered.endswith("if") and lowered[:-2] in _CASE_INSENSITIVE_AGGREGATES:
+        return lowered[:-2] + "If"
+    return name
+
+
+class ExpressionSyntaxError(ValueError):
+    """Выражение не разбирается поддерживаемой грамматикой"""
+
+
+# --- Узлы AST
+
+@dataclass(frozen=True)
+class Literal:
+    value: str  # SQL-текст: число, строка в кавычках, NULL, true/false
+
+
+@dataclass(frozen=True)
+class Identifier:
+    name: str
+
+
+@dataclass(frozen=True)
+class Call:
+    name: str
+    args: tuple
+    params: tuple = None  # параметры параметрической функции: quantile(0.9)(x)
+
+
+@dataclass(frozen=True)
+class Unary:
+    op: str  # "-" или "NOT"
+    operand: object
+
+
+@dataclass(frozen=True)
+class Binary:
+    op: str
+    left: object
+    right: object
+
+
+@dataclass(frozen=True)
+class Between:
+    operand: object
+    low: object
+    high: object
+    negated: bool = False
+
+
+@dataclass(frozen=True)
+class IsNull:
+    operand: object
+    negated: bool = False
+
+
+@dataclass(frozen=True)
+class Tuple:
+    items: tuple
+
+
+@dataclass(frozen=True)
+class Array:
+    items: tuple
+
+
+@dataclass(frozen=True)
+class Case:
+    operand: object
+    whens: tuple  # ((условие, результат), ...)
+    default: object = None
+
+
+@dataclass(frozen=True)
+class Raw:
+    """Непрозрачный кусок SQL, который не удалось разобрать; печатается в скобках"""
+    sql: str
+
+
+# --- Лексер
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>'(?:[^'\\]|\\.|'')*')
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][\w]*(?:\.\w+)*|`[^`]+`)
+  | (?P<op><=|>=|!=|<>|==|\|\||->|[=<>+\-*/%(),\[\]])
+""", re.VERBOSE)
+
+_KEYWORDS = {"AND", "OR", "NOT", "IN", "LIKE", "ILIKE", "BETWEEN", "IS", "NULL", "CASE", "WHEN", "THEN",
+             "ELSE", "END"}
+
+
+def _tokenize(text: str) -> list:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if not m:
+            raise ExpressionSyntaxError(f"Неожиданный символ {text[pos]!r} в позиции {pos}: {text}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        value = m.group()
+        if kind == "name" and value.upper() in _KEYWORDS:
+            tokens.append(("kw", value.upper()))
+        else:
+            tokens.append((kind, value))
+    tokens.append(("end", ""))
+    return tokens
+
+
+# --- Парсер (рекурсивный спуск по уровням приоритета ClickHouse)
+
+_COMPARISON_OPS = {"=", "==", "!=", "<>", "<", ">", "<=", ">="}
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset: int = 0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, kind: str, value: str = None) -> bool:
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind: str, value: str = None):
+        if not self.accept(kind, value):
+            raise ExpressionSyntaxError(f"Ожидалось {value or kind}, получено {self.peek()[1]!r}: {self.text}")
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek()[0] != "end":
+            raise ExpressionSyntaxError(f"Лишний текст после выражения: {self.peek()[1]!r}: {self.text}")
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept("kw", "OR"):
+            node = Binary("OR", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept("kw", "AND"):
+            node = Binary("AND", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept("kw", "NOT"):
+            return Unary("NOT", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_additive()
+        token = self.peek()
+        if token[0] == "op" and token[1] in _COMPARISON_OPS:
+            self.take()
+            return Binary("=" if token[1] == "==" else token[1], node, self.parse_additive())
+        negated = False
+        if token == ("kw", "NOT") and self.peek(1)[0] == "kw" and self.peek(1)[1] in ("IN", "LIKE", "ILIKE", "BETWEEN"):
+            self.take()
+            negated = True
+            token = self.peek()
+        if token[0] == "kw" and token[1] in ("IN", "LIKE", "ILIKE"):
+            self.take()
+            op = ("NOT " if negated else "") + token[1]
+            if token[1] == "IN" and self.accept("op", "("):
+                # Список IN всегда кортеж: (a, b) IN ((1, 2)) не равно (a, b) IN (1, 2)
+                return Binary(op, node, Tuple(self.parse_list(")")))
+            return Binary(op, node, self.parse_additive())
+        if token == ("kw", "BETWEEN"):
+            self.take()
+            low = self.parse_additive()
+            self.expect("kw", "AND")
+            return Between(node, low, self.parse_additive(), negated)
+        if token == ("kw", "IS"):
+            self.take()
+            is_negated = self.accept("kw", "NOT")
+            self.expect("kw", "NULL")
+            return IsNull(node, is_negated)
+        if negated:
+            raise ExpressionSyntaxError(f"Неожиданный NOT: {self.text}")
+        return node
+
+    def parse_additive(self):
+        node = self.parse_multiplicative()
+        while self.peek()[0] == "op" and self.peek()[1] in ("+", "-", "||"):
+            node = Binary(self.take()[1], node, self.parse_multiplicative())
+        return node
+
+    def parse_multiplicative(self):
+        node = self.parse_unary()
+        while self.peek()[0] == "op" and self.peek()[1] in ("*", "/", "%"):
+            node = Binary(self.take()[1], node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.accept("op", "-"):
+            operand = self.parse_unary()
+            if isinstance(operand, Literal) and re.match(r"^[\d.]", operand.value):
+                return Literal("-" + operand.value)
+            return Unary("-", operand)
+        return self.parse_primary()
+
+    def parse_list(self, closing: str) -> tuple:
+        items = []
+        if not self.accept("op", closing):
+            items.append(self.parse_or())
+            while self.accept("op", ","):
+                items.append(self.parse_or())
+            self.expect("op", closing)
+        return tuple(items)
+
+    def parse_primary(self):
+        kind, value = self.take()
+        if kind in ("number", "string"):
+            return Literal(value)
+        if kind == "kw" and value == "NULL":
+            return Literal("NULL")
+        if kind == "kw" and value == "CASE":
+            return self.parse_case()
+        if kind == "name":
+            if self.accept("op", "("):
+                value = _canonical_function_name(value)
+                args = self.parse_list(")")
+                if self.accept("op", "("):
+                    # Параметрическая функция: name(params)(args)
+                    return Call(value, self.parse_list(")"), args)
+                return Call(value, args)
+            if self.peek() == ("op", "->"):
+                raise ExpressionSyntaxError(f"Лямбда-выражения не поддерживаются: {self.text}")
+            return Identifier(value)
+        if kind == "op" and value == "(":
+            items = self.parse_list(")")
+            if len(items) == 1:
+                return items[0]
+            return Tuple(items)
+        if kind == "op" and value == "[":
+            return Array(self.parse_list("]"))
+        raise ExpressionSyntaxError(f"Неожиданный токен {value!r}: {self.text}")
+
+    def parse_case(self):
+        operand = None
+        if self.peek() != ("kw", "WHEN"):
+            operand = self.parse_or()
+        whens = []
+        while self.accept("kw", "WHEN"):
+            condition = self.parse_or()
+            self.expect("kw", "THEN")
+            whens.append((condition, self.parse_or()))
+        if not whens:
+            raise ExpressionSyntaxError(f"CASE без WHEN: {self.text}")
+        default = self.parse_or() if self.accept("kw", "ELSE") else None
+        self.expect("kw", "END")
+        return Case(operand, tuple(whens), default)
+
+
+@lru_cache(maxsize=4096)
+def _parse_cached(text: str):
+    try:
+        return _Parser(text).parse()
+    except ExpressionSyntaxError as e:
+        return e
+
+
+def parse(text: str):
+    """AST выражения; ExpressionSyntaxError, если выражение не разбирается"""
+    result = _parse_cached(text.strip())
+    if isinstance(result, ExpressionSyntaxError):
+        raise result
+    return result
+
+
+def try_parse(text: str):
+    """AST выражения или None, если выражение не разбирается"""
+    result = _parse_cached(text.strip())
+    return None if isinstance(result, ExpressionSyntaxError) else result
+
+
+# --- Печать обратно в SQL
+
+_PRECEDENCE = {
+    "OR": 1, "AND": 2, "NOT": 3,
+    "=": 4, "!=": 4, "<>": 4, "<": 4, ">": 4, "<=": 4, ">=": 4,
+    "IN": 4, "NOT IN": 4, "LIKE": 4, "NOT LIKE": 4, "ILIKE": 4, "NOT ILIKE": 4,
+    "+": 5, "-": 5, "||": 5, "*": 6, "/": 6, "%": 6,
+}
+_ASSOCIATIVE = {"AND", "OR"}
+_UNARY_MINUS = 7
+_PRIMARY = 8
+
+
+def _precedence(node) -> int:
+    if isinstance(node, Binary):
+        return _PRECEDENCE[node.op]
+    if isinstance(node, Unary):
+        return _PRECEDENCE["NOT"] if node.op == "NOT" else _UNARY_MINUS
+    if isinstance(node, (Between, IsNull)):
+        return 4
+    return _PRIMARY
+
+
+def _wrap(node, min_precedence: int) -> str:
+    sql = to_sql(node)
+    return f"({sql})" if _precedence(node) < min_precedence else sql
+
+
+@lru_cache(maxsize=8192)
+def to_sql(node) -> str:
+    """Канонический SQL-текст узла: одинаковые деревья печатаются одинаково"""
+    if isinstance(node, Literal):
+        return node.value
+    if isinstance(node, Identifier):
+        return node.name
+    if isinstance(node, Raw):
+        return f"({node.sql})"
+    if isinstance(node, Call):
+        args = ", ".join(to_sql(a) for a in node.args)
+        if node.params is not None:
+            return f"{node.name}({', '.join(to_sql(p) for p in node.params)})({args})"
+        return f"{node.name}({args})"
+    if isinstance(node, Unary):
+        if node.op == "NOT":
+            return f"NOT {_wrap(node.operand, _PRECEDENCE['NOT'])}"
+        return f"-{_wrap(node.operand, _UNARY_MINUS)}"
+    if isinstance(node, Binary):
+        precedence = _PRECEDENCE[node.op]
+        left = _wrap(node.left, precedence + (1 if precedence == 4 else 0))
+        right = _wrap(node.right, precedence if node.op in _ASSOCIATIVE else precedence + 1)
+        if node.op.endswith("IN") and not isinstance(node.right, (Tuple, Array, Raw)):
+            # x IN ('a') — скобки у списка из одного элемента сохраняем
+            right = f"({to_sql(node.right)})"
+        return f"{left} {node.op} {right}"
+    if isinstance(node, Between):
+        keyword = "NOT BETWEEN" if node.negated else "BETWEEN"
+        return f"{_wrap(node.operand, 5)} {keyword} {_wrap(node.low, 5)} AND {_wrap(node.high, 5)}"
+    if isinstance(node, IsNull):
+        return f"{_wrap(node.operand, 5)} IS {'NOT ' if node.negated else ''}NULL"
+    if isinstance(node, Tuple):
+        return "(" + ", ".join(to_sql(i) for i in node.items) + ")"
+    if isinstance(node, Array):
+        return "[" + ", ".join(to_sql(i) for i in node.items) + "]"
+    if isinstance(node, Case):
+        parts = ["CASE"]
+        if node.operand is not None:
+            parts.append(to_sql(node.operand))
+        for condition, result in node.whens:
+            parts.append(f"WHEN {to_sql(condition)} THEN {to_sql(result)}")
+        if node.default is not None:
+            parts.append(f"ELSE {to_sql(node.default)}")
+        parts.append("END")
+        return " ".join(parts)
+    raise TypeError(f"Неизвестный узел AST: {node!r}")
+
+
+# --- Работа с агрегатами
+
+def aggregate_base_name(name: str):
+    """Имя агрегата без комбинатора -If в нижнем регистре; None, если это не агрегат"""
+    lowered = name.lower()
+    if lowered in AGGREGATE_FUNCTIONS:
+        return lowered
+    if lowered.endswith("if") and lowered[:-2] in AGGREGATE_FUNCTIONS:
+        return lowered[:-2]
+    return None
+
+
+def is_aggregate_call(node) -> bool:
+    return isinstance(node, Call) and aggregate_base_name(node.name) is not None
+
+
+def is_if_aggregate(node) -> bool:
+    """Вызов агрегата с комбинатором -If: sumIf(x, cond), countIf(cond)"""
+    return is_aggregate_call(node) and node.name.lower().endswith("if") \
+        and node.name.lower() not in AGGREGATE_FUNCTIONS
+
+
+def condition_node(condition: str):
+    """AST условия; неразбираемое условие сохраняется как есть (Raw)"""
+    return try_parse(condition) or Raw(condition)
+
+
+def add_condition(call: Call, condition) -> Call:
+    """Добавляет условие к агрегату через -If: sum(x) -> sumIf(x, cond), sumIf(x, c) -> sumIf(x, c AND cond)"""
+    if is_if_aggregate(call):
+        if not call.args:
+            return Call(call.name, (condition,), call.params)
+        *args, existing = call.args
+        if call.name.lower() == "countif" and len(call.args) == 1:
+            args, existing = [], call.args[0]
+        return Call(call.name, tuple(args) + (Binary("AND", existing, condition),), call.params)
+    if call.name.lower() == "count" and not call.args:
+        return Call(call.name + "If", (condition,), call.params)
+    return Call(call.name + "If", call.args + (condition,), call.params)
+
+
+def aggregate_calls(node) -> list:
+    """Агрегатные вызовы верхнего уровня (внутрь аргументов агрегатов не заходим)"""
+    if is_aggregate_call(node):
+        return [node]
+    found = []
+    for child in _children(node):
+        found += aggregate_calls(child)
+    return found
+
+
+def identifiers(node) -> set:
+    """Имена всех колонок, на которые ссылается выражение"""
+    if isinstance(node, Identifier):
+        return {node.name}
+    names = set()
+    for child in _children(node):
+        names |= identifiers(child)
+    return names
+
+
+def _children(node) -> list:
+    if isinstance(node, Call):
+        return list(node.args) + list(node.params or ())
+    if isinstance(node, Unary):
+        return [node.operand]
+    if isinstance(node, Binary):
+        return [node.left, node.right]
+    if isinstance(node, Between):
+        return [node.operand, node.low, node.high]
+    if isinstance(node, IsNull):
+        return [node.operand]
+    if isinstance(node, (Tuple, Array)):
+        return list(node.items)
+    if isinstance(node, Case):
+        children = [] if node.operand is None else [node.operand]
+        for condition, result in node.whens:
+            children += [condition, result]
+        return children + ([] if node.default is None else [node.default])
+    return []
+
+
+def replace_subtrees(node, replacements: dict):
+    """Копия дерева, где поддеревья-ключи replacements заменены значениями"""
+    if node in replacements:
+        return replacements[node]
+    if isinstance(node, Call):
+        return Call(node.name, tuple(replace_subtrees(a, replacements) for a in node.args),
+                    None if node.params is None else tuple(replace_subtrees(p, replacements) for p in node.params))
+    if isinstance(node, Unary):
+        return Unary(node.op, replace_subtrees(node.operand, replacements))
+    if isinstance(node, Binary):
+        return Binary(node.op, replace_subtrees(node.left, replacements), replace_subtrees(node.right, replacements))
+    if isinstance(node, Between):
+        return Between(replace_subtrees(node.operand, replacements), replace_subtrees(node.low, replacements),
+                       replace_subtrees(node.high, replacements), node.negated)
+    if isinstance(node, IsNull):
+        return IsNull(replace_subtrees(node.operand, replacements), node.negated)
+    if isinstance(node, Tuple):
+        return Tuple(tuple(replace_subtrees(i, replacements) for i in node.items))
+    if isinstance(node, Array):
+        return Array(tuple(replace_subtrees(i, replacements) for i in node.items))
+    if isinstance(node, Case):
+        return Case(
+            None if node.operand is None else replace_subtrees(node.operand, replacements),
+            tuple((replace_subtrees(c, replacements), replace_subtrees(r, replacements)) for c, r in node.whens),
+            None if node.default is None else replace_subtrees(node.default, replacements),
+        )
+    return node
@@ -0,0 +1,265 @@
+"""Материализованные предагрегаты для часто используемых метрик.
+
+По каталогу пресетов строится таблица AggregatingMergeTree с состояниями агрегатов
+(-State) на пользователя и день и материализованное представление, которое
+заполняет её из SOURCE_TABLE. Метрики, все агрегаты которых есть в таблице,
+считаются по ней через -Merge вместо сырых дневных строк:
+
+    view = build_preaggregated_view(load_presets(), "ft_pa_prod.delivery_abtest_preagg")
+    generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, preaggregated=view)
+
+Колонки агрегатов называются по хэшу канонического выражения, поэтому добавление
+пресетов не переименовывает существующие колонки (новые добавляются через ALTER).
+Типы колонок-измерений (event_date, magnit_id, ab) берутся из исходной таблицы
+(source_dimension_types) или передаются явно — DDL без них не строится. Исходные
+колонки считаются не-Nullable; числовые аргументы приводятся к Float64, аргументы
+uniq — к String.
+
+Пример:
+    python preaggregation.py --table ft_pa_prod.delivery_abtest_preagg > preagg.sql
+    python preaggregation.py --table ft_pa_prod.delivery_abtest_preagg \
+        --dimension-types '{"event_date": "Date", "magnit_id": "UInt64", "ab": "Array(String)"}' > preagg.sql
+"""
+import argparse
+import hashlib
+import json
+
+from config_store import load_presets
+from expression_parser import (
+    Call,
+    Identifier,
+    aggregate_base_name,
+    aggregate_calls,
+    is_if_aggregate,
+    replace_subtrees,
+    to_sql,
+    try_parse,
+)
+from sql_generator import (
+    SOURCE_TABLE,
+    build_base_where,
+    build_group_label,
+    build_metric_expressions,
+    fold_having,
+    fold_metric_filters,
+)
+
+# Колонки, по которым агрегирует представление: день, пользователь и его группы
+DIMENSIONS = ("event_date", "magnit_id", "ab")
+
+# Агрегаты, которые раскладываются на состояния по дням и сливаются через -Merge
+MERGEABLE_AGGREGATES = {"sum", "avg", "min", "max", "count", "uniq", "uniqexact"}
+UNIQ_AGGREGATES = {"uniq", "uniqexact"}
+
+
+def _column_name(call: Call) -> str:
+    return "a_" + hashlib.sha1(to_sql(call).encode("utf-8")).hexdigest()[:12]
+
+
+def _state_arguments(call: Call):
+    """Аргументы -State вызова с приведением типов и типы для AggregateFunction"""
+    base = aggregate_base_name(call.name)
+    args = list(call.args)
+    condition = args.pop() if is_if_aggregate(call) else None
+    cast, type_name = ("toString", "String") if base in UNIQ_AGGREGATES else ("toFloat64", "Float64")
+    state_args = [f"{cast}({to_sql(a)})" for a in args]
+    types = [type_name] * len(args)
+    if condition is not None:
+        state_args.append(f"toUInt8({to_sql(condition)})")
+        types.append("UInt8")
+    return state_args, types
+
+
+def _mergeable(call: Call) -> bool:
+    if call.params is not None or aggregate_base_name(call.name) not in MERGEABLE_AGGREGATES:
+        return False
+    # Агрегаты внутри аргументов (sum(max(x))) по дням не раскладываются
+    return not any(aggregate_calls(a) for a in call.args)
+
+
+def _metric_aggregates(m: dict):
+    """Агрегаты метрики после встраивания её фильтров; None, если метрику нельзя предагрегировать"""
+    folded = fold_metric_filters(m)
+    if folded is None:
+        return None
+    calls = []
+    for expr in folded:
+        node = try_parse(expr)
+        if node is None:
+            return None
+        calls += aggregate_calls(node)
+    if not all(_mergeable(c) for c in calls):
+        return None
+    return calls
+
+
+def _having_expressions(experiment: dict, m: dict):
+    """HAVING эксперимента для метрики по строкам под её фильтрами; None, если его нельзя выразить через -If"""
+    _, _, extra_where = build_metric_expressions(m)
+    return fold_having(experiment, extra_where)
+
+
+def source_dimension_types(execute, source_table: str = SOURCE_TABLE) -> dict:
+    """Типы колонок DIMENSIONS в исходной таблице по DESCRIBE TABLE; execute(sql) -> строки-словари"""
+    types = {row["name"]: row["type"] for row in execute(f"DESCRIBE TABLE {source_table}")}
+    missing = [name for name in DIMENSIONS if name not in types]
+    if missing:
+        raise ValueError(f"В {source_table} нет колонок: {', '.join(missing)}")
+    return {name: types[name] for name in DIMENSIONS}
+
+
+class PreaggregatedView:
+    """Описание таблицы предагрегатов: имя, источник, агрегаты (AST вызова -> колонка) и типы измерений.
+
+    dimension_types — {колонка: тип} для DIMENSIONS, как в исходной таблице; нужен только для DDL.
+    """
+
+    def __init__(self, table: str, aggregates: dict, source_table: str = SOURCE_TABLE, dimension_types: dict = None):
+        self.table = table
+        self.source_table = source_table
+        self.aggregates = aggregates
+        self.dimension_types = dimension_types
+
+    def covers(self, experiment: dict, m: dict) -> bool:
+        """Можно ли посчитать метрику эксперимента по таблице предагрегатов.
+
+        Глобальные WHERE фильтры ссылаются на колонки, которых в таблице нет, поэтому
+        такие эксперименты считаются по исходной таблице. HAVING допустим, если его
+        агрегаты тоже есть в таблице.
+        """
+        if experiment.get("filters", {}).get("where"):
+            return False
+        calls = _metric_aggregates(m)
+        having = _having_expressions(experiment, m)
+        if calls is None or having is None:
+            return False
+        for expr in having:
+            node = try_parse(expr)
+            if node is None:
+                return False
+            calls = calls + aggregate_calls(node)
+        return all(c in self.aggregates for c in calls)
+
+    def _merge(self, expr: str) -> str:
+        node = try_parse(expr)
+        replacements = {
+            c: Call(c.name + "Merge", (Identifier(self.aggregates[c]),)) for c in aggregate_calls(node)
+        }
+        return to_sql(replace_subtrees(node, replacements))
+
+    def metric_query(self, experiment: dict, m: dict):
+        """Поюзерный запрос метрики по таблице предагрегатов (-Merge); None, если метрика не покрыта.
+
+        Схема результата та же, что у build_metric_query.
+        """
+        if not self.covers(experiment, m):
+            return None
+        numerator, denominator, presence = fold_metric_filters(m)
+        having_conditions = [] if presence == "1" else [self._merge(presence)]
+        having_conditions += [self._merge(expr) for expr in _having_expressions(experiment, m)]
+
+        select_clause = ",\n    ".join([
+            f"'{experiment['experiment_name']}' AS exp_name",
+            "magnit_id",
+            build_group_label(experiment),
+            f"'{m['type']}' AS metric_type",
+            f"'{m['name']}' AS metric_name",
+            f"{self._merge(numerator)} AS numerator",
+            f"{self._merge(denominator)} AS denominator"
+        ])
+        query = (
+            f"SELECT\n    {select_clause}\n"
+            f"FROM {self.table}\n"
+            f"WHERE {' AND '.join(build_base_where(experiment))}\n"
+            f"GROUP BY magnit_id, group_label\n"
+            + (f"HAVING {' AND '.join(having_conditions)}" if having_conditions else "")
+        )
+        return query.strip()
+
+    def _state_columns(self) -> list:
+        columns = []
+        for call, column in self.aggregates.items():
+            state_args, types = _state_arguments(call)
+            state_name = call.name + "State"
+            columns.append((column, f"AggregateFunction({', '.join([call.name] + types)})",
+                            f"{state_name}({', '.join(state_args)})"))
+        return columns
+
+    def _select_sql(self) -> str:
+        fields = list(DIMENSIONS) + [f"{state} AS {column}" for column, _, state in self._state_columns()]
+        return (
+            f"SELECT\n    " + ",\n    ".join(fields) + "\n"
+            f"FROM {self.source_table}\n"
+            f"GROUP BY {', '.join(DIMENSIONS)}"
+        )
+
+    def ddl(self) -> list:
+        """Операторы CREATE TABLE и CREATE MATERIALIZED VIEW"""
+        if not self.dimension_types:
+            raise ValueError("Для DDL нужны типы колонок исходной таблицы: dimension_types или source_dimension_types")
+        missing = [name for name in DIMENSIONS if name not in self.dimension_types]
+        if missing:
+            raise ValueError(f"Не заданы типы колонок: {', '.join(missing)}")
+        nullable = [name for name in DIMENSIONS if self.dimension_types[name].startswith("Nullable(")]
+        if nullable:
+            raise ValueError(f"Колонки ключа сортировки не могут быть Nullable: {', '.join(nullable)}")
+        columns = [f"{name} {self.dimension_types[name]}" for name in DIMENSIONS]
+        columns += [f"{column} {type_name}" for column, type_name, _ in self._state_columns()]
+        create_table = (
+            f"CREATE TABLE IF NOT EXISTS {self.table}\n(\n    " + ",\n    ".join(columns) + "\n)\n"
+            f"ENGINE = AggregatingMergeTree\n"
+            f"PARTITION BY toYYYYMM(event_date)\n"
+            f"ORDER BY ({', '.join(DIMENSIONS)})"
+        )
+        create_view = f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.table}_mv TO {self.table} AS\n{self._select_sql()}"
+        return [create_table, create_view]
+
+    def backfill_sql(self, start_date: str, end_date: str) -> str:
+        """INSERT истории за период: представление видит только новые вставки в источник"""
+        select = self._select_sql().replace(
+            f"FROM {self.source_table}\n",
+            f"FROM {self.source_table}\nWHERE event_date BETWEEN '{start_date}' AND '{end_date}'\n",
+        )
+        return f"INSERT INTO {self.table}\n{select}"
+
+
+def build_preaggregated_view(presets: list, table: str, source_table: str = SOURCE_TABLE,
+                             dimension_types: dict = None) -> PreaggregatedView:
+    """Таблица предагрегатов для всех агрегатов пресетов, которые раскладываются по дням.
+
+    dimension_types нужны для DDL (см. source_dimension_types); для маршрутизации запросов — нет.
+    """
+    aggregates = {}
+    for preset in presets:
+        for call in _metric_aggregates(preset) or []:
+            aggregates.setdefault(call, _column_name(call))
+    return PreaggregatedView(table, aggregates, source_table, dimension_types)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DDL таблицы предагрегатов по каталогу пресетов")
+    parser.add_argument("--table", required=True, help="Имя таблицы предагрегатов")
+    parser.add_argument("--source-table", default=SOURCE_TABLE)
+    parser.add_argument("--backfill-from", help="Дата начала INSERT истории (YYYY-MM-DD)")
+    parser.add_argument("--backfill-to", help="Дата окончания INSERT истории (YYYY-MM-DD)")
+    parser.add_argument("--dimension-types",
+                        help="Типы колонок JSON-объектом, например "
+                             '\'{"event_date": "Date", "magnit_id": "UInt64", "ab": "Array(String)"}\'; '
+                             "по умолчанию — DESCRIBE TABLE исходной таблицы в ClickHouse")
+    args = parser.parse_args(argv)
+
+    if args.dimension_types:
+        dimension_types = json.loads(args.dimension_types)
+    else:
+        from batch_runner import ClickHouseExecutor
+        dimension_types = source_dimension_types(ClickHouseExecutor(), args.source_table)
+    view = build_preaggregated_view(load_presets(), args.table, args.source_table, dimension_types)
+    statements = view.ddl()
+    if args.backfill_from and args.backfill_to:
+        statements.append(view.backfill_sql(args.backfill_from, args.backfill_to))
+    print(";\n\n".join(statements) + ";")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+"""Лёгкие таймеры и счётчики для поиска узких мест: конфиг, S3, генерация SQL, запросы.
+
+Включается переменной окружения AB_PROFILING=1 или enable(). В выключенном
+состоянии timer() возвращает общий пустой контекст, а timed и count сводятся к
+одной проверке флага, так что инструментирование можно оставлять в горячих путях.
+
+- timer(name) / @timed(name) — число вызовов, суммарное и максимальное время;
+- count(name, value) — счётчики (вызовы S3, байты, попадания в кэш);
+- log_query(...) — журнал времени выполнения запросов (последние QUERY_LOG_SIZE).
+
+Снимок выгружается в JSON (to_json) или в текстовом формате Prometheus
+(to_prometheus, write_metrics — файл для textfile collector).
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+QUERY_LOG_SIZE = 1000
+METRIC_PREFIX = "ab"
+
+_enabled = os.getenv("AB_PROFILING", "") not in ("", "0", "false", "False")
+_lock = threading.Lock()
+# name -> [calls, total_seconds, max_seconds]
+_timers = {}
+_counters = {}
+_query_log = deque(maxlen=QUERY_LOG_SIZE)
+_disabled_timer = contextlib.nullcontext()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _query_log.clear()
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+
+@contextlib.contextmanager
+def _timer(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timer(name: str):
+    """Контекстный менеджер: время блока копится под именем name"""
+    return _timer(name) if _enabled else _disabled_timer
+
+
+def timed(name: str = None):
+    """Декоратор: время каждого вызова функции (по умолчанию под её именем)"""
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(label, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def log_query(experiment_name: str, query_name: str, seconds: float, rows: int = None, status: str = "ok"):
+    if not _enabled:
+        return
+    with _lock:
+        _query_log.append({
+            "experiment_name": experiment_name,
+            "query_name": query_name,
+            "seconds": seconds,
+            "rows": rows,
+            "status": status,
+            "finished_at": time.time(),
+        })
+
+
+def snapshot() -> dict:
+    """Текущие таймеры, счётчики и журнал запросов"""
+    with _lock:
+        return {
+            "timers": {
+                name: {"calls": calls, "seconds": total, "max_seconds": longest}
+                for name, (calls, total, longest) in _timers.items()
+            },
+            "counters": dict(_counters),
+            "queries": list(_query_log),
+        }
+
+
+def to_json(data: dict = None) -> str:
+    return json.dumps(snapshot() if data is None else data, ensure_ascii=False, indent=2)
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(data: dict = None) -> str:
+    """Снимок в текстовом формате Prometheus; журнал запросов сворачивается по (эксперимент, запрос)"""
+    data = snapshot() if data is None else data
+    lines = []
+
+    def family(metric, metric_type, help_text, samples):
+        if not samples:
+            return
+        lines.append(f"# HELP {METRIC_PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{metric} {metric_type}")
+        for labels, value in samples:
+            labels_text = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+            lines.append(f"{METRIC_PREFIX}_{metric}{{{labels_text}}} {value!r}")
+
+    timers = sorted(data["timers"].items())
+    family("timer_calls_total", "counter", "Число вызовов участка кода",
+           [({"name": n}, t["calls"]) for n, t in timers])
+    family("timer_seconds_total", "counter", "Суммарное время участка кода, секунды",
+           [({"name": n}, float(t["seconds"])) for n, t in timers])
+    family("timer_seconds_max", "gauge", "Максимальное время одного вызова, секунды",
+           [({"name": n}, float(t["max_seconds"])) for n, t in timers])
+    family("counter_total", "counter", "Счётчики (вызовы S3, байты, попадания в кэш)",
+           [({"name": n}, v) for n, v in sorted(data["counters"].items())])
+
+    queries = {}
+    for q in data["queries"]:
+        key = (q["experiment_name"], q["query_name"], q["status"])
+        calls, total = queries.get(key, (0, 0.0))
+        queries[key] = (calls + 1, total + q["seconds"])
+    keys = sorted(queries)
+    family("query_runs_total", "counter", "Выполнения запросов",
+           [({"experiment": e, "query": n, "status": s}, queries[(e, n, s)][0]) for e, n, s in keys])
+    family("query_seconds_total", "counter", "Суммарное время выполнения запросов, секунды",
+           [({"experiment": e, "query": n, "status": s}, float(queries[(e, n, s)][1])) for e, n, s in keys])
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path: str):
+    """Пишет снимок в файл: JSON для *.json, иначе формат Prometheus (атомарная замена файла)"""
+    text = to_json() if path.endswith(".json") else to_prometheus()
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,351 @@
+"""Инкрементальный дневной кэш результатов по экспериментам.
+
+Исходная таблица дневная, и прошедшие дни не меняются, поэтому для каждой метрики
+хранятся частичные агрегаты по (день, группа): суммы для sum/count/sumIf/countIf,
+состояния uniqHLL12State для uniq/uniqIf и точное число пользователей, впервые
+активных в этот день (с начала эксперимента). При повторном запуске запрашиваются
+только отсутствующие дни, а итог собирается слиянием: суммы складываются,
+состояния сливаются в ClickHouse через uniqHLL12Merge запросом без чтения таблиц
+(см. merge_uniq_states).
+
+Число пользователей — знаменатель basic метрик — точное, как при полном проходе.
+Числители uniq метрик — оценки HLL с погрешностью порядка 1-2%.
+
+Кэш даёт точечные оценки по группам (среднее на пользователя для basic, отношение
+сумм для ratio). Дисперсии по дневным агрегатам не восстанавливаются — для
+доверительных интервалов нужны запросы с output="aggregate".
+"""
+import hashlib
+import json
+import os
+from datetime import date, timedelta
+
+from expression_parser import to_sql, try_parse
+from sql_generator import (
+    build_base_where,
+    build_group_label,
+    build_metric_expressions,
+    experiment_arms,
+    sample_fraction,
+    split_aggregate_call,
+)
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Формат хранимых дней; входит в ключ, чтобы записи старого формата не читались
+CACHE_FORMAT = 3
+UNIQ_STATE_TYPE = "AggregateFunction(uniqHLL12, UInt64)"
+# Состояния передаются в запрос слияния литералами: держимся ниже max_query_size (256 КиБ)
+MERGE_QUERY_BYTES = 200_000
+
+ADDITIVE_AGGREGATIONS = {"sum", "count", "sumif", "countif"}
+UNIQ_AGGREGATIONS = {"uniq", "uniqif", "uniqexact", "uniqexactif"}
+
+
+def metric_cache_key(experiment: dict, metric: dict, source_table: str) -> str:
+    """Хэш нормализованного определения метрики, групп и глобальных фильтров.
+
+    Дата окончания и название метрики в ключ не входят: один и тот же расчёт
+    переиспользуется при продлении эксперимента и переименовании метрики. Дата
+    начала входит — от неё отсчитывается первый день активности пользователя.
+    """
+    definition = {k: v for k, v in metric.items() if k not in ("name", "bootstrap", "covariate")}
+    definition["where_filters"] = sorted(
+        (json.dumps(f, sort_keys=True, ensure_ascii=False) for f in metric.get("where_filters", []))
+    )
+    payload = {
+        "metric": definition,
+        "control_group_id": experiment.get("control_group_id"),
+        "test_group_id": experiment.get("test_group_id"),
+        "where": sorted(
+            json.dumps(f, sort_keys=True, ensure_ascii=False)
+            for f in experiment.get("filters", {}).get("where", [])
+        ),
+        "source_table": source_table,
+        "start_date": experiment["start_date"],
+        "format": CACHE_FORMAT,
+    }
+    if experiment.get("arms"):
+        payload["arms"] = experiment_arms(experiment)
+    if sample_fraction(experiment) != 1:
+        # Ключ полного прохода не меняется: выборка добавляется, только если она задана
+        payload["sample"] = sample_fraction(experiment)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _metric_parts(expr: str):
+    """Описание частичного агрегата для выражения числителя/знаменателя"""
+    if expr == "1":
+        return {"kind": "users"}
+    call = split_aggregate_call(expr)
+    if not call:
+        raise ValueError(f"Выражение нельзя разложить по дням: {expr}")
+    agg_name, inner = call
+    agg = agg_name.lower()
+    if agg in ADDITIVE_AGGREGATIONS:
+        return {"kind": "sum", "sql": f"toFloat64({expr})"}
+    if agg in UNIQ_AGGREGATIONS:
+        node = try_parse(expr)
+        if agg.endswith("if") and node is not None:
+            # Условие — последний аргумент: uniqIf(x, y, cond)
+            arg = ", ".join(to_sql(a) for a in node.args[:-1])
+            cond = to_sql(node.args[-1])
+        elif agg.endswith("if"):
+            arg, cond = (part.strip() for part in inner.split(",", 1))
+        else:
+            arg, cond = inner, ""
+        # Сумма поюзерных uniq(x) равна числу уникальных пар (magnit_id, x)
+        return {"kind": "uniq", "hash": f"cityHash64(magnit_id, {arg})", "cond": cond}
+    raise ValueError(f"Агрегация {agg_name} не раскладывается по дням: {expr}")
+
+
+def generate_daily_partials_query(experiment: dict, metric: dict, source_table: str, days: list) -> str:
+    """Запрос частичных агрегатов метрики по (event_date, group_label) за указанные дни.
+
+    Возвращает строки (event_date, group_label, part, value, state): part 0 —
+    пользователи, 1 — числитель, 2 — знаменатель ratio метрики. Для сумм заполнено
+    value, для uniq — state (hex состояния uniqHLL12State).
+
+    Пользователи дня — число пользователей, чей первый день активности с начала
+    эксперимента приходится на этот день; их сумма по дням равна точному числу
+    пользователей за период. Для этого читаются ключевые колонки (magnit_id,
+    event_date, ab и колонки фильтров) с начала эксперимента по последний день.
+    """
+    if experiment.get("filters", {}).get("having"):
+        raise ValueError("HAVING считается по всему периоду и не раскладывается по дням")
+    if metric.get("cap_quantile"):
+        raise ValueError("Порог обрезки считается по всему периоду и не раскладывается по дням")
+    expressions = build_metric_expressions(metric)
+    if expressions is None:
+        raise ValueError(f"Неподдерживаемый тип метрики: {metric['type']}")
+    numerator, denominator, extra_where = expressions
+
+    days = sorted(days)
+    where_clauses = build_base_where(dict(experiment, start_date=days[0].isoformat(), end_date=days[-1].isoformat()))
+    if (days[-1] - days[0]).days + 1 != len(days):
+        where_clauses.append("event_date IN (" + ", ".join(f"'{d.isoformat()}'" for d in days) + ")")
+    if extra_where:
+        where_clauses.append(extra_where)
+
+    parts = [_metric_parts(numerator)]
+    if metric["type"] == "ratio":
+        parts.append(_metric_parts(denominator))
+
+    sums = []
+    hashes = []
+    for i, part in enumerate(parts, start=1):
+        if part["kind"] == "sum":
+            sums.append(f"({i}, {part['sql']})")
+        elif part["kind"] == "uniq":
+            hash_expr = part["hash"] if not part["cond"] else f"if({part['cond']}, {part['hash']}, NULL)"
+            hashes.append(f"({i}, {hash_expr})")
+
+    history_where = build_base_where(dict(experiment, end_date=days[-1].isoformat()))
+    if extra_where:
+        history_where.append(extra_where)
+    where_sql = " AND ".join(where_clauses)
+    queries = [
+        f"SELECT first_day AS event_date, group_label, 0 AS part, toFloat64(count()) AS value, '' AS state\n"
+        f"FROM (\n"
+        f"    SELECT\n"
+        f"        magnit_id,\n"
+        f"        {build_group_label(experiment).replace(chr(10), chr(10) + ' ' * 8)},\n"
+        f"        min(event_date) AS first_day\n"
+        f"    FROM {source_table}\n"
+        f"    WHERE {' AND '.join(history_where)}\n"
+        f"    GROUP BY magnit_id, group_label\n"
+        f")\n"
+        f"WHERE first_day IN (" + ", ".join(f"'{d.isoformat()}'" for d in days) + ")\n"
+        f"GROUP BY first_day, group_label"
+    ]
+    if hashes:
+        queries.append(
+            f"SELECT\n"
+            f"    event_date,\n"
+            f"    {build_group_label(experiment).replace(chr(10), chr(10) + ' ' * 4)},\n"
+            f"    h.1 AS part,\n"
+            f"    toFloat64(0) AS value,\n"
+            f"    hex(CAST(uniqHLL12State(assumeNotNull(h.2)) AS String)) AS state\n"
+            f"FROM {source_table}\n"
+            f"ARRAY JOIN [{', '.join(hashes)}] AS h\n"
+            f"WHERE {where_sql} AND h.2 IS NOT NULL\n"
+            f"GROUP BY event_date, group_label, part"
+        )
+    if sums:
+        queries.append(
+            f"SELECT event_date, group_label, p.1 AS part, p.2 AS value, '' AS state\n"
+            f"FROM (\n"
+            f"    SELECT\n"
+            f"        event_date,\n"
+            f"        {build_group_label(experiment).replace(chr(10), chr(10) + ' ' * 8)},\n"
+            f"        [{', '.join(sums)}] AS parts\n"
+            f"    FROM {source_table}\n"
+            f"    WHERE {where_sql}\n"
+            f"    GROUP BY event_date, group_label\n"
+            f")\n"
+            f"ARRAY JOIN parts AS p"
+        )
+    return "\nUNION ALL\n".join(queries)
+
+
+def _state_chunks(states: list) -> list:
+    """Пачки состояний для одного запроса: не больше MERGE_QUERY_BYTES и не меньше двух состояний"""
+    chunks = [[]]
+    size = 0
+    for state in states:
+        if len(chunks[-1]) >= 2 and size + len(state) > MERGE_QUERY_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(state)
+        size += len(state)
+    return chunks
+
+
+def merge_uniq_states(execute, states: dict) -> dict:
+    """Слияние состояний uniqHLL12 в ClickHouse: {ключ: [hex состояний]} -> {ключ: оценка}.
+
+    Запрос не читает таблиц — состояния передаются литералами. Чтобы запрос не
+    превышал max_query_size, состояния сливаются пачками, а промежуточные
+    состояния (uniqHLL12MergeState) — следующими раундами.
+    """
+    result = {}
+    for key, pending in states.items():
+        while True:
+            rows = []
+            for chunk in _state_chunks(pending):
+                values = ", ".join(f"'{state}'" for state in chunk)
+                rows += execute(
+                    f"SELECT\n"
+                    f"    hex(CAST(uniqHLL12MergeState(s) AS String)) AS state,\n"
+                    f"    uniqHLL12Merge(s) AS value\n"
+                    f"FROM (SELECT CAST(unhex(arrayJoin([{values}])) AS {UNIQ_STATE_TYPE}) AS s)"
+                )
+            if len(rows) == 1:
+                result[key] = float(rows[0]["value"])
+                break
+            pending = [row["state"] for row in rows]
+    return result
+
+
+def _encode_day(rows) -> dict:
+    """Строки запроса за один день -> хранимая запись {group: {part: {"value"} | {"state"}}}"""
+    groups = {}
+    for row in rows:
+        group = groups.setdefault(row["group_label"], {})
+        part = str(int(row["part"]))
+        group[part] = {"state": row["state"]} if row["state"] else {"value": float(row["value"])}
+    return groups
+
+
+class DailyResultCache:
+    """Локальный дисковый кэш дневных частичных агрегатов с вытеснением по размеру.
+
+    Файлы хранятся как <directory>/<key>/<YYYY-MM-DD>.json. Когда общий размер
+    превышает max_bytes, удаляются дни, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, day: date) -> str:
+        return os.path.join(self.directory, key, f"{day.isoformat()}.json")
+
+    def get(self, key: str, day: date):
+        path = self._path(key, day)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Время обращения для вытеснения давно не использованных дней
+        os.utime(path)
+        return data
+
+    def put(self, key: str, day: date, data: dict):
+        path = self._path(key, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Удаляет самые давно использованные дни, пока кэш не влезет в max_bytes"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def fetch_metric_totals(experiment: dict, metric: dict, source_table: str, execute, cache: DailyResultCache,
+                        today: date = None) -> dict:
+    """Точечные оценки метрики по группам с дозапросом только отсутствующих в кэше дней.
+
+    execute(sql) должен возвращать итерируемые строки-словари. Кэшируются только
+    дни раньше today: текущий день ещё может дозаписываться. Возвращает
+    {group_label: {"users", "numerator", "denominator", "value"}}.
+    """
+    today = today or date.today()
+    key = metric_cache_key(experiment, metric, source_table)
+    start = date.fromisoformat(experiment["start_date"])
+    end = date.fromisoformat(experiment["end_date"])
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    daily = {}
+    missing = []
+    for day in days:
+        data = cache.get(key, day) if day < today else None
+        if data is None:
+            missing.append(day)
+        else:
+            daily[day] = data
+
+    if missing:
+        sql = generate_daily_partials_query(experiment, metric, source_table, missing)
+        rows_by_day = {day: [] for day in missing}
+        for row in execute(sql):
+            day = row["event_date"]
+            day = day if isinstance(day, date) else date.fromisoformat(str(day)[:10])
+            rows_by_day[day].append(row)
+        for day, rows in rows_by_day.items():
+            daily[day] = _encode_day(rows)
+            if day < today:
+                cache.put(key, day, daily[day])
+        cache.evict()
+
+    merged = {}
+    states = {}
+    for data in daily.values():
+        for group_label, parts in data.items():
+            group = merged.setdefault(group_label, {})
+            for part, value in parts.items():
+                if "state" in value:
+                    states.setdefault((group_label, part), []).append(value["state"])
+                else:
+                    group[part] = group.get(part, 0.0) + value["value"]
+    for (group_label, part), value in merge_uniq_states(execute, states).items():
+        merged[group_label][part] = value
+
+    result = {}
+    for group_label, group in merged.items():
+        users = group.get("0", 0.0)
+        numerator = group.get("1", 0.0)
+        denominator = group.get("2", 0.0) if metric["type"] == "ratio" else users
+        result[group_label] = {
+            "users": users,
+            "numerator": numerator,
+            "denominator": denominator,
+            "value": numerator / denominator if denominator else float("nan"),
+        }
+    return result
@@ -0,0 +1,226 @@
+"""Колоночное хранилище результатов запросов по экспериментам (Arrow IPC + mmap).
+
+Результат каждого запроса эксперимента сохраняется в отдельный файл Arrow IPC
+без сжатия: <directory>/<эксперимент>/<хэш конфигурации>/<запрос>.arrow. При
+чтении файл отображается в память (pyarrow.memory_map), и числовые колонки
+отдаются как numpy-массивы поверх отображения, без копирования и разбора.
+Строковые колонки пишутся со словарным кодированием и восстанавливаются
+индексированием маленького словаря.
+
+Хэш конфигурации (experiment_config_hash) не зависит от дат эксперимента: при
+продлении эксперимента файлы перезаписываются на месте. В метаданных файла
+хранятся даты и хэш самого SQL, и файл считается актуальным, только если SQL
+совпадает, — кластер запрашивается заново при изменении конфигурации, периода
+или генератора SQL.
+
+Нужен пакет pyarrow.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from analysis import (
+    analyze_bootstrap_replicates,
+    analyze_cuped,
+    analyze_quantiles,
+    analyze_rows,
+    analyze_stratified,
+    analyze_sufficient_statistics,
+    sufficient_statistics_from_rows,
+)
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+    except Exception as e:
+        raise RuntimeError("Для хранилища результатов нужен пакет pyarrow") from e
+    return pa
+
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "_"
+
+
+def sql_hash(sql: str) -> str:
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+
+def experiment_config_hash(experiment: dict, source_table: str = SOURCE_TABLE, **options) -> str:
+    """Хэш определения эксперимента без дат и параметров генерации SQL (fused, output и т.д.)"""
+    definition = {k: v for k, v in experiment.items() if k not in ("start_date", "end_date")}
+    payload = {"experiment": definition, "source_table": source_table, "options": options}
+    # PreaggregatedView описывается именем таблицы
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=lambda v: getattr(v, "table", str(v)))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def columns_from_rows(rows: list) -> dict:
+    """dict колонок из списка строк-словарей (ответ executor)"""
+    names = list(rows[0]) if rows else []
+    return {name: [row[name] for row in rows] for name in names}
+
+
+def _to_arrow_array(pa, values):
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return pa.array(values)
+    array = pa.array(list(values))
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        # Колонки вида exp_name/metric_name повторяются на каждой строке
+        return array.dictionary_encode()
+    return array
+
+
+def _to_numpy(pa, column):
+    array = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        dictionary = array.dictionary.to_numpy(zero_copy_only=False).astype(object)
+        if array.null_count:
+            dictionary = np.append(dictionary, None)
+            indices = array.indices.fill_null(len(dictionary) - 1)
+        else:
+            indices = array.indices
+        return dictionary[indices.to_numpy()]
+    try:
+        return array.to_numpy(zero_copy_only=True)
+    except (pa.ArrowInvalid, NotImplementedError):
+        # NULL в числовой колонке или вложенный тип — с копированием
+        return array.to_numpy(zero_copy_only=False)
+
+
+class ResultStore:
+    """Файлы Arrow IPC с результатами запросов и вытеснением по размеру.
+
+    Когда общий размер превышает max_bytes, удаляются файлы, к которым дольше
+    всего не обращались.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, experiment_name: str, config_hash: str, query_name: str) -> str:
+        return os.path.join(
+            self.directory, _safe_filename(experiment_name), config_hash, f"{_safe_filename(query_name)}.arrow"
+        )
+
+    def metadata(self, experiment_name: str, config_hash: str, query_name: str):
+        """Метаданные файла (sql_hash, start_date, end_date, created_at) или None"""
+        pa = _pyarrow()
+        path = self._path(experiment_name, config_hash, query_name)
+        try:
+            with pa.memory_map(path, "r") as source:
+                schema = pa.ipc.open_file(source).schema
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in (schema.metadata or {}).items()}
+
+    def get(self, experiment_name: str, config_hash: str, query_name: str, sql: str):
+        """dict колонок numpy поверх отображённого в память файла или None, если файла нет или SQL другой.
+
+        Файл закрывается до возврата. Отображение освобождается, когда не останется
+        ссылок на числовые колонки, которые отдаются без копирования.
+        """
+        pa = _pyarrow()
+        path = self._path(experiment_name, config_hash, query_name)
+        try:
+            with pa.memory_map(path, "r") as source:
+                reader = pa.ipc.open_file(source)
+                metadata = reader.schema.metadata or {}
+                if metadata.get(b"sql_hash", b"").decode("utf-8") != sql_hash(sql):
+                    return None
+                table = reader.read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        # Время обращения для вытеснения давно не использованных файлов
+        os.utime(path)
+        return {name: _to_numpy(pa, table.column(name)) for name in table.column_names}
+
+    def put(self, experiment_name: str, config_hash: str, query_name: str, sql: str, columns: dict,
+            start_date: str = None, end_date: str = None):
+        pa = _pyarrow()
+        path = self._path(experiment_name, config_hash, query_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.table({name: _to_arrow_array(pa, values) for name, values in columns.items()})
+        table = table.replace_schema_metadata({
+            "sql_hash": sql_hash(sql),
+            "start_date": str(start_date or ""),
+            "end_date": str(end_date or ""),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            # Один record batch на файл: колонки при чтении не склеиваются и не копируются
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Удаляет самые давно использованные файлы, пока хранилище не влезет в max_bytes"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def fetch_experiment_results(experiment: dict, execute, store: ResultStore, source_table: str = SOURCE_TABLE,
+                             **options) -> dict:
+    """Результаты всех запросов эксперимента {query_name: dict колонок}: из хранилища или из кластера.
+
+    options передаются в generate_sql_queries_for_metrics (fused, output, sample и т.д.)
+    и входят в хэш конфигурации. Недостающие результаты запрашиваются через execute,
+    сохраняются и читаются обратно из файла, так что в памяти остаются только
+    отображённые страницы.
+    """
+    config_hash = experiment_config_hash(experiment, source_table, **options)
+    results = {}
+    written = False
+    for query_name, sql in generate_sql_queries_for_metrics(experiment, source_table, **options):
+        columns = store.get(experiment["experiment_name"], config_hash, query_name, sql)
+        if columns is None:
+            store.put(experiment["experiment_name"], config_hash, query_name, sql, columns_from_rows(execute(sql)),
+                      experiment.get("start_date"), experiment.get("end_date"))
+            columns = store.get(experiment["experiment_name"], config_hash, query_name, sql)
+            written = True
+        results[query_name] = columns
+    if written:
+        store.evict()
+    return results
+
+
+def analyze_stored(columns: dict, alpha: float = 0.05, control_label: str = "control", test_label: str = "test") -> dict:
+    """Анализ результата одного запроса по его колонкам: квантили, бутстреп, CUPED, страты, строки или статистики"""
+    if not columns:
+        return {}
+    if "stratum" in columns:
+        return analyze_stratified(columns, alpha, control_label, test_label)
+    if "sketch" in columns or "level" in columns:
+        return analyze_quantiles(columns, alpha, control_label, test_label)
+    if "replicate" in columns:
+        return analyze_bootstrap_replicates(columns, alpha, control_label, test_label)
+    if "numerator" in columns:
+        if "covariate" in columns:
+            return analyze_cuped(sufficient_statistics_from_rows(columns), alpha, control_label, test_label)
+        return analyze_rows(columns, alpha, control_label, test_label)
+    if "sum_c" in columns:
+        return analyze_cuped(columns, alpha, control_label, test_label)
+    return analyze_sufficient_statistics(columns, alpha, control_label, test_label)
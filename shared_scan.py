@@ -0,0 +1,217 @@
+"""Общий проход по таблице для нескольких экспериментов с пересекающимися датами.
+
+Эксперименты с одинаковыми глобальными фильтрами (WHERE, HAVING и долей выборки sample)
+и пересекающимися периодами объединяются в группу. Для группы строится один запрос: массив ab
+разворачивается через ARRAY JOIN по «плечам» всех экспериментов группы
+(эксперимент, группа, group_id, период, группы предыдущих плеч), так что строка таблицы читается один раз,
+а group_label и exp_name получаются для каждого эксперимента отдельно. Одинаковые
+по определению метрики разных экспериментов считаются одной колонкой.
+
+Метрики с bootstrap или cap_quantile, квантильные метрики, эксперименты с CUPED или strata и метрики,
+которые нельзя встроить через -If, считаются обычными запросами эксперимента.
+"""
+import json
+
+from profiling import timed
+from sql_optimizer import optimize_query
+from sql_generator import (
+    build_filter_conditions,
+    build_having_block,
+    build_metric_query,
+    experiment_arms,
+    fold_metric_filters,
+    generate_sql_queries_for_metrics,
+    needs_folded_having,
+    sample_condition,
+    sample_fraction,
+    share_common_aggregates,
+    wrap_sufficient_statistics,
+)
+
+
+def _filters_key(experiment: dict) -> str:
+    filters = experiment.get("filters", {})
+    return json.dumps(
+        {
+            "where": sorted(json.dumps(f, sort_keys=True, ensure_ascii=False) for f in filters.get("where", [])),
+            "having": sorted(h["expression"] for h in filters.get("having", [])),
+            "sample": sample_fraction(experiment),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+
+
+def plan_shared_scans(experiments: list) -> list:
+    """Разбивает эксперименты на группы: одинаковые фильтры и связная цепочка пересекающихся периодов"""
+    by_filters = {}
+    for experiment in experiments:
+        by_filters.setdefault(_filters_key(experiment), []).append(experiment)
+
+    groups = []
+    for candidates in by_filters.values():
+        candidates = sorted(candidates, key=lambda e: e["start_date"])
+        current = [candidates[0]]
+        current_end = candidates[0]["end_date"]
+        for experiment in candidates[1:]:
+            # Даты в ISO формате сравниваются как строки
+            if experiment["start_date"] <= current_end:
+                current.append(experiment)
+                current_end = max(current_end, experiment["end_date"])
+            else:
+                groups.append(current)
+                current = [experiment]
+                current_end = experiment["end_date"]
+        groups.append(current)
+    return groups
+
+
+def _metric_definition_key(m: dict) -> str:
+    definition = {k: v for k, v in m.items() if k not in ("name", "bootstrap", "covariate")}
+    return json.dumps(definition, sort_keys=True, ensure_ascii=False)
+
+
+def generate_shared_scan_query(experiments: list, source_table: str):
+    """Один запрос для группы экспериментов из plan_shared_scans.
+
+    Возвращает (sql, leftover), где leftover — список пар (эксперимент, метрика),
+    которые нельзя встроить в общий запрос. Результат в том же «длинном» формате,
+    что и у generate_sql_queries_for_metrics; exp_name берётся из плеча эксперимента.
+    """
+    arms = []
+    group_ids = []
+    for e in experiments:
+        # Пользователь из нескольких групп попадает в первое по списку плечо — как в CASE обычного запроса
+        previous = []
+        for label, group_id in experiment_arms(e):
+            excluded = "[" + ", ".join(f"'{g}'" for g in previous) + "]" if previous else "emptyArrayString()"
+            arms.append(f"('{e['experiment_name']}', '{label}', '{group_id}', "
+                        f"toDate('{e['start_date']}'), toDate('{e['end_date']}'), {excluded})")
+            previous.append(group_id)
+            group_ids.append(group_id)
+
+    # HAVING у экспериментов группы общий; при фильтрах метрик в -If он считается по метрикам, как в fused
+    metric_having = any(needs_folded_having(e, e["metrics"]) for e in experiments)
+    columns = {}
+    metric_tuples = {}
+    leftover = []
+    for e in experiments:
+        for m in e["metrics"]:
+            folded = fold_metric_filters(m, e if metric_having else None)
+            if folded is None:
+                leftover.append((e, m))
+                continue
+            definition = _metric_definition_key(m)
+            if definition not in columns:
+                columns[definition] = (len(columns), folded)
+            i = columns[definition][0]
+            metric_tuples.setdefault((i, m["type"], m["name"]), []).append(e["experiment_name"])
+
+    if not metric_tuples:
+        return None, leftover
+
+    expressions = []
+    aliases = []
+    for i, (numerator, denominator, presence) in columns.values():
+        expressions += [numerator, denominator, presence]
+        aliases += [f"num_{i}", f"den_{i}", f"has_{i}"]
+    # Одинаковые агрегаты разных метрик (например, sum(gmv)) считаются один раз
+    fused_columns, expressions = share_common_aggregates(expressions)
+    fused_columns += [f"{expr} AS {alias}" for expr, alias in zip(expressions, aliases)]
+    tuples = []
+    for (i, metric_type, metric_name), names in metric_tuples.items():
+        names_sql = ", ".join(f"'{n}'" for n in names)
+        tuples.append(
+            f"('{metric_type}', '{metric_name}', toFloat64(num_{i}), toFloat64(den_{i}), toUInt8(has_{i}), [{names_sql}])"
+        )
+
+    where_clauses = [
+        f"event_date BETWEEN '{min(e['start_date'] for e in experiments)}' "
+        f"AND '{max(e['end_date'] for e in experiments)}'",
+        "hasAny(ab, [" + ", ".join(f"'{g}'" for g in dict.fromkeys(group_ids)) + "])",
+    ]
+    if sample_condition(experiments[0].get("sample")):
+        where_clauses.append(sample_condition(experiments[0]["sample"]))
+    where_clauses += build_filter_conditions(experiments[0].get("filters", {}).get("where", []))
+    having_block = "" if metric_having else build_having_block(experiments[0])
+
+    arms_sql = ",\n            ".join(arms)
+    inner_select = ",\n        ".join(["magnit_id", "arm"] + fused_columns)
+    metrics_array = ",\n    ".join(tuples)
+    query = (
+        f"SELECT\n"
+        f"    arm.1 AS exp_name,\n"
+        f"    magnit_id,\n"
+        f"    arm.2 AS group_label,\n"
+        f"    m.1 AS metric_type,\n"
+        f"    m.2 AS metric_name,\n"
+        f"    m.3 AS numerator,\n"
+        f"    m.4 AS denominator\n"
+        f"FROM (\n"
+        f"    SELECT\n        {inner_select}\n"
+        f"    FROM {source_table}\n"
+        f"    ARRAY JOIN arrayFilter(\n"
+        f"        a -> has(ab, a.3) AND NOT hasAny(ab, a.6) AND event_date BETWEEN a.4 AND a.5,\n"
+        f"        [\n            {arms_sql}\n        ]\n"
+        f"    ) AS arm\n"
+        f"    WHERE {' AND '.join(where_clauses)}\n"
+        f"    GROUP BY magnit_id, arm\n"
+        + (f"    {having_block}\n" if having_block else "") +
+        f")\n"
+        f"ARRAY JOIN [\n    {metrics_array}\n] AS m\n"
+        f"WHERE m.5 = 1 AND has(m.6, arm.1)"
+    )
+    return query, leftover
+
+
+@timed()
+def generate_shared_scan_queries(experiments: list, source_table: str, output: str = "rows",
+                                 optimize: bool = False, prewhere: bool = True) -> list:
+    """Запросы для всех экспериментов с общими проходами: список (название, sql, [эксперименты]).
+
+    Результаты общих запросов раскладываются по экспериментам через split_results_by_experiment.
+    optimize и prewhere — как в generate_sql_queries_for_metrics.
+    """
+    if output not in ("rows", "aggregate"):
+        raise ValueError(f"Неизвестный формат результата: {output}")
+
+    queries = []
+    shareable = []
+    for e in experiments:
+        if e.get("cuped") or e.get("strata"):
+            for name, sql in generate_sql_queries_for_metrics(e, source_table, fused=True, output=output):
+                queries.append((name, sql, [e["experiment_name"]]))
+            continue
+        separate = [m for m in e["metrics"] if m.get("bootstrap") or m.get("cap_quantile") or m["type"] == "quantile"]
+        regular = [m for m in e["metrics"] if m not in separate]
+        if separate:
+            for name, sql in generate_sql_queries_for_metrics(dict(e, metrics=separate), source_table, output=output):
+                queries.append((name, sql, [e["experiment_name"]]))
+        if regular:
+            shareable.append(dict(e, metrics=regular))
+
+    for group in plan_shared_scans(shareable) if shareable else []:
+        sql, leftover = generate_shared_scan_query(group, source_table)
+        names = [e["experiment_name"] for e in group]
+        if sql is not None:
+            if output == "aggregate":
+                sql = wrap_sufficient_statistics(sql, fraction=sample_fraction(group[0]))
+            queries.append((" + ".join(names), sql, names))
+        for e, m in leftover:
+            sql = build_metric_query(e, m, source_table)
+            if sql is None:
+                continue
+            if output == "aggregate":
+                sql = wrap_sufficient_statistics(sql, fraction=sample_fraction(e))
+            queries.append((m["name"], sql, [e["experiment_name"]]))
+    if optimize:
+        queries = [(name, optimize_query(sql, prewhere), names) for name, sql, names in queries]
+    return queries
+
+
+def split_results_by_experiment(rows, experiment_names: list) -> dict:
+    """Раскладывает строки общего запроса по экспериментам: {experiment_name: rows}"""
+    result = {name: [] for name in experiment_names}
+    for row in rows:
+        result.setdefault(row["exp_name"], []).append(row)
+    return result
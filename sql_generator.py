@@ -0,0 +1,943 @@
+"""Генерация ClickHouse SQL для метрик A/B-экспериментов.
+
+Эксперимент описывается словарём того же вида, что сохраняется в experiments_config.yaml
+(experiment_name, control_group_id, test_group_id, start_date, end_date, metrics, filters).
+Эксперимент A/B/n вместо пары групп задаёт список плеч arms (см. experiment_arms).
+"""
+from datetime import date, timedelta
+import math
+import re
+
+from expression_parser import (
+    Call,
+    Identifier,
+    add_condition,
+    aggregate_calls,
+    condition_node,
+    is_if_aggregate,
+    replace_subtrees,
+    to_sql,
+    try_parse,
+)
+from profiling import timed
+from sql_optimizer import optimize_query
+
+SOURCE_TABLE = "ft_pa_prod.delivery_abtest_metrics_daily"
+
+# Детерминированная выборка пользователей: cityHash64(magnit_id) % SAMPLE_BUCKETS < k
+SAMPLE_BUCKETS = 10000
+
+AVAILABLE_METRICS = [
+    "discounts_sum", "discount_sum_w_nds", "launch_flg", "catalog_main_flg", "catalog_listing_flg",
+    "search_main_flg", "search_result_flg", "product_screen_flg", "product_screen_to_cart_flg",
+    "listing_to_cart_flg", "listing_to_item_flg", "search_screen_to_cart_flg", "cart_visit_flg",
+    "cart_2_checkout_flg", "checkout_visit_flg", "pay_button_pushed_flg", "purhase_flg", "first_order_date",
+    "orders_cnt", "items_cnt", "gmv", "cm2_amt", "net_revenue", "total_discount", "total_discount_wo_nds",
+    "bonus_add", "bonus_written", "promo_discount", "gmv_add_bonuses", "net_revenue_add_bonuses", "cm",
+    "gm", "pcpo", "lcpo", "orders_rec_cnt", "items_rec_cnt", "gmv_rec", "cm2_amt_rec", "net_revenue_rec",
+    "rec_views_flag", "rec_a2c_flg", "rec_pdp_flg", "crb_without_pdp", "crb_with_pdp", "aic_num_pdp",
+    "aic_num_wo_pdp", "aic_denum_pdp", "aic_denum_wo_pdp", "empty_search", "non_empty_search",
+    "total_searches", "search_revenue", "search_order_cnt", "search_good_amount", "search_with_order_amount",
+    "catalog_revenue", "catalog_order_cnt", "catalog_good_amount", "catalog_with_order_amount"
+]
+
+AGGREGATION_FUNCTIONS = [
+    "sum", "avg", "max", "min",
+    "sumIf", "maxIf", "minIf", "avgIf",
+    "count", "countIf",
+    "uniqIf", "anyIf"
+]
+
+
+def parse_expression(expr: str) -> str:
+    if "(" in expr and ")" in expr:
+        return expr
+    try:
+        field, agg = expr.split("-")
+        return f"{agg.upper()}({field})"
+    except:
+        return expr
+
+# --- Функция форматирования значений для SQL в зависимости от типа данных
+
+def format_sql_value(value, value_type):
+    """Форматирует значение для SQL в зависимости от типа данных"""
+    if value_type == "число":
+        return str(value)
+    elif value_type == "булево":
+        if str(value).lower() in ['true', '1', 'да', 'yes']:
+            return 'true'
+        elif str(value).lower() in ['false', '0', 'нет', 'no']:
+            return 'false'
+        else:
+            return str(value)  # Если не удается определить, оставляем как есть
+    else:  # строка (по умолчанию)
+        return f"'{value}'"
+
+# --- Вспомогательные функции для сборки SQL
+
+def build_filter_conditions(filters: list) -> list:
+    """Превращает список фильтров {field, operator, value, value_type} в SQL-условия"""
+    conditions = []
+    for f in filters:
+        value_type = f.get("value_type", "строка")
+        if f["operator"] == "IN":
+            val = ", ".join(format_sql_value(v, value_type) for v in f["value"])
+            conditions.append(f"{f['field']} IN ({val})")
+        else:
+            formatted_value = format_sql_value(f['value'], value_type)
+            conditions.append(f"{f['field']} {f['operator']} {formatted_value}")
+    return conditions
+
+
+def merge_if_condition(expr: str, extra_cond: str) -> str:
+    """Встраивает условие во все агрегаты выражения с -If комбинатором.
+
+    sumIf(x, c) -> sumIf(x, c AND extra), sum(a) / countIf(c) -> sumIf(a, extra) / countIf(c AND extra).
+    Если выражение не содержит *If агрегатов, возвращается как есть.
+    """
+    if not extra_cond:
+        return expr
+    node = try_parse(expr)
+    if node is None:
+        return _merge_if_condition_text(expr, extra_cond)
+    calls = aggregate_calls(node)
+    if not any(is_if_aggregate(c) for c in calls):
+        return expr
+    condition = condition_node(extra_cond)
+    return to_sql(replace_subtrees(node, {c: add_condition(c, condition) for c in calls}))
+
+
+def has_if_aggregate(expr: str) -> bool:
+    """Есть ли в выражении агрегат с -If комбинатором (if(...) внутри sum(...) не считается)"""
+    node = try_parse(expr)
+    if node is None:
+        return "if(" in expr.lower()
+    return any(is_if_aggregate(c) for c in aggregate_calls(node))
+
+
+def _merge_if_condition_text(expr: str, extra_cond: str) -> str:
+    """Текстовое встраивание условия для выражений, которые не разбирает expression_parser"""
+    if not extra_cond:
+        return expr
+    e = expr.strip()
+    # countIf(condition)
+    if e.lower().startswith("countif("):
+        inner = e[e.find("(") + 1: e.rfind(")")].strip()
+        if inner:
+            new_inner = f"({inner}) AND ({extra_cond})"
+        else:
+            new_inner = f"({extra_cond})"
+        return f"countIf({new_inner})"
+    # <agg>If(arg, condition)
+    m_ = re.match(r"^(\w+If)\s*\((.*)\)$", e)
+    if m_:
+        agg_name = m_.group(1)
+        inside = m_.group(2)
+        # Разделяем по первой запятой на аргумент и условие
+        parts = inside.split(",", 1)
+        if len(parts) == 2:
+            arg = parts[0].strip()
+            cond = parts[1].strip()
+            cond = cond[1:-1].strip() if cond.startswith("(") and cond.endswith(")") else cond
+            if cond:
+                merged_cond = f"({cond}) AND ({extra_cond})"
+            else:
+                merged_cond = f"({extra_cond})"
+            return f"{agg_name}({arg}, {merged_cond})"
+        else:
+            # Если условие отсутствует, трактуем всё как аргумент и добавляем условие
+            arg = inside.strip()
+            return f"{agg_name}({arg}, ({extra_cond}))"
+    return expr
+
+
+def split_aggregate_call(expr: str):
+    """Разбирает выражение вида agg(...) на (agg, аргументы); None, если это не один вызов"""
+    node = try_parse(expr)
+    if node is not None:
+        if not isinstance(node, Call) or node.params is not None:
+            return None
+        return node.name, ", ".join(to_sql(a) for a in node.args)
+    m_ = re.match(r"^\s*(\w+)\s*\(", expr)
+    if not m_:
+        return None
+    e = expr.strip()
+    depth = 0
+    open_pos = e.find("(")
+    for i in range(open_pos, len(e)):
+        if e[i] == "(":
+            depth += 1
+        elif e[i] == ")":
+            depth -= 1
+            if depth == 0:
+                # Закрывающая скобка вызова должна быть последним символом
+                if i != len(e) - 1:
+                    return None
+                return m_.group(1), e[open_pos + 1: i].strip()
+    return None
+
+
+def add_if_combinator(expr: str, extra_cond: str):
+    """Встраивает условие во все агрегаты выражения через -If комбинатор.
+
+    sum(x) -> sumIf(x, cond), sum(a) / count() -> sumIf(a, cond) / countIf(cond).
+    Возвращает None, если выражение не разбирается или не содержит агрегатов.
+    """
+    if not extra_cond:
+        return expr
+    node = try_parse(expr)
+    if node is None:
+        return None
+    calls = aggregate_calls(node)
+    if not calls:
+        return None
+    condition = condition_node(extra_cond)
+    return to_sql(replace_subtrees(node, {c: add_condition(c, condition) for c in calls}))
+
+
+def share_common_aggregates(expressions: list):
+    """Выносит агрегаты, которые встречаются в нескольких выражениях, в общие колонки.
+
+    Возвращает (columns, rewritten): columns — колонки вида "sum(gmv) AS agg_0" для
+    повторяющихся агрегатов, rewritten — выражения, где эти агрегаты заменены
+    ссылкой на колонку. Агрегаты сравниваются по AST, поэтому различия в пробелах
+    и регистре ключевых слов не мешают. Выражения без общих агрегатов и
+    неразбираемые выражения возвращаются как есть.
+    """
+    parsed = [try_parse(expr) for expr in expressions]
+    counts = {}
+    for node in parsed:
+        for call in aggregate_calls(node) if node is not None else []:
+            counts[call] = counts.get(call, 0) + 1
+
+    shared = {}
+    columns = []
+    for call, count in counts.items():
+        if count > 1:
+            alias = f"agg_{len(shared)}"
+            shared[call] = Identifier(alias)
+            columns.append(f"{to_sql(call)} AS {alias}")
+
+    rewritten = []
+    for expr, node in zip(expressions, parsed):
+        if node is None or not any(call in shared for call in aggregate_calls(node)):
+            rewritten.append(expr)
+        else:
+            rewritten.append(to_sql(replace_subtrees(node, shared)))
+    return columns, rewritten
+
+
+def build_metric_expressions(m: dict):
+    """Возвращает (numerator, denominator, extra_where) для метрики или None для неизвестного типа.
+
+    extra_where — условие индивидуальных фильтров метрики, которое не удалось
+    встроить в *If агрегации и которое нужно добавить в WHERE.
+    """
+    metric_extra_condition = " AND ".join(build_filter_conditions(m.get("where_filters", [])))
+
+    if m["type"] == "basic":
+        expr_original = m['expression']
+        # Если это *If агрегация — встраиваем фильтры в выражение, иначе добавляем их в WHERE
+        if has_if_aggregate(expr_original):
+            return merge_if_condition(expr_original, metric_extra_condition), "1", ""
+        return expr_original, "1", metric_extra_condition
+
+    if m["type"] == "ratio":
+        numerator_original = m["numerator"]
+        denominator_original = m["denominator"]
+
+        num_has_if = has_if_aggregate(numerator_original)
+        den_has_if = has_if_aggregate(denominator_original)
+
+        if num_has_if:
+            numerator_expr = merge_if_condition(numerator_original, metric_extra_condition)
+        else:
+            numerator_expr = numerator_original
+
+        if den_has_if:
+            denominator_expr = merge_if_condition(denominator_original, metric_extra_condition)
+        else:
+            denominator_expr = denominator_original
+
+        # Если ни одно из выражений не *If — добавляем фильтры в WHERE
+        if not num_has_if and not den_has_if:
+            return numerator_expr, denominator_expr, metric_extra_condition
+        return numerator_expr, denominator_expr, ""
+
+    return None
+
+
+def sample_condition(fraction: float) -> str:
+    """Условие хэш-выборки доли fraction пользователей; пустая строка для полного прохода.
+
+    Выборка зависит только от magnit_id, так что одни и те же пользователи попадают
+    в неё при каждом запуске и в обеих группах.
+    """
+    if fraction is None or fraction == 1:
+        return ""
+    if not 0 < fraction < 1:
+        raise ValueError(f"Доля выборки должна быть в (0, 1]: {fraction}")
+    buckets = max(1, round(fraction * SAMPLE_BUCKETS))
+    return f"cityHash64(magnit_id) % {SAMPLE_BUCKETS} < {buckets}"
+
+
+def sample_fraction(experiment: dict) -> float:
+    """Фактическая доля выборки эксперимента (с округлением до корзин); 1.0 — без выборки"""
+    fraction = experiment.get("sample")
+    if fraction is None or fraction == 1:
+        return 1.0
+    return max(1, round(fraction * SAMPLE_BUCKETS)) / SAMPLE_BUCKETS
+
+
+def experiment_arms(experiment: dict) -> list:
+    """Плечи эксперимента [(group_label, group_id), ...]; первое плечо — контроль.
+
+    Эксперимент A/B/n задаёт arms: [{"label": "control", "group_id": "..."}, {"label": "test_b", ...}].
+    Без arms — два плеча control/test из control_group_id и test_group_id.
+    """
+    if experiment.get("arms"):
+        return [(arm["label"], arm["group_id"]) for arm in experiment["arms"]]
+    return [("control", experiment["control_group_id"]), ("test", experiment["test_group_id"])]
+
+
+def build_base_where(experiment: dict) -> list:
+    """Общие условия WHERE эксперимента: период, группы, выборка и глобальные фильтры"""
+    group_ids = ", ".join(f"'{group_id}'" for _, group_id in experiment_arms(experiment))
+    where_clauses = [
+        f"event_date BETWEEN '{experiment['start_date']}' AND '{experiment['end_date']}'",
+        f"hasAny(ab, [{group_ids}])"
+    ]
+    if sample_condition(experiment.get("sample")):
+        where_clauses.append(sample_condition(experiment["sample"]))
+    where_clauses += build_filter_conditions(experiment.get("filters", {}).get("where", []))
+    return where_clauses
+
+
+def build_group_label(experiment: dict) -> str:
+    """CASE по плечам эксперимента: пользователь из нескольких групп попадает в первое по списку плечо"""
+    branches = "".join(f"    WHEN has(ab, '{group_id}') THEN '{label}'\n" for label, group_id in experiment_arms(experiment))
+    return f"CASE\n{branches}END AS group_label"
+
+
+def build_stratum_expression(experiment: dict):
+    """Выражение страты пользователя по опции strata эксперимента; None без страт.
+
+    strata — выражение или список выражений: колонки (platform) берутся через any(),
+    агрегаты (min(first_order_date) < '2024-01-01') — как есть. Несколько выражений
+    склеиваются в одну строку через « | ». Страта должна не зависеть от воздействия
+    (атрибут пользователя или поведение до начала эксперимента).
+    """
+    strata = experiment.get("strata")
+    if not strata:
+        return None
+    parts = []
+    for expr in [strata] if isinstance(strata, str) else strata:
+        node = try_parse(expr)
+        if node is None:
+            raise ValueError(f"Не разбирается выражение страты: {expr}")
+        parts.append(f"toString({expr if aggregate_calls(node) else f'any({expr})'})")
+    return parts[0] if len(parts) == 1 else f"arrayStringConcat([{', '.join(parts)}], ' | ')"
+
+
+def build_having_block(experiment: dict) -> str:
+    having_filters = experiment.get("filters", {}).get("having", [])
+    if not having_filters:
+        return ""
+    return "HAVING " + " AND ".join(h["expression"] for h in having_filters)
+
+
+def wrap_sufficient_statistics(query: str, covariate: bool = False, fraction: float = 1.0, strata: bool = False) -> str:
+    """Оборачивает поюзерный запрос во внешнюю агрегацию по группам.
+
+    Возвращает для каждой пары (метрика, группа) n, Σx, Σx², Σy, Σy² и Σxy, где
+    x — numerator, y — denominator. Этого достаточно для t-теста по basic метрикам
+    и дельта-метода по ratio метрикам. Пользователи с NULL в numerator/denominator
+    не учитываются — так же, как в analysis.sufficient_statistics_from_rows.
+
+    При covariate=True добавляются Σc, Σc² и Σxc по колонке covariate (для CUPED).
+    При strata=True статистики считаются по (страта, группа) — по колонке stratum
+    (см. build_stratum_expression и analysis.analyze_stratified).
+    Для запроса по выборке (fraction < 1) добавляется колонка sample_fraction, по которой
+    analysis пересчитывает размеры групп на полную аудиторию.
+    """
+    inner = query.replace("\n", "\n    ")
+    stratum_field = "    stratum,\n" if strata else ""
+    stratum_key = ", stratum" if strata else ""
+    extra_fields = ""
+    if fraction != 1:
+        extra_fields += f",\n    {fraction!r} AS sample_fraction"
+    if covariate:
+        extra_fields += (
+            f",\n    sum(toFloat64(covariate)) AS sum_c,\n"
+            f"    sum(toFloat64(covariate) * toFloat64(covariate)) AS sum_c2,\n"
+            f"    sum(toFloat64(numerator) * toFloat64(covariate)) AS sum_xc"
+        )
+    return (
+        f"SELECT\n"
+        f"    exp_name,\n"
+        f"    group_label,\n"
+        f"{stratum_field}"
+        f"    metric_type,\n"
+        f"    metric_name,\n"
+        f"    count() AS n,\n"
+        f"    sum(toFloat64(numerator)) AS sum_x,\n"
+        f"    sum(toFloat64(numerator) * toFloat64(numerator)) AS sum_x2,\n"
+        f"    sum(toFloat64(denominator)) AS sum_y,\n"
+        f"    sum(toFloat64(denominator) * toFloat64(denominator)) AS sum_y2,\n"
+        f"    sum(toFloat64(numerator) * toFloat64(denominator)) AS sum_xy{extra_fields}\n"
+        f"FROM (\n    {inner}\n)\n"
+        f"WHERE numerator IS NOT NULL AND denominator IS NOT NULL\n"
+        f"GROUP BY exp_name, group_label{stratum_key}, metric_type, metric_name"
+    )
+
+
+def cap_metric_query(query: str, cap_quantile: float) -> str:
+    """Винсоризация поюзерного запроса: numerator обрезается сверху квантилем cap_quantile.
+
+    Порог общий для всех групп эксперимента (считается по пользователям всех групп
+    оконной функцией в том же запросе), так что обрезка не зависит от того, в какую
+    группу попал пользователь. Знаменатель ratio метрик не обрезается.
+    """
+    cap_quantile = float(cap_quantile)
+    if not 0 < cap_quantile < 1:
+        raise ValueError(f"Квантиль обрезки должен быть в (0, 1): {cap_quantile}")
+    inner = query.replace("\n", "\n    ")
+    return (
+        f"WITH users AS (\n"
+        f"    {inner}\n"
+        f")\n"
+        f"SELECT\n"
+        f"    * EXCEPT (numerator),\n"
+        f"    least(toFloat64(numerator), quantileExact({cap_quantile!r})(toFloat64(numerator)) OVER ()) AS numerator\n"
+        f"FROM users"
+    )
+
+
+def poisson_weight_sql(uniform_expr: str, max_weight: int = 10) -> str:
+    """SQL-выражение веса Poisson(1) по равномерной величине в [0, 1) (обратная функция распределения)"""
+    branches = []
+    cdf = 0.0
+    for k in range(max_weight):
+        cdf += math.exp(-1) / math.factorial(k)
+        branches.append(f"u < {cdf!r}, {k}")
+    return f"multiIf({', '.join(branches)}, {max_weight})"
+
+
+def wrap_poisson_bootstrap(query: str, replicates: int, seed: int = 0) -> str:
+    """Пуассоновский бутстреп внутри ClickHouse поверх поюзерного запроса.
+
+    Вес пользователя в реплике r — Poisson(1), полученный из cityHash64(magnit_id, r, seed),
+    поэтому реплики детерминированы и не требуют выгрузки строк на клиент. Для каждой
+    группы возвращается replicates + 1 строк: replicate = 0 — исходная выборка
+    (все веса 1), 1..replicates — бутстреп-реплики с n = Σw, sum_x = Σw·x, sum_y = Σw·y.
+    """
+    inner = query.replace("\n", "\n            ")
+    weight = poisson_weight_sql("u")
+    return (
+        f"SELECT\n"
+        f"    exp_name,\n"
+        f"    group_label,\n"
+        f"    metric_type,\n"
+        f"    metric_name,\n"
+        f"    replicate_pos - 1 AS replicate,\n"
+        f"    n,\n"
+        f"    sum_x,\n"
+        f"    sum_y\n"
+        f"FROM (\n"
+        f"    SELECT\n"
+        f"        exp_name,\n"
+        f"        group_label,\n"
+        f"        metric_type,\n"
+        f"        metric_name,\n"
+        f"        sumForEach(w) AS n_arr,\n"
+        f"        sumForEach(arrayMap(v -> v * toFloat64(numerator), w)) AS sum_x_arr,\n"
+        f"        sumForEach(arrayMap(v -> v * toFloat64(denominator), w)) AS sum_y_arr\n"
+        f"    FROM (\n"
+        f"        SELECT\n"
+        f"            *,\n"
+        f"            arrayMap(\n"
+        f"                (r, u) -> if(r = 0, 1, {weight}),\n"
+        f"                range({int(replicates) + 1}),\n"
+        f"                arrayMap(r -> cityHash64(magnit_id, r, {int(seed)}) / 18446744073709551616, range({int(replicates) + 1}))\n"
+        f"            ) AS w\n"
+        f"        FROM (\n"
+        f"            {inner}\n"
+        f"        )\n"
+        f"        WHERE numerator IS NOT NULL AND denominator IS NOT NULL\n"
+        f"    )\n"
+        f"    GROUP BY exp_name, group_label, metric_type, metric_name\n"
+        f")\n"
+        f"ARRAY JOIN n_arr AS n, sum_x_arr AS sum_x, sum_y_arr AS sum_y, arrayEnumerate(n_arr) AS replicate_pos\n"
+        f"ORDER BY metric_name, group_label, replicate"
+    )
+
+
+def build_quantile_sketch_query(experiment: dict, m: dict, source_table: str, output: str = "rows") -> str:
+    """Запрос квантильной метрики (type: quantile) без выгрузки значений на клиент.
+
+    m["expression"] — значение в строке таблицы (например, gmv), m["level"] — уровень
+    квантиля (0.5 — медиана). output="rows" возвращает t-digest скетчи по (группа,
+    день, реплика) в hex — их сливает tdigest.py; output="aggregate" — готовый
+    квантиль по (группа, реплика), слияние внутри ClickHouse. С опцией bootstrap
+    строки берутся с пуассоновскими весами пользователя (как в wrap_poisson_bootstrap),
+    replicate = 0 — исходная выборка. При HAVING эксперимента строки собираются по
+    пользователю (groupArray) в том же проходе, HAVING отбирает пользователей, а
+    строки разворачиваются обратно через ARRAY JOIN.
+    """
+    value = m["expression"]
+    node = try_parse(value)
+    if node is not None and aggregate_calls(node):
+        raise ValueError(f"Квантильная метрика '{m['name']}' ожидает значение строки, а не агрегат: {value}")
+    level = float(m.get("level", 0.5))
+    if not 0 < level < 1:
+        raise ValueError(f"Уровень квантиля должен быть в (0, 1): {level}")
+    replicates = int(m["bootstrap"].get("replicates", 1000)) if m.get("bootstrap") else 0
+    seed = int(m["bootstrap"].get("seed", 0)) if m.get("bootstrap") else 0
+
+    where_clauses = build_base_where(experiment) + build_filter_conditions(m.get("where_filters", []))
+    having_block = build_having_block(experiment)
+    if having_block:
+        group_label = build_group_label(experiment).replace("\n", "\n        ")
+        rows = (
+            f"SELECT\n"
+            f"    magnit_id,\n"
+            f"    r.1 AS event_date,\n"
+            f"    group_label,\n"
+            f"    r.2 AS x\n"
+            f"FROM (\n"
+            f"    SELECT\n"
+            f"        magnit_id,\n"
+            f"        {group_label},\n"
+            f"        groupArray((event_date, toFloat64({value}))) AS user_rows\n"
+            f"    FROM {source_table}\n"
+            f"    WHERE {' AND '.join(where_clauses)}\n"
+            f"    GROUP BY magnit_id, group_label\n"
+            f"    {having_block}\n"
+            f")\n"
+            f"ARRAY JOIN user_rows AS r"
+        )
+    else:
+        group_label = build_group_label(experiment).replace("\n", "\n    ")
+        rows = (
+            f"SELECT\n"
+            f"    magnit_id,\n"
+            f"    event_date,\n"
+            f"    {group_label},\n"
+            f"    toFloat64({value}) AS x\n"
+            f"FROM {source_table}\n"
+            f"WHERE {' AND '.join(where_clauses)}"
+        )
+    if replicates:
+        uniform = f"cityHash64(magnit_id, replicate, {seed}) / 18446744073709551616"
+        inner = rows.replace("\n", "\n        ")
+        rows = (
+            f"SELECT\n"
+            f"    group_label,\n"
+            f"    event_date,\n"
+            f"    x,\n"
+            f"    replicate,\n"
+            f"    toUInt64(if(replicate = 0, 1, {poisson_weight_sql('u')})) AS weight\n"
+            f"FROM (\n"
+            f"    SELECT\n"
+            f"        group_label,\n"
+            f"        event_date,\n"
+            f"        x,\n"
+            f"        replicate,\n"
+            f"        {uniform} AS u\n"
+            f"    FROM (\n"
+            f"        {inner}\n"
+            f"    )\n"
+            f"    ARRAY JOIN range({replicates + 1}) AS replicate\n"
+            f")\n"
+            f"WHERE weight > 0"
+        )
+        sketch_args, count = "x, weight", "sum(weight)"
+        function = "quantileTDigestWeighted"
+    else:
+        sketch_args, count = "x", "count()"
+        function = "quantileTDigest"
+    inner = rows.replace("\n", "\n    ")
+
+    fields = [
+        f"'{experiment['experiment_name']}' AS exp_name",
+        "group_label",
+        f"'{m['type']}' AS metric_type",
+        f"'{m['name']}' AS metric_name",
+        f"{level!r} AS level",
+    ]
+    group_by = ["group_label"]
+    if output == "rows":
+        fields.append("event_date")
+        group_by.append("event_date")
+    fields.append("replicate" if replicates else "0 AS replicate")
+    if replicates:
+        group_by.append("replicate")
+    fields.append(f"{count} AS n")
+    if output == "rows":
+        fields.append(f"hex(CAST({function}State({level!r})({sketch_args}) AS String)) AS sketch")
+    else:
+        fields.append(f"{function}({level!r})({sketch_args}) AS value")
+    select_clause = ",\n    ".join(fields)
+    return (
+        f"SELECT\n    {select_clause}\n"
+        f"FROM (\n    {inner}\n)\n"
+        f"WHERE x IS NOT NULL\n"
+        f"GROUP BY {', '.join(group_by)}"
+    )
+
+
+def build_cuped_metric_query(experiment: dict, m: dict, source_table: str):
+    """Поюзерный запрос basic метрики с ковариатой CUPED за предпериод в том же проходе.
+
+    Период чтения расширяется на pre_period_days дней до start_date; значение метрики
+    и ковариата считаются условной агрегацией по event_date (-If комбинаторы).
+    Ковариата по умолчанию — то же выражение, что и у метрики, либо m["covariate"].
+    Пользователи без строк в периоде эксперимента отбрасываются, а HAVING эксперимента
+    считается только по строкам периода эксперимента. У пользователей без строк
+    в предпериоде (например, новых) ковариата равна 0, в том числе для avg и других
+    агрегатов, которые на пустом наборе дают NaN или NULL.
+
+    Возвращает None — и метрика считается без CUPED, — если метрика не basic
+    (ratio метрики CUPED не поддерживают) или выражение (или HAVING) нельзя
+    разделить по периодам.
+    """
+    if m["type"] != "basic":
+        return None
+    numerator, _, extra_where = build_metric_expressions(m)
+
+    start_date = experiment["start_date"]
+    pre_period_days = int(experiment["cuped"].get("pre_period_days", 14))
+    pre_start = (date.fromisoformat(start_date) - timedelta(days=pre_period_days)).isoformat()
+    in_period = f"event_date >= '{start_date}'"
+    pre_period = f"event_date < '{start_date}'"
+
+    value = add_if_combinator(numerator, in_period)
+    covariate = add_if_combinator(m.get("covariate") or numerator, pre_period)
+    having = fold_having(experiment, in_period)
+    if value is None or covariate is None or having is None:
+        return None
+    covariate = f"ifNotFinite({covariate}, 0)"
+
+    where_clauses = build_base_where(dict(experiment, start_date=pre_start))
+    if extra_where:
+        where_clauses.append(extra_where)
+
+    having_conditions = [f"countIf({in_period}) > 0"] + having
+
+    select_clause = ",\n    ".join([
+        f"'{experiment['experiment_name']}' AS exp_name",
+        "magnit_id",
+        build_group_label(experiment),
+        f"'{m['type']}' AS metric_type",
+        f"'{m['name']}' AS metric_name",
+        f"{value} AS numerator",
+        "1 AS denominator",
+        f"{covariate} AS covariate"
+    ])
+
+    return (
+        f"SELECT\n    {select_clause}\n"
+        f"FROM {source_table}\n"
+        f"WHERE {' AND '.join(where_clauses)}\n"
+        f"GROUP BY magnit_id, group_label\n"
+        f"HAVING {' AND '.join(having_conditions)}"
+    )
+
+
+# --- Функция генерации SQL для всех метрик из эксперимента
+
+def build_metric_query(experiment: dict, m: dict, source_table: str):
+    """Поюзерный запрос для одной метрики; None для неподдерживаемого типа"""
+    expressions = build_metric_expressions(m)
+    if expressions is None:
+        return None
+    numerator, denominator, extra_where = expressions
+
+    having_conditions = [h["expression"] for h in experiment.get("filters", {}).get("having", [])]
+    stratum = build_stratum_expression(experiment)
+    if stratum is not None and extra_where:
+        # Страта считается по всем строкам пользователя, как в generate_fused_sql_query:
+        # фильтры метрики уходят в -If, а HAVING считается по строкам под ними (fold_having),
+        # так что выборка та же, что и без страт
+        folded = fold_metric_filters(m, experiment)
+        if folded is not None:
+            numerator, denominator, presence = folded
+            having_conditions = [presence]
+            extra_where = None
+
+    # Комбинируем глобальные WHERE фильтры с индивидуальными фильтрами метрики
+    where_clauses = build_base_where(experiment)
+    if extra_where:
+        where_clauses.append(extra_where)
+
+    base_fields = [
+        f"'{experiment['experiment_name']}' AS exp_name",
+        "magnit_id",
+        build_group_label(experiment),
+        f"'{m['type']}' AS metric_type",
+        f"'{m['name']}' AS metric_name"
+    ]
+    if stratum is not None:
+        base_fields.append(f"{stratum} AS stratum")
+
+    select_clause = ",\n    ".join(base_fields + [f"{numerator} AS numerator", f"{denominator} AS denominator"])
+
+    query = (
+        f"SELECT\n    {select_clause}\n"
+        f"FROM {source_table}\n"
+        f"WHERE {' AND '.join(where_clauses)}\n"
+        f"GROUP BY magnit_id, group_label\n"
+        + (f"HAVING {' AND '.join(having_conditions)}" if having_conditions else "")
+    )
+    return query.strip()
+
+
+@timed()
+def generate_sql_queries_for_metrics(experiment: dict, source_table: str, fused: bool = False,
+                                     output: str = "rows", sample: float = None, preaggregated=None,
+                                     optimize: bool = False, prewhere: bool = True) -> list:
+    """Генерирует SQL для метрик эксперимента: список пар (название, запрос).
+
+    По умолчанию — отдельный запрос на каждую метрику. При fused=True все метрики
+    считаются одним проходом по таблице (см. generate_fused_sql_query); метрики,
+    которые нельзя встроить в общий запрос, возвращаются отдельными запросами.
+
+    output="rows" — строка на пользователя и группу, output="aggregate" — только
+    достаточные статистики по группам (см. wrap_sufficient_statistics).
+
+    Для метрик с опцией bootstrap ({"replicates": B, "seed": 0}) всегда генерируется
+    отдельный запрос с пуассоновским бутстрепом (см. wrap_poisson_bootstrap).
+
+    Квантильные метрики (type: quantile) всегда считаются отдельными запросами по
+    t-digest скетчам (см. build_quantile_sketch_query).
+
+    Метрики с опцией cap_quantile (например, 0.99) винсоризуются в том же запросе
+    (см. cap_metric_query) и всегда возвращаются достаточными статистиками по группам,
+    независимо от output.
+
+    Если у эксперимента задан cuped ({"pre_period_days": N}), basic метрики считаются
+    отдельными запросами с дополнительной колонкой covariate (см. build_cuped_metric_query).
+    Ratio метрики и basic метрики, выражение которых нельзя разделить по периодам,
+    считаются без CUPED — обычными запросами без колонки covariate.
+
+    sample — доля пользователей для быстрой оценки (например, 0.01): детерминированная
+    хэш-выборка по magnit_id (см. sample_condition). Средние и отношения по выборке
+    несмещённые, а их погрешность отражает размер выборки; в режиме aggregate
+    добавляется колонка sample_fraction.
+
+    preaggregated — таблица предагрегатов (preaggregation.PreaggregatedView): метрики,
+    все агрегаты которых в ней есть, считаются отдельными запросами по ней через -Merge.
+
+    Если у эксперимента заданы strata (выражения сегмента пользователя), в поюзерных
+    строках появляется колонка stratum, а достаточные статистики считаются по
+    (страта, группа) в том же проходе — для пост-стратификации в
+    analysis.analyze_stratified. Метрики с bootstrap, квантильные метрики и basic
+    метрики с CUPED считаются без страт; таблица предагрегатов не используется.
+
+    optimize=True прогоняет запросы через sql_optimizer.optimize_query (PREWHERE,
+    hasAny, удаление лишних условий); prewhere=False — без PREWHERE, для табличных функций.
+    """
+    if output not in ("rows", "aggregate"):
+        raise ValueError(f"Неизвестный формат результата: {output}")
+    if sample is not None:
+        sample_condition(sample)  # проверка доли
+        experiment = dict(experiment, sample=sample)
+    fraction = sample_fraction(experiment)
+
+    # В таблице предагрегатов нет колонок страт
+    stratified = build_stratum_expression(experiment) is not None
+    if stratified:
+        preaggregated = None
+
+    def metric_query(m):
+        query = preaggregated.metric_query(experiment, m) if preaggregated is not None else None
+        return query or build_metric_query(experiment, m, source_table)
+
+    regular_metrics = []
+    bootstrap_metrics = []
+    quantile_metrics = []
+    capped_metrics = []
+    cuped_queries = []
+    preaggregated_queries = []
+    for m in experiment["metrics"]:
+        if m["type"] == "quantile":
+            quantile_metrics.append(m)
+            continue
+        if m.get("bootstrap"):
+            bootstrap_metrics.append(m)
+            continue
+        if m.get("cap_quantile"):
+            capped_metrics.append(m)
+            continue
+        query = build_cuped_metric_query(experiment, m, source_table) if experiment.get("cuped") else None
+        if query is not None:
+            cuped_queries.append((m["name"], query))
+        elif preaggregated is not None and preaggregated.covers(experiment, m):
+            preaggregated_queries.append((m["name"], preaggregated.metric_query(experiment, m)))
+        else:
+            regular_metrics.append(m)
+
+    if fused:
+        sql_queries = generate_fused_sql_query(dict(experiment, metrics=regular_metrics), source_table)
+    else:
+        sql_queries = []
+        for m in regular_metrics:
+            query = build_metric_query(experiment, m, source_table)
+            if query is not None:
+                sql_queries.append((m["name"], query))
+    sql_queries += preaggregated_queries
+
+    if output == "aggregate":
+        sql_queries = [(name, wrap_sufficient_statistics(query, fraction=fraction, strata=stratified))
+                       for name, query in sql_queries]
+        cuped_queries = [(name, wrap_sufficient_statistics(query, covariate=True, fraction=fraction))
+                         for name, query in cuped_queries]
+    sql_queries += cuped_queries
+
+    for m in capped_metrics:
+        query = build_cuped_metric_query(experiment, m, source_table) if experiment.get("cuped") else None
+        covariate = query is not None
+        query = query or metric_query(m)
+        if query is None:
+            continue
+        sql_queries.append((m["name"], wrap_sufficient_statistics(
+            cap_metric_query(query, m["cap_quantile"]), covariate, fraction, strata=stratified and not covariate
+        )))
+
+    for m in bootstrap_metrics:
+        query = metric_query(m)
+        if query is None:
+            continue
+        if m.get("cap_quantile"):
+            # Порог считается по исходной выборке и в репликах не пересчитывается
+            query = cap_metric_query(query, m["cap_quantile"])
+        options = m["bootstrap"]
+        sql_queries.append(
+            (m["name"], wrap_poisson_bootstrap(query, int(options.get("replicates", 1000)), int(options.get("seed", 0))))
+        )
+    for m in quantile_metrics:
+        sql_queries.append((m["name"], build_quantile_sketch_query(experiment, m, source_table, output)))
+
+    if optimize:
+        sql_queries = [(name, optimize_query(query, prewhere)) for name, query in sql_queries]
+    return sql_queries
+
+
+def fold_having(experiment: dict, condition: str):
+    """Выражения HAVING эксперимента по строкам под условием condition; None, если их нельзя встроить через -If.
+
+    В отдельном запросе метрики (build_metric_query) фильтры метрики без *If агрегатов
+    попадают в WHERE, и HAVING считается по отфильтрованным строкам. Там, где эти
+    фильтры встраиваются в -If, то же условие встраивается в агрегаты HAVING, чтобы
+    набор пользователей не менялся.
+    """
+    expressions = [h["expression"] for h in experiment.get("filters", {}).get("having", [])]
+    if not condition:
+        return expressions
+    folded = [add_if_combinator(expr, condition) for expr in expressions]
+    return None if any(expr is None for expr in folded) else folded
+
+
+def fold_metric_filters(m: dict, experiment: dict = None):
+    """(numerator, denominator, presence) метрики с фильтрами, встроенными через -If.
+
+    presence — условие наличия у пользователя строк под фильтрами метрики. Если
+    передан experiment, в presence добавляется и его HAVING по тем же строкам
+    (см. fold_having) — тогда внешний HAVING запросу не нужен.
+    Возвращает None, если тип метрики не поддерживается или выражение нельзя
+    встроить (не один вызов агрегатной функции).
+    """
+    expressions = build_metric_expressions(m)
+    if expressions is None:
+        return None
+    numerator, denominator, extra_where = expressions
+    having = fold_having(experiment, extra_where) if experiment is not None else []
+    if having is None:
+        return None
+    if not extra_where:
+        return numerator, denominator, " AND ".join(having) or "1"
+    numerator = add_if_combinator(numerator, extra_where)
+    denominator = "1" if denominator == "1" else add_if_combinator(denominator, extra_where)
+    if numerator is None or denominator is None:
+        return None
+    return numerator, denominator, " AND ".join([f"countIf({extra_where}) > 0"] + having)
+
+
+def needs_folded_having(experiment: dict, metrics: list) -> bool:
+    """Нужен ли HAVING по метрикам: у эксперимента есть HAVING, а у метрик — фильтры, которые уходят в -If"""
+    if not experiment.get("filters", {}).get("having"):
+        return False
+    return any((build_metric_expressions(m) or ("", "", ""))[2] for m in metrics)
+
+
+def generate_fused_sql_query(experiment: dict, source_table: str) -> list:
+    """Один запрос на все метрики эксперимента (один проход по таблице).
+
+    Индивидуальные WHERE фильтры метрик встраиваются в агрегаты через -If
+    комбинаторы. Чтобы набор пользователей совпадал с отдельными запросами,
+    для таких метрик считается флаг наличия строк под фильтром, и пользователь
+    без таких строк в выдачу метрики не попадает. Результат в «длинном» формате
+    с теми же колонками, что и у отдельных запросов. Если у метрик есть такие
+    фильтры, HAVING эксперимента тоже считается для каждой метрики по строкам под
+    её фильтрами и входит во флаг (см. fold_having), как в отдельном запросе;
+    иначе он применяется ко всему запросу.
+    """
+    fused_columns = []
+    metric_tuples = []
+    separate_metrics = []
+    metric_having = needs_folded_having(experiment, experiment["metrics"])
+
+    for m in experiment["metrics"]:
+        if build_metric_expressions(m) is None:
+            continue
+        folded = fold_metric_filters(m, experiment if metric_having else None)
+        if folded is None:
+            # Сложное выражение — считаем отдельным запросом
+            separate_metrics.append(m)
+            continue
+        numerator, denominator, presence = folded
+
+        i = len(metric_tuples)
+        fused_columns += [(numerator, f"num_{i}"), (denominator, f"den_{i}"), (presence, f"has_{i}")]
+        metric_tuples.append(
+            f"('{m['type']}', '{m['name']}', toFloat64(num_{i}), toFloat64(den_{i}), toUInt8(has_{i}))"
+        )
+
+    sql_queries = []
+    if metric_tuples:
+        # Одинаковые агрегаты разных метрик (например, sum(gmv)) считаются один раз
+        shared_columns, expressions = share_common_aggregates([expr for expr, _ in fused_columns])
+        fused_columns = shared_columns + [f"{expr} AS {alias}" for expr, (_, alias) in zip(expressions, fused_columns)]
+        stratum = build_stratum_expression(experiment)
+        if stratum is not None:
+            fused_columns.append(f"{stratum} AS stratum")
+        inner_select = ",\n        ".join(["magnit_id", build_group_label(experiment).replace("\n", "\n        ")] + fused_columns)
+        having_block = "" if metric_having else build_having_block(experiment)
+        metrics_array = ",\n    ".join(metric_tuples)
+        query = (
+            f"SELECT\n"
+            f"    '{experiment['experiment_name']}' AS exp_name,\n"
+            f"    magnit_id,\n"
+            f"    group_label,\n"
+            + ("    stratum,\n" if stratum is not None else "") +
+            f"    m.1 AS metric_type,\n"
+            f"    m.2 AS metric_name,\n"
+            f"    m.3 AS numerator,\n"
+            f"    m.4 AS denominator\n"
+            f"FROM (\n"
+            f"    SELECT\n        {inner_select}\n"
+            f"    FROM {source_table}\n"
+            f"    WHERE {' AND '.join(build_base_where(experiment))}\n"
+            f"    GROUP BY magnit_id, group_label\n"
+            + (f"    {having_block}\n" if having_block else "") +
+            f")\n"
+            f"ARRAY JOIN [\n    {metrics_array}\n] AS m\n"
+            f"WHERE m.5 = 1"
+        )
+        sql_queries.append((experiment["experiment_name"], query))
+
+    for m in separate_metrics:
+        sql_queries.append((m["name"], build_metric_query(experiment, m, source_table)))
+
+    return sql_queries
@@ -0,0 +1,242 @@
+"""Оптимизирующий проход по SQL, который строят sql_generator и shared_scan.
+
+Для каждого WHERE, который фильтрует таблицу (а не подзапрос):
+- OR из has(ab, ...) по одному массиву сворачивается в hasAny(ab, [...]);
+- одинаковые условия и условия, следующие из других (x = 'a' при x IN ('a', 'b'),
+  x > 5 при x > 3), удаляются;
+- условия только по дешёвым и селективным колонкам (PREWHERE_COLUMNS) переносятся
+  в PREWHERE, так что остальные колонки читаются лишь для подходящих строк;
+- в -If агрегатах того же SELECT убираются условия, которые уже гарантирует WHERE:
+  sumIf(gmv, platform = 'ios') при WHERE platform = 'ios' становится sum(gmv).
+
+Проход работает по строкам: генераторы пишут WHERE одной строкой, а колонки
+SELECT — по одной на строку. Всё, что не разбирается expression_parser, остаётся
+как есть. PREWHERE поддерживают только таблицы семейства MergeTree; для
+табличных функций (chdb поверх Parquet) нужен prewhere=False. В блоках с JOIN и
+ARRAY JOIN (общий проход shared_scan) PREWHERE не ставится.
+"""
+import re
+
+from expression_parser import (
+    Array,
+    Binary,
+    Call,
+    Identifier,
+    Literal,
+    Tuple,
+    identifiers,
+    is_if_aggregate,
+    replace_subtrees,
+    to_sql,
+    try_parse,
+)
+
+# Колонки, условия по которым дёшево проверить до чтения остальных колонок
+PREWHERE_COLUMNS = {"event_date", "ab", "magnit_id"}
+
+_WHERE_RE = re.compile(r"^(\s*)WHERE (.+)$")
+_SELECT_ITEM_RE = re.compile(r"^(\s*)(.+) AS (\w+)(,?)$")
+_JOIN_RE = re.compile(r"^\s*(?:\w+ )*JOIN\b")
+_NUMBER_RE = re.compile(r"^-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?$")
+
+
+# --- Условия как список конъюнктов
+
+def conjuncts(node) -> list:
+    if isinstance(node, Binary) and node.op == "AND":
+        return conjuncts(node.left) + conjuncts(node.right)
+    return [node]
+
+
+def _disjuncts(node) -> list:
+    if isinstance(node, Binary) and node.op == "OR":
+        return _disjuncts(node.left) + _disjuncts(node.right)
+    return [node]
+
+
+def join_conjuncts(items: list):
+    node = items[0]
+    for item in items[1:]:
+        node = Binary("AND", node, item)
+    return node
+
+
+def collapse_has(node):
+    """has(ab, 'a') OR has(ab, 'b') OR hasAny(ab, ['c']) -> hasAny(ab, ['a', 'b', 'c'])"""
+    leaves = _disjuncts(node)
+    if len(leaves) < 2:
+        return node
+    array = None
+    values = []
+    for leaf in leaves:
+        if not isinstance(leaf, Call) or len(leaf.args) != 2 or leaf.params is not None:
+            return node
+        if array is not None and leaf.args[0] != array:
+            return node
+        array = leaf.args[0]
+        if leaf.name == "has" and isinstance(leaf.args[1], Literal):
+            values.append(leaf.args[1])
+        elif leaf.name == "hasAny" and isinstance(leaf.args[1], Array) \
+                and all(isinstance(v, Literal) for v in leaf.args[1].items):
+            values += leaf.args[1].items
+        else:
+            return node
+    return Call("hasAny", (array, Array(tuple(dict.fromkeys(values)))))
+
+
+# --- Следование одного условия из другого
+
+def _value_set(node):
+    """(колонка, множество литералов) для x = v и x IN (v1, v2); иначе None"""
+    if not isinstance(node, Binary) or not isinstance(node.left, Identifier):
+        return None
+    if node.op == "=" and isinstance(node.right, Literal):
+        return node.left, {node.right.value}
+    if node.op == "IN" and isinstance(node.right, Tuple) and all(isinstance(v, Literal) for v in node.right.items):
+        return node.left, {v.value for v in node.right.items}
+    return None
+
+
+def _bound(node):
+    """(колонка, оператор, число) для x > 5, x <= 3.5, x = 2; иначе None"""
+    if not isinstance(node, Binary) or not isinstance(node.left, Identifier) \
+            or not isinstance(node.right, Literal) or not _NUMBER_RE.match(node.right.value):
+        return None
+    if node.op not in (">", ">=", "<", "<=", "="):
+        return None
+    return node.left, node.op, float(node.right.value)
+
+
+def _bound_implies(a, b) -> bool:
+    _, a_op, a_value = a
+    _, b_op, b_value = b
+    if b_op in (">", ">="):
+        if a_op not in (">", ">=", "="):
+            return False
+        return a_value > b_value or (a_value == b_value and (b_op == ">=" or a_op == ">"))
+    if b_op in ("<", "<="):
+        if a_op not in ("<", "<=", "="):
+            return False
+        return a_value < b_value or (a_value == b_value and (b_op == "<=" or a_op == "<"))
+    return a_op == "=" and a_value == b_value
+
+
+def implies(a, b) -> bool:
+    """Следует ли условие b из условия a (консервативно: False, если не уверены)"""
+    if a == b:
+        return True
+    a_set, b_set = _value_set(a), _value_set(b)
+    if a_set and b_set and a_set[0] == b_set[0]:
+        return a_set[1] <= b_set[1]
+    a_bound, b_bound = _bound(a), _bound(b)
+    if a_bound and b_bound and a_bound[0] == b_bound[0]:
+        return _bound_implies(a_bound, b_bound)
+    return False
+
+
+def remove_redundant(items: list) -> list:
+    """Убирает повторы и условия, следующие из других условий списка"""
+    kept = []
+    for i, item in enumerate(items):
+        redundant = False
+        for j, other in enumerate(items):
+            if i == j or not implies(other, item):
+                continue
+            # Из равносильных условий оставляем первое
+            if implies(item, other) and j > i:
+                continue
+            redundant = True
+            break
+        if not redundant:
+            kept.append(item)
+    return kept
+
+
+def optimize_condition(node) -> list:
+    """Конъюнкты условия после свёртки has и удаления лишних условий"""
+    return remove_redundant([collapse_has(c) for c in conjuncts(node)])
+
+
+def split_prewhere(items: list, prewhere_columns: set = PREWHERE_COLUMNS):
+    """(prewhere, where): в PREWHERE — условия только по prewhere_columns"""
+    prewhere = [c for c in items if identifiers(c) and identifiers(c) <= prewhere_columns]
+    where = [c for c in items if c not in prewhere]
+    return prewhere, where
+
+
+# --- -If агрегаты под уже гарантированными условиями
+
+def drop_implied_if_conditions(node, guaranteed: list):
+    """Убирает из -If агрегатов условия, которые следуют из guaranteed; пустое условие снимает -If"""
+    replacements = {}
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, Call) and is_if_aggregate(current) and current.args:
+            *args, condition = current.args
+            remaining = [c for c in conjuncts(condition) if not any(implies(g, c) for g in guaranteed)]
+            if len(remaining) < len(conjuncts(condition)):
+                if remaining:
+                    replacements[current] = Call(current.name, tuple(args) + (join_conjuncts(remaining),), current.params)
+                else:
+                    replacements[current] = Call(current.name[:-2], tuple(args), current.params)
+            continue
+        if isinstance(current, (Call, Binary)):
+            stack += list(current.args) if isinstance(current, Call) else [current.left, current.right]
+    return replace_subtrees(node, replacements) if replacements else node
+
+
+# --- Проход по тексту запроса
+
+def _table_scope(lines: list, where_index: int, indent: str):
+    """(индекс SELECT, индекс FROM) блока WHERE, если FROM читает таблицу; иначе None"""
+    from_index = None
+    for i in range(where_index - 1, -1, -1):
+        line = lines[i]
+        if from_index is None and line.startswith(indent + "FROM "):
+            if line[len(indent) + 5:].strip() == "(":
+                return None
+            from_index = i
+        elif from_index is not None and line.startswith(indent + "SELECT"):
+            return i, from_index
+    return None
+
+
+def _optimize_select_items(lines: list, select_index: int, from_index: int, indent: str, guaranteed: list):
+    item_indent = indent + "    "
+    for i in range(select_index + 1, from_index):
+        m = _SELECT_ITEM_RE.match(lines[i])
+        if not m or m.group(1) != item_indent:
+            continue
+        node = try_parse(m.group(2))
+        if node is None:
+            continue
+        optimized = drop_implied_if_conditions(node, guaranteed)
+        if optimized != node:
+            lines[i] = f"{item_indent}{to_sql(optimized)} AS {m.group(3)}{m.group(4)}"
+
+
+def optimize_query(sql: str, prewhere: bool = True) -> str:
+    """Применяет оптимизации ко всем WHERE по таблицам в запросе"""
+    lines = sql.split("\n")
+    result = []
+    for line in lines:
+        m = _WHERE_RE.match(line)
+        # Уже обработанные строки берём из result: в них учтены вставленные PREWHERE
+        scope = _table_scope(result, len(result), m.group(1)) if m else None
+        node = try_parse(m.group(2)) if scope else None
+        if node is None:
+            result.append(line)
+            continue
+        indent = m.group(1)
+        items = optimize_condition(node)
+        _optimize_select_items(result, scope[0], scope[1], indent, items)
+        where = items
+        joined = any(_JOIN_RE.match(l) for l in result[scope[1] + 1:])
+        if prewhere and not joined:
+            prewhere_items, where = split_prewhere(items)
+            if prewhere_items:
+                result.append(f"{indent}PREWHERE {to_sql(join_conjuncts(prewhere_items))}")
+        if where:
+            result.append(f"{indent}WHERE {to_sql(join_conjuncts(where))}")
+    return "\n".join(result)
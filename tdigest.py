@@ -0,0 +1,86 @@
+"""t-digest скетчи ClickHouse (quantileTDigestState) на стороне Python.
+
+Квантильные метрики (type: quantile) возвращают из ClickHouse не значения
+пользователей, а скетчи по (группа, день, реплика бутстрепа) в hex. Здесь они
+декодируются, сливаются по дням и превращаются в квантили — так же, как это
+делает quantileTDigestMerge, но без повторного запроса к кластеру.
+
+Формат состояния ClickHouse: varuint число центроидов, затем пары
+(mean Float32, count Float32). Интерполяция повторяет QuantileTDigest.
+"""
+import numpy as np
+
+
+def decode_sketch(sketch):
+    """(means, counts) центроидов из состояния quantileTDigestState (bytes или hex-строка)"""
+    data = bytes.fromhex(sketch) if isinstance(sketch, str) else bytes(sketch)
+    size = 0
+    shift = 0
+    pos = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    pairs = np.frombuffer(data, dtype="<f4", count=2 * size, offset=pos).reshape(size, 2)
+    return pairs[:, 0].astype(np.float64), pairs[:, 1].astype(np.float64)
+
+
+def sketch_quantiles(key_codes, means, counts, levels, size: int = None):
+    """Квантили по группам центроидов: levels[k] для центроидов с key_codes == k.
+
+    Центроиды одного ключа считаются одним скетчем: слияние без сжатия, поэтому
+    квантили слитых скетчей чуть точнее quantileTDigestMerge. Интерполяция как
+    в QuantileTDigest::getImpl; все ключи обрабатываются одной сортировкой.
+    Для ключа без центроидов — NaN.
+    """
+    key_codes = np.asarray(key_codes, dtype=np.int64)
+    means = np.asarray(means, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    size = len(levels) if size is None else size
+
+    order = np.lexsort((means, key_codes))
+    key_codes, means, counts = key_codes[order], means[order], counts[order]
+    seg_end = np.searchsorted(key_codes, np.arange(size), side="right")
+    seg_start = np.searchsorted(key_codes, np.arange(size), side="left")
+    totals = np.bincount(key_codes, weights=counts, minlength=size)
+
+    # Позиция центра центроида: накопленный вес ключа до него + половина его веса
+    cumulative = np.cumsum(counts) - counts
+    cumulative -= np.concatenate([[0.0], np.cumsum(totals)[:-1]])[key_codes]
+    position = cumulative + counts * 0.5
+    target = levels * totals
+
+    # Первый центроид ключа с позицией >= target: запросы сортируются перед центроидами
+    all_keys = np.concatenate([key_codes, np.arange(size)])
+    all_positions = np.concatenate([position, target])
+    kinds = np.concatenate([np.ones(len(key_codes), dtype=np.int64), np.zeros(size, dtype=np.int64)])
+    merged = np.lexsort((kinds, all_positions, all_keys))
+    before = np.cumsum(kinds[merged])
+    index = np.empty(size, dtype=np.int64)
+    query_pos = np.flatnonzero(kinds[merged] == 0)
+    index[all_keys[merged[query_pos]]] = before[query_pos]
+
+    result = np.full(size, np.nan)
+    non_empty = seg_end > seg_start
+    last = np.maximum(seg_end - 1, 0)
+    beyond = non_empty & (index >= seg_end)
+    result[beyond] = means[last[beyond]]
+
+    inside = non_empty & ~beyond
+    i = index[inside]
+    first = i == seg_start[inside]
+    prev = np.where(first, i, i - 1)
+    prev_x = np.where(first, 0.0, position[prev])
+    left = prev_x + 0.5 * (counts[prev] == 1)
+    right = position[i] - 0.5 * (counts[i] == 1)
+    x = target[inside]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        interpolated = means[prev] + (x - left) / (right - left) * (means[i] - means[prev])
+    result[inside] = np.where(x <= left, means[prev], np.where(x >= right, means[i], interpolated))
+    single = non_empty & (seg_end - seg_start == 1)
+    result[single] = means[seg_start[single]]
+    return result
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def synthetic_parquet(tmp_path_factory):
+    """Parquet с небольшой синтетической таблицей (см. benchmark.generate_synthetic_data)"""
+    pytest.importorskip("chdb")
+    from benchmark import generate_synthetic_data
+
+    return generate_synthetic_data(users=3000, days=14, experiments=1, data_dir=str(tmp_path_factory.mktemp("data")))
+
+
+@pytest.fixture(scope="session")
+def chdb_executor(synthetic_parquet):
+    """ChdbExecutor поверх synthetic_parquet"""
+    from batch_runner import ChdbExecutor
+
+    return ChdbExecutor(synthetic_parquet)
+
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+
+@pytest.fixture
+def golden():
+    """Сравнение текста с tests/golden/<name>; UPDATE_GOLDEN=1 перезаписывает эталон"""
+    def check(name: str, text: str):
+        path = os.path.join(GOLDEN_DIR, name)
+        if os.getenv("UPDATE_GOLDEN"):
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        with open(path, "r", encoding="utf-8") as f:
+            assert text == f.read()
+    return check
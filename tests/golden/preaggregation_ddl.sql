@@ -0,0 +1,47 @@
+CREATE TABLE IF NOT EXISTS ft_pa_prod.delivery_abtest_preagg
+(
+    event_date Date,
+    magnit_id UInt64,
+    ab Array(String),
+    a_8b590e93b0cd AggregateFunction(sum, Float64),
+    a_6847f853e67f AggregateFunction(sum, Float64),
+    a_96af9569e1e1 AggregateFunction(sumIf, Float64, UInt8),
+    a_5d122e372be1 AggregateFunction(countIf, UInt8),
+    a_8edef75d83eb AggregateFunction(sumIf, Float64, UInt8),
+    a_13ea94cb16f8 AggregateFunction(countIf, UInt8),
+    a_a85fdb532a63 AggregateFunction(uniq, String)
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(event_date)
+ORDER BY (event_date, magnit_id, ab);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS ft_pa_prod.delivery_abtest_preagg_mv TO ft_pa_prod.delivery_abtest_preagg AS
+SELECT
+    event_date,
+    magnit_id,
+    ab,
+    sumState(toFloat64(gmv)) AS a_8b590e93b0cd,
+    sumState(toFloat64(orders_cnt)) AS a_6847f853e67f,
+    sumIfState(toFloat64(gmv), toUInt8(purhase_flg = 1)) AS a_96af9569e1e1,
+    countIfState(toUInt8(purhase_flg = 1)) AS a_5d122e372be1,
+    sumIfState(toFloat64(items_cnt), toUInt8(orders_cnt > 0)) AS a_8edef75d83eb,
+    countIfState(toUInt8(orders_cnt > 0)) AS a_13ea94cb16f8,
+    uniqState(toString(event_date)) AS a_a85fdb532a63
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+GROUP BY event_date, magnit_id, ab;
+
+INSERT INTO ft_pa_prod.delivery_abtest_preagg
+SELECT
+    event_date,
+    magnit_id,
+    ab,
+    sumState(toFloat64(gmv)) AS a_8b590e93b0cd,
+    sumState(toFloat64(orders_cnt)) AS a_6847f853e67f,
+    sumIfState(toFloat64(gmv), toUInt8(purhase_flg = 1)) AS a_96af9569e1e1,
+    countIfState(toUInt8(purhase_flg = 1)) AS a_5d122e372be1,
+    sumIfState(toFloat64(items_cnt), toUInt8(orders_cnt > 0)) AS a_8edef75d83eb,
+    countIfState(toUInt8(orders_cnt > 0)) AS a_13ea94cb16f8,
+    uniqState(toString(event_date)) AS a_a85fdb532a63
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-31'
+GROUP BY event_date, magnit_id, ab;
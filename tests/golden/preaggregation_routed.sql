@@ -0,0 +1,102 @@
+-- purchase_gmv
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'basic' AS metric_type,
+    'purchase_gmv' AS metric_name,
+    sum(gmv) AS numerator,
+    1 AS denominator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t']) AND purhase_flg = 1
+GROUP BY magnit_id, group_label
+HAVING sum(orders_cnt) > 0;
+
+-- max_order
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'basic' AS metric_type,
+    'max_order' AS metric_name,
+    quantile(0.9)(gmv) AS numerator,
+    1 AS denominator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+GROUP BY magnit_id, group_label
+HAVING sum(orders_cnt) > 0;
+
+-- gmv
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'basic' AS metric_type,
+    'gmv' AS metric_name,
+    sumMerge(a_8b590e93b0cd) AS numerator,
+    1 AS denominator
+FROM ft_pa_prod.delivery_abtest_preagg
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+GROUP BY magnit_id, group_label
+HAVING sumMerge(a_6847f853e67f) > 0;
+
+-- aov
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'ratio' AS metric_type,
+    'aov' AS metric_name,
+    sumMerge(a_8b590e93b0cd) AS numerator,
+    sumMerge(a_6847f853e67f) AS denominator
+FROM ft_pa_prod.delivery_abtest_preagg
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+GROUP BY magnit_id, group_label
+HAVING sumMerge(a_6847f853e67f) > 0;
+
+-- items_per_order
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'ratio' AS metric_type,
+    'items_per_order' AS metric_name,
+    sumIfMerge(a_8edef75d83eb) AS numerator,
+    countIfMerge(a_13ea94cb16f8) AS denominator
+FROM ft_pa_prod.delivery_abtest_preagg
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+GROUP BY magnit_id, group_label
+HAVING sumMerge(a_6847f853e67f) > 0;
+
+-- active_days
+SELECT
+    'exp0' AS exp_name,
+    magnit_id,
+    CASE
+    WHEN has(ab, 'exp0_c') THEN 'control'
+    WHEN has(ab, 'exp0_t') THEN 'test'
+END AS group_label,
+    'basic' AS metric_type,
+    'active_days' AS metric_name,
+    uniqMerge(a_a85fdb532a63) AS numerator,
+    1 AS denominator
+FROM ft_pa_prod.delivery_abtest_preagg
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+GROUP BY magnit_id, group_label
+HAVING sumMerge(a_6847f853e67f) > 0;
+
@@ -0,0 +1,15 @@
+-- before
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE (has(ab, 'exp0_c') OR has(segments, 'new')) AND (has(ab, 'exp0_t') OR has(ab, city))
+GROUP BY magnit_id
+
+-- after
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE (has(ab, 'exp0_c') OR has(segments, 'new')) AND (has(ab, 'exp0_t') OR has(ab, city))
+GROUP BY magnit_id
@@ -0,0 +1,16 @@
+-- before
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE (has(ab, 'exp0_c') OR has(ab, 'exp0_t') OR hasAny(ab, ['exp0_b'])) AND platform = 'ios'
+GROUP BY magnit_id
+
+-- after
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+PREWHERE hasAny(ab, ['exp0_c', 'exp0_t', 'exp0_b'])
+WHERE platform = 'ios'
+GROUP BY magnit_id
@@ -0,0 +1,16 @@
+-- before
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t']) AND platform = 'ios'
+GROUP BY magnit_id
+
+-- after
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+PREWHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t'])
+WHERE platform = 'ios'
+GROUP BY magnit_id
@@ -0,0 +1,15 @@
+-- before
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE (event_date = '2024-01-01' OR platform = 'ios') AND toFloat64(gmv) > 0
+GROUP BY magnit_id
+
+-- after
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE (event_date = '2024-01-01' OR platform = 'ios') AND toFloat64(gmv) > 0
+GROUP BY magnit_id
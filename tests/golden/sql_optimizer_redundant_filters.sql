@@ -0,0 +1,21 @@
+-- before
+SELECT
+    magnit_id,
+    sumIf(gmv, platform = 'ios') AS numerator,
+    countIf(orders_cnt > 5 AND purhase_flg = 1) AS denominator,
+    sumIf(gmv, orders_cnt >= 6) AS capped
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE platform IN ('ios', 'android') AND platform = 'ios' AND orders_cnt > 3 AND orders_cnt > 5 AND platform = 'ios'
+GROUP BY magnit_id
+HAVING sumIf(gmv, platform = 'ios') > 0 AND countIf(orders_cnt > 5) > 0
+
+-- after
+SELECT
+    magnit_id,
+    sum(gmv) AS numerator,
+    countIf(purhase_flg = 1) AS denominator,
+    sumIf(gmv, orders_cnt >= 6) AS capped
+FROM ft_pa_prod.delivery_abtest_metrics_daily
+WHERE platform = 'ios' AND orders_cnt > 5
+GROUP BY magnit_id
+HAVING sumIf(gmv, platform = 'ios') > 0 AND countIf(orders_cnt > 5) > 0
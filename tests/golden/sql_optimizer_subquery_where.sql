@@ -0,0 +1,27 @@
+-- before
+SELECT
+    magnit_id,
+    numerator
+FROM (
+    SELECT
+        magnit_id,
+        sum(gmv) AS numerator
+    FROM ft_pa_prod.delivery_abtest_metrics_daily
+    WHERE event_date = '2024-01-01' AND event_date = '2024-01-01'
+    GROUP BY magnit_id
+)
+WHERE numerator > 0 AND numerator > 0
+
+-- after
+SELECT
+    magnit_id,
+    numerator
+FROM (
+    SELECT
+        magnit_id,
+        sum(gmv) AS numerator
+    FROM ft_pa_prod.delivery_abtest_metrics_daily
+    PREWHERE event_date = '2024-01-01'
+    GROUP BY magnit_id
+)
+WHERE numerator > 0 AND numerator > 0
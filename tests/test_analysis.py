@@ -0,0 +1,174 @@
+import numpy as np
+import pytest
+
+from analysis import adjust_p_values, analyze_rows, sufficient_statistics_from_rows
+
+P_VALUES = [0.8, 0.9, 0.95, 0.001, 0.002, 0.003, 0.04, np.nan, 0.01, 0.03]
+FAMILIES = ["A", "A", "A", "B", "B", "B", "C", "C", "C", "C"]
+
+
+@pytest.mark.parametrize("method", ["holm", "bh", "bonferroni"])
+def test_families_are_adjusted_independently(method):
+    p = np.array(P_VALUES)
+    families = np.array(FAMILIES)
+    adjusted = adjust_p_values(p, families, method)
+    for family in dict.fromkeys(FAMILIES):
+        mask = families == family
+        np.testing.assert_allclose(adjusted[mask], adjust_p_values(p[mask], families[mask], method))
+
+
+def test_holm_does_not_leak_between_families():
+    adjusted = adjust_p_values([0.8, 0.9, 0.95, 0.001, 0.002, 0.003], ["A"] * 3 + ["B"] * 3, "holm")
+    np.testing.assert_allclose(adjusted, [1, 1, 1, 0.003, 0.004, 0.004])
+
+
+def test_single_family_reference_values():
+    p = [0.01, 0.04, 0.03, 0.005]
+    np.testing.assert_allclose(adjust_p_values(p, ["A"] * 4, "holm"), [0.03, 0.06, 0.06, 0.02])
+    np.testing.assert_allclose(adjust_p_values(p, ["A"] * 4, "bh"), [0.02, 0.04, 0.04, 0.02])
+    np.testing.assert_allclose(adjust_p_values(p, ["A"] * 4, "bonferroni"), [0.04, 0.16, 0.12, 0.02])
+
+
+def _rows(users=5000, seed=0):
+    """Поюзерные строки трёх метрик блоками по метрике, группы вперемешку, с NULL в части строк"""
+    rng = np.random.default_rng(seed)
+    metrics = [("gmv", "basic"), ("orders", "basic"), ("aov", "ratio")]
+    group = np.where(rng.random(users) < 0.5, "control", "test")
+    columns = {"exp_name": [], "metric_type": [], "metric_name": [], "group_label": [],
+               "numerator": [], "denominator": []}
+    for name, kind in metrics:
+        numerator = rng.gamma(2.0, 50.0, users) * np.where(group == "test", 1.05, 1.0)
+        numerator[rng.random(users) < 0.01] = np.nan
+        columns["exp_name"] += ["exp0"] * users
+        columns["metric_type"] += [kind] * users
+        columns["metric_name"] += [name] * users
+        columns["group_label"] += list(group)
+        columns["numerator"] += list(numerator)
+        columns["denominator"] += list(rng.integers(1, 5, users) if kind == "ratio" else np.ones(users))
+    return {key: np.array(values, dtype=object if key not in ("numerator", "denominator") else np.float64)
+            for key, values in columns.items()}
+
+
+def _reference(rows, name):
+    """Welch t / дельта-метод для одной метрики по её строкам без векторизации по метрикам"""
+    estimates = {}
+    for label in ("control", "test"):
+        mask = (rows["metric_name"] == name) & (rows["group_label"] == label) & np.isfinite(rows["numerator"])
+        x, y = rows["numerator"][mask], rows["denominator"][mask]
+        ratio = x.mean() / y.mean()
+        covariance = np.cov(x, y)
+        variance = (covariance[0, 0] - 2 * ratio * covariance[0, 1] + ratio ** 2 * covariance[1, 1]) / (
+            y.mean() ** 2 * len(x))
+        estimates[label] = (ratio, variance)
+    diff = estimates["test"][0] - estimates["control"][0]
+    return estimates["control"][0], diff, diff / np.sqrt(estimates["control"][1] + estimates["test"][1])
+
+
+def test_rows_match_per_metric_reference():
+    rows = _rows()
+    result = analyze_rows(rows)
+    for i, name in enumerate(result["metric_name"]):
+        control, diff, statistic = _reference(rows, name)
+        assert result["control"][i] == pytest.approx(control)
+        assert result["diff"][i] == pytest.approx(diff)
+        assert result["statistic"][i] == pytest.approx(statistic)
+
+
+def test_key_columns_as_lists_objects_and_categoricals_agree():
+    rows = _rows(users=3000, seed=1)
+    expected = sufficient_statistics_from_rows(rows)
+    variants = [{k: list(v) for k, v in rows.items()}]
+    pd = pytest.importorskip("pandas")
+    variants.append({k: pd.Series(v, dtype="category") if v.dtype == object else v for k, v in rows.items()})
+    for variant in variants:
+        stats = sufficient_statistics_from_rows(variant)
+        order = {key: i for i, key in enumerate(zip(stats["metric_name"], stats["group_label"]))}
+        index = [order[key] for key in zip(expected["metric_name"], expected["group_label"])]
+        for column in ("n", "sum_x", "sum_x2", "sum_y", "sum_xy"):
+            np.testing.assert_allclose(np.asarray(stats[column])[index], expected[column])
+
+
+def _chunks(columns, sizes):
+    start = 0
+    for size in sizes:
+        yield {key: values[start:start + size] for key, values in columns.items()}
+        start += size
+
+
+def _assert_same_statistics(actual, expected, columns=("n", "sum_x", "sum_x2", "sum_y", "sum_y2", "sum_xy")):
+    order = {key: i for i, key in enumerate(zip(actual["metric_name"], actual["group_label"]))}
+    assert len(order) == len(expected["n"])
+    index = [order[key] for key in zip(expected["metric_name"], expected["group_label"])]
+    for column in columns:
+        np.testing.assert_allclose(np.asarray(actual[column], dtype=np.float64)[index], expected[column], rtol=1e-9)
+
+
+def test_online_statistics_match_batch_for_any_chunking():
+    from analysis import OnlineStatistics
+
+    rows = _rows(users=4000, seed=2)
+    rng = np.random.default_rng(2)
+    rows["covariate"] = np.where(rng.random(len(rows["numerator"])) < 0.1, np.nan, rng.gamma(2.0, 40.0, len(rows["numerator"])))
+    expected = sufficient_statistics_from_rows(rows)
+    total = len(rows["numerator"])
+    pd = pytest.importorskip("pandas")
+    categorical = {k: pd.Series(v, dtype="category") if v.dtype == object else v for k, v in rows.items()}
+    for columns, sizes in [
+        (rows, [total]),
+        (rows, [1, 0, 999, 5000, total]),
+        (categorical, [333] * (total // 333 + 1)),
+    ]:
+        statistics = OnlineStatistics()
+        for chunk in _chunks(columns, sizes):
+            # Срез pandas.Series сохраняет исходный индекс — update не должен на него опираться
+            statistics.update(chunk)
+        _assert_same_statistics(statistics.result(), expected, ("n", "sum_x", "sum_x2", "sum_y", "sum_y2", "sum_xy",
+                                                                "sum_c", "sum_c2", "sum_xc"))
+
+
+def test_online_statistics_keep_precision_for_large_means():
+    from analysis import OnlineStatistics
+
+    rng = np.random.default_rng(3)
+    x = 1e6 + rng.normal(0, 1, 20000)
+    rows = {"exp_name": ["exp0"] * len(x), "metric_type": ["basic"] * len(x), "metric_name": ["m"] * len(x),
+            "group_label": ["control"] * len(x), "numerator": x, "denominator": np.ones(len(x))}
+    statistics = OnlineStatistics()
+    for chunk in _chunks(rows, [1000] * 20):
+        statistics.update(chunk)
+    variance = statistics._m2[0, statistics._X] / (len(x) - 1)
+    assert variance == pytest.approx(np.var(x, ddof=1), rel=1e-9)
+
+
+def test_stream_statistics_match_rows_through_chdb(chdb_executor):
+    from batch_runner import stream_statistics
+    from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+    experiment = {
+        "experiment_name": "exp0", "control_group_id": "exp0_c", "test_group_id": "exp0_t",
+        "start_date": "2024-01-08", "end_date": "2024-01-14", "cuped": {"pre_period_days": 7},
+        "filters": {"where": [], "having": []},
+        "metrics": [
+            {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+            {"name": "aov", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)"},
+            {"name": "gmv_boot", "type": "basic", "expression": "sum(gmv)", "bootstrap": {"replicates": 3}},
+        ],
+    }
+    with_covariate = set()
+    for name, sql in generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, fused=True):
+        rows = chdb_executor(sql)
+        streamed = stream_statistics(chdb_executor, sql, chunk_rows=257)
+        if "numerator" not in rows[0]:
+            # Бутстреп уже агрегирован в SQL и проходит без изменений
+            key = lambda row: (row["group_label"], int(row["replicate"]))
+            assert sorted(map(key, streamed)) == sorted(map(key, rows))
+            continue
+        columns = {key: np.array([row[key] for row in rows]) for key in rows[0]}
+        expected = sufficient_statistics_from_rows(columns)
+        actual = {key: np.array([row[key] for row in streamed]) for key in streamed[0]}
+        statistics = [column for column in expected if column.startswith("sum_") or column == "n"]
+        assert sorted(statistics) == sorted(column for column in actual if column.startswith("sum_") or column == "n")
+        _assert_same_statistics(actual, expected, statistics)
+        if "sum_c" in expected:
+            with_covariate.add(name)
+    assert with_covariate == {"gmv"}
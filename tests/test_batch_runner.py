@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+
+import pytest
+import yaml
+
+import batch_runner
+from batch_runner import JsonlSink, MemorySink, plan_queries, run_batch
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+
+def _experiment(name, metrics=2):
+    return {
+        "experiment_name": name,
+        "control_group_id": "exp0_c",
+        "test_group_id": "exp0_t",
+        "start_date": "2024-01-01",
+        "end_date": "2024-01-14",
+        "filters": {"where": [], "having": []},
+        "metrics": [{"name": f"m{i}", "type": "basic", "expression": f"sum(gmv) * {i + 1}"} for i in range(metrics)],
+    }
+
+
+CONFIG = {"experiments": [_experiment("a", 3), _experiment("b", 1)]}
+
+
+def test_plan_interleaves_experiments():
+    tasks = plan_queries(CONFIG)
+    assert [(experiment, query) for experiment, query, _, _ in tasks] == [
+        ("a", "m0"), ("b", "m0"), ("a", "m1"), ("a", "m2"),
+    ]
+
+
+class FlakyExecutor:
+    """Падает failures раз на каждом запросе, затем отдаёт одну строку; считает одновременные запросы"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.attempts = {}
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, sql):
+        with self.lock:
+            self.attempts[sql] = self.attempts.get(sql, 0) + 1
+            attempt = self.attempts[sql]
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(0.01)
+            if attempt <= self.failures:
+                raise RuntimeError("timeout")
+            return [{"exp_name": "x", "value": attempt}]
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_retries_then_succeeds_within_per_experiment_limit():
+    execute = FlakyExecutor(failures=1)
+    sink = MemorySink()
+    summary = run_batch({"experiments": [_experiment("a", 6)]}, execute, [sink], max_workers=8,
+                        per_experiment_limit=2, retries=2, retry_backoff=0)
+    assert {s["status"] for s in summary} == {"ok"}
+    assert {s["attempts"] for s in summary} == {2}
+    assert execute.peak <= 2
+    assert sorted(sink.results["a"]) == [f"m{i}" for i in range(6)]
+
+
+def test_reports_error_after_retries():
+    summary = run_batch(CONFIG, FlakyExecutor(failures=5), [MemorySink()], retries=1, retry_backoff=0)
+    assert {s["status"] for s in summary} == {"error"}
+    assert {s["attempts"] for s in summary} == {2}
+    assert all(s["error"] == "timeout" for s in summary)
+
+
+def test_batch_results_match_direct_queries(chdb_executor, tmp_path):
+    sink = MemorySink()
+    summary = run_batch(CONFIG, chdb_executor, [sink, JsonlSink(str(tmp_path))], output="aggregate")
+    assert {s["status"] for s in summary} == {"ok"}
+    for experiment in CONFIG["experiments"]:
+        for name, sql in generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, output="aggregate"):
+            assert sink.results[experiment["experiment_name"]][name] == chdb_executor(sql)
+    lines = (tmp_path / "a" / "m0.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == sink.results["a"]["m0"]
+
+
+def test_stream_gives_same_statistics_as_aggregate(chdb_executor):
+    aggregate, streamed = MemorySink(), MemorySink()
+    run_batch(CONFIG, chdb_executor, [aggregate], output="aggregate")
+    run_batch(CONFIG, chdb_executor, [streamed], output="rows", stream=True, chunk_rows=500)
+    for experiment, queries in aggregate.results.items():
+        for name, rows in queries.items():
+            actual = {row["group_label"]: row for row in streamed.results[experiment][name]}
+            assert len(actual) == len(rows) == 2
+            for expected in rows:
+                row = actual[expected["group_label"]]
+                assert float(row["n"]) == float(expected["n"])
+                assert float(row["sum_x"]) == pytest.approx(float(expected["sum_x"]))
+                assert float(row["sum_x2"]) == pytest.approx(float(expected["sum_x2"]))
+
+
+def test_cli_runs_local_config(synthetic_parquet, tmp_path, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text(yaml.dump(CONFIG), encoding="utf-8")
+    output_dir = tmp_path / "results"
+    code = batch_runner.main(["--config", str(config), "--executor", "chdb", "--parquet", synthetic_parquet,
+                              "--experiment", "b", "--output-dir", str(output_dir)])
+    assert code == 0
+    assert "1 из 1" in capsys.readouterr().out
+    assert (output_dir / "b" / "m0.jsonl").exists()
+    assert not (output_dir / "a").exists()
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import benchmark
+from benchmark import (
+    VARIANTS,
+    find_regressions,
+    generate_synthetic_data,
+    run_benchmark,
+    synthetic_config,
+)
+
+
+def test_synthetic_data_is_deterministic_with_stable_assignment(synthetic_parquet, tmp_path, chdb_executor):
+    table = f"file('{synthetic_parquet}', Parquet)"
+    (summary,) = chdb_executor(
+        f"SELECT count() AS rows, uniqExact(magnit_id) AS users, uniqExact(event_date) AS days, "
+        f"min(event_date) AS first_day, max(length(ab)) AS experiments FROM {table}"
+    )
+    assert summary["days"] == 14 and summary["first_day"] == "2024-01-01"
+    assert summary["experiments"] == 1
+    assert 0.25 < int(summary["rows"]) / (3000 * 14) < 0.35
+    # Группа пользователя не меняется по дням, группы примерно равны
+    (groups,) = chdb_executor(
+        f"SELECT max(user_groups) AS max_groups, countIf(user_ab = ['exp0_c']) / count() AS control_share "
+        f"FROM (SELECT any(ab) AS user_ab, uniqExact(ab) AS user_groups FROM {table} GROUP BY magnit_id)"
+    )
+    assert groups["max_groups"] == 1
+    assert 0.45 < groups["control_share"] < 0.55
+
+    copy = generate_synthetic_data(users=3000, days=14, experiments=1, data_dir=str(tmp_path))
+    checksum = "SELECT sum(cityHash64(magnit_id, event_date, gmv, orders_cnt)) AS h FROM file('{}', Parquet)"
+    assert chdb_executor(checksum.format(copy)) == chdb_executor(checksum.format(synthetic_parquet))
+
+
+def test_synthetic_config_is_valid():
+    from experiment_io import validate_experiments
+
+    config = synthetic_config(experiments=2, metrics=6, days=7)
+    assert [e["experiment_name"] for e in config["experiments"]] == ["bench_0", "bench_1"]
+    assert [m["type"] for m in config["experiments"][0]["metrics"]] == ["basic", "ratio", "basic"] * 2
+    assert config["experiments"][1]["end_date"] == "2024-01-07"
+    assert validate_experiments(config["experiments"]) == {}
+
+
+def test_run_benchmark_variants_agree(tmp_path):
+    pytest.importorskip("chdb")
+    results = run_benchmark(users=400, days=3, experiments=2, metrics=3, outputs=["rows", "aggregate"],
+                            repeat=1, data_dir=str(tmp_path))
+    assert [r["stage"] for r in results[:1]] == ["data"]
+    stages = {(r["stage"], r["variant"], r["output"]) for r in results[1:]}
+    assert stages == {(stage, variant, output) for stage in ("generate", "execute", "analyze")
+                      for variant in VARIANTS for output in ("rows", "aggregate")}
+    rows = {(r["variant"], r["output"]): r["rows"] for r in results if r["stage"] == "execute"}
+    for output in ("rows", "aggregate"):
+        assert len({rows[(variant, output)] for variant in VARIANTS}) == 1
+    # 2 эксперимента × 3 метрики × 2 группы
+    assert rows[("separate", "aggregate")] == 12
+    assert all(r["seconds"] >= 0 for r in results)
+
+
+def _result(seconds, stage="execute", variant="fused"):
+    return {"stage": stage, "variant": variant, "output": "aggregate", "users": 10, "days": 1, "experiments": 1,
+            "metrics": 1, "seconds": seconds}
+
+
+def test_find_regressions_compares_with_latest_matching_run():
+    history = [{"commit": "old", "results": [_result(0.1)]}, {"commit": "new", "results": [_result(1.0)]}]
+    assert find_regressions(history, [_result(1.1)]) == []
+    (regression,) = find_regressions(history, [_result(1.3)])
+    assert regression["commit"] == "new" and regression["before"] == 1.0
+    # Миллисекундный шум и этап data не считаются регрессией
+    assert find_regressions([{"results": [_result(0.001)]}], [_result(0.04)]) == []
+    assert find_regressions([{"results": [_result(1, "data", None)]}], [_result(5, "data", None)]) == []
+    assert find_regressions(history, [_result(5, variant="separate")]) == []
+
+
+def test_main_appends_history_and_fails_on_regression(tmp_path, monkeypatch, capsys):
+    history = tmp_path / "history.jsonl"
+    argv = ["--users", "100", "--experiments", "1", "--metrics", "3", "--repeat", "1", "--no-execute",
+            "--history", str(history), "--fail-on-regression"]
+    assert benchmark.main(argv) == 0
+    (record,) = [json.loads(line) for line in history.read_text(encoding="utf-8").splitlines()]
+    assert {r["stage"] for r in record["results"]} == {"generate"}
+    assert len(record["results"]) == len(VARIANTS)
+
+    clock = iter(range(0, 10 ** 6, 10))
+    monkeypatch.setattr(benchmark.time, "perf_counter", lambda: next(clock))
+    assert benchmark.main(argv) == 1
+    assert "Регрессия" in capsys.readouterr().out
+    assert len(history.read_text(encoding="utf-8").splitlines()) == 2
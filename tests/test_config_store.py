@@ -0,0 +1,187 @@
+import pytest
+
+import config_store
+
+
+class ClientError(Exception):
+    def __init__(self, code, status):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+
+
+class FakeS3:
+    """Минимальная замена клиента S3: get_object/put_object с ETag и 404 для отсутствующих ключей.
+
+    errors[Key] — исключение, которое бросает get_object этого ключа, пока его не уберут.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.errors = {}
+        self.gets = 0
+        self.puts = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.gets += 1
+        if Key in self.errors:
+            raise self.errors[Key]
+        if Key not in self.objects:
+            raise ClientError("NoSuchKey", 404)
+        body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError("304", 304)
+
+        class Body:
+            def read(self_):
+                return body.encode("utf-8")
+        return {"Body": Body(), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        current = self.objects.get(Key)
+        if (IfMatch and (current is None or current[1] != IfMatch)) or (IfNoneMatch == "*" and current is not None):
+            raise ClientError("PreconditionFailed", 412)
+        etag = f'"{len(self.puts) + 1}"'
+        self.objects[Key] = (Body.decode("utf-8"), etag)
+        self.puts.append(Key)
+        return {"ETag": etag}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: client)
+    config_store.invalidate_cache()
+    yield client
+    config_store.invalidate_cache()
+
+
+def test_missing_object_is_cached_for_ttl(s3, monkeypatch):
+    monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 60)
+    assert config_store.s3_read_yaml("missing.yaml") is None
+    assert config_store.s3_read_yaml("missing.yaml") is None
+    assert s3.gets == 1
+
+
+def test_missing_object_is_revalidated_after_ttl(s3, monkeypatch):
+    monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 0)
+    assert config_store.s3_read_yaml("config.yaml") is None
+    s3.objects[config_store._s3_key("config.yaml")] = ("experiments: []\n", '"1"')
+    assert config_store.s3_read_yaml("config.yaml") == {"experiments": []}
+    assert s3.gets == 2
+
+
+def test_s3_error_is_not_reported_as_missing_object(s3):
+    s3.errors[config_store._s3_key("config.yaml")] = ClientError("SlowDown", 503)
+    with pytest.raises(OSError):
+        config_store.s3_read_yaml("config.yaml")
+
+
+def test_s3_error_falls_back_to_stale_cached_object(s3, monkeypatch):
+    monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 0)
+    key = config_store._s3_key("config.yaml")
+    s3.objects[key] = ("experiments: []\n", '"1"')
+    assert config_store.s3_read_yaml("config.yaml") == {"experiments": []}
+    s3.errors[key] = ClientError("InternalError", 500)
+    assert config_store.s3_read_yaml("config.yaml") == {"experiments": []}
+    assert config_store.s3_read_yaml("config.yaml") == {"experiments": []}
+
+
+def test_manifest_read_error_does_not_break_save_experiment(s3, monkeypatch):
+    monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 0)
+    config_store.save_experiment({"experiment_name": "exp", "metrics": []})
+    s3.errors[config_store._s3_key(config_store.MANIFEST_FILE)] = ClientError("InternalError", 500)
+    # Манифест берётся из устаревшего кэша, эксперимент уже в нём — манифест не переписывается
+    config_store.save_experiment({"experiment_name": "exp", "metrics": [{"name": "gmv"}]})
+    assert config_store.load_experiment("exp")[0]["metrics"] == [{"name": "gmv"}]
+
+
+def _put_yaml(s3, filename, data):
+    s3.objects[config_store._s3_key(filename)] = (config_store.yaml.dump(data), '"old"')
+
+
+def test_manifest_read_error_does_not_rerun_migration(s3):
+    _put_yaml(s3, config_store.CONFIG_FILE, {"experiments": [{"experiment_name": "exp", "metrics": []}]})
+    s3.errors[config_store._s3_key(config_store.MANIFEST_FILE)] = ClientError("SlowDown", 503)
+    with pytest.raises(OSError):
+        config_store.migrate_monolithic_config()
+    assert s3.puts == []
+
+
+def test_migration_keeps_existing_experiment_objects(s3):
+    _put_yaml(s3, config_store.CONFIG_FILE, {"experiments": [{"experiment_name": "exp", "metrics": []}]})
+    filename = config_store._experiment_filename("exp")
+    _put_yaml(s3, filename, {"experiment_name": "exp", "metrics": [{"name": "gmv"}]})
+    assert config_store.migrate_monolithic_config() == 1
+    assert config_store.load_experiment("exp")[0]["metrics"] == [{"name": "gmv"}]
+
+
+def test_experiment_layout_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: None)
+    (tmp_path / config_store.CONFIG_FILE).write_text(config_store.yaml.dump(
+        {"experiments": [{"experiment_name": "a", "metrics": []}, {"experiment_name": "b", "metrics": []}]}
+    ), encoding="utf-8")
+    assert config_store.list_experiment_names() == ["a", "b"]
+    assert config_store.migrate_monolithic_config() == 2
+    assert config_store.migrate_monolithic_config() == 0
+
+    experiment, etag = config_store.load_experiment("a")
+    config_store.save_experiment(dict(experiment, metrics=[{"name": "gmv"}]), expected_etag=etag)
+    with pytest.raises(config_store.ConfigConflictError):
+        config_store.save_experiment(experiment, expected_etag=etag)
+    with pytest.raises(config_store.ConfigConflictError):
+        config_store.save_experiment({"experiment_name": "b"}, must_not_exist=True)
+    config_store.save_experiment({"experiment_name": "c", "metrics": []})
+
+    assert config_store.delete_experiment("b")
+    assert not config_store.delete_experiment("b")
+    assert config_store.list_experiment_names() == ["a", "c"]
+    assert config_store.load_config()["experiments"][0]["metrics"] == [{"name": "gmv"}]
+
+
+GMV = {"name": "gmv", "type": "basic", "expression": "sum(gmv)"}
+GMV_LEGACY = dict(GMV, name="gmv_legacy")
+
+
+def test_catalog_keeps_stored_duplicates_and_rejects_new_ones():
+    catalog = config_store.PresetCatalog([GMV, GMV_LEGACY, dict(GMV, expression="sum(gmv) * 2")])
+    assert [p["name"] for p in catalog.presets] == ["gmv", "gmv_legacy"]
+    assert catalog.get("gmv_legacy") == GMV_LEGACY
+    with pytest.raises(config_store.DuplicatePresetError):
+        catalog.add(dict(GMV, name="gmv_copy"))
+
+
+def test_compaction_keeps_every_preset_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: None)
+    monkeypatch.setattr(config_store, "PRESETS_COMPACT_THRESHOLD", 100)
+    (tmp_path / config_store.METRICS_PRESETS_FILE).write_text(
+        config_store.yaml.dump({"metrics_presets": [GMV, GMV_LEGACY]}), encoding="utf-8"
+    )
+    config_store.save_new_preset({"name": "orders", "type": "basic", "expression": "sum(orders_cnt)"})
+    assert config_store.compact_presets() == 1
+    assert [p["name"] for p in config_store.load_presets()] == ["gmv", "gmv_legacy", "orders"]
+
+
+def test_s3_reads_are_counted_when_profiling(s3, monkeypatch):
+    import profiling
+
+    monkeypatch.setattr(profiling, "_enabled", True)
+    profiling.reset()
+    monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 60)
+    s3.objects[config_store._s3_key("config.yaml")] = ("experiments: []\n", '"1"')
+    try:
+        config_store.s3_read_yaml("config.yaml")
+        config_store.s3_read_yaml("config.yaml")
+        monkeypatch.setattr(config_store, "CACHE_TTL_SECONDS", 0)
+        config_store.s3_read_yaml("config.yaml")
+        config_store.s3_read_yaml("missing.yaml")
+        data = profiling.snapshot()
+    finally:
+        profiling.reset()
+    # Промах и 304 при повторной проверке, попадание в кэш по TTL, 404 отдельным счётчиком
+    assert data["counters"] == {
+        "s3_get_object": 3, "s3_bytes_read": len("experiments: []\n"), "s3_cache_hits": 1,
+        "s3_not_modified": 1, "s3_not_found": 1, "yaml_cache_hits": 2,
+    }
+    assert data["timers"]["s3_get_object"]["calls"] == 3
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import config_store
+from experiment_io import (
+    FORMATS,
+    export_experiments,
+    import_experiments,
+    parse_experiments,
+    validate_experiment,
+    validate_experiments,
+)
+
+EXPERIMENT = {
+    "experiment_name": "exp0",
+    "control_group_id": "exp0_c",
+    "test_group_id": "exp0_t",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-14",
+    "metrics": [
+        {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+        {"name": "aov", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)",
+         "where_filters": [{"field": "purhase_flg", "operator": "=", "value": "1", "value_type": "число"}]},
+    ],
+    "filters": {"where": [], "having": [{"expression": "sum(orders_cnt) > 0"}]},
+}
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_export_import_round_trip(fmt):
+    experiments = [EXPERIMENT, dict(EXPERIMENT, experiment_name="exp1", cuped={"pre_period_days": 7})]
+    parsed = parse_experiments(export_experiments(experiments, fmt), fmt)
+    assert parsed == experiments
+    assert validate_experiments(parsed) == {}
+
+
+@pytest.mark.parametrize("filters", ["sum(gmv) > 0", [{"expression": "sum(gmv) > 0"}], None])
+def test_malformed_filters_are_validation_errors(filters):
+    errors = validate_experiment(dict(EXPERIMENT, filters=filters))
+    assert len(errors) == 1 and errors[0].startswith("filters")
+
+
+def test_malformed_nested_filters_are_validation_errors():
+    errors = validate_experiment(dict(EXPERIMENT, filters={"where": "gmv > 0", "having": "sum(gmv) > 0"}))
+    assert [error.split(":")[0] for error in errors] == ["WHERE", "HAVING"]
+    metric = dict(EXPERIMENT["metrics"][0], where_filters="gmv > 0")
+    assert validate_experiment(dict(EXPERIMENT, metrics=[metric])) == [
+        "Метрика 'gmv': фильтры должны быть списком: 'gmv > 0'"
+    ]
+
+
+def test_csv_import_reports_every_invalid_row_and_saves_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: None)
+    text = export_experiments([
+        EXPERIMENT,
+        dict(EXPERIMENT, experiment_name="bad_filters", filters="sum(gmv) > 0"),
+        dict(EXPERIMENT, experiment_name="bad_dates", start_date="2024-02-01"),
+    ], "csv")
+    with pytest.raises(ValueError) as error:
+        import_experiments(text, "csv")
+    assert "bad_filters: filters" in str(error.value)
+    assert "bad_dates: Дата начала позже даты окончания" in str(error.value)
+    assert config_store.list_experiment_names() == []
+
+
+def test_import_saves_batch_and_refuses_existing_names(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: None)
+    text = json.dumps([EXPERIMENT, dict(EXPERIMENT, experiment_name="exp1")])
+    assert import_experiments(text, "json") == 2
+    assert config_store.list_experiment_names() == ["exp0", "exp1"]
+    with pytest.raises(config_store.ConfigConflictError):
+        import_experiments(text, "json")
+    assert import_experiments(text, "json", overwrite=True) == 2
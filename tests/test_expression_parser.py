@@ -0,0 +1,92 @@
+import pytest
+
+from expression_parser import Call, ExpressionSyntaxError, Identifier, aggregate_calls, parse, to_sql, try_parse
+from sql_generator import has_if_aggregate, merge_if_condition, share_common_aggregates
+
+EXPRESSIONS = [
+    "sum(gmv) / nullIf(count(), 0)",
+    "-sum(gmv) - -1 - (2 - 3)",
+    "a - (b - c) * d / (e / f) % 7",
+    "NOT (a = 1 OR b = 2) AND c != 3",
+    "x NOT IN ('a') AND (a, b) IN ((1, 2), (3, 4)) AND y LIKE '%it''s%'",
+    "x BETWEEN 1 + 1 AND 5 AND y IS NOT NULL AND z NOT BETWEEN -1 AND 1",
+    "CASE WHEN gmv > 100 THEN 'big' WHEN gmv > 0 THEN 'small' ELSE NULL END",
+    "CASE platform WHEN 'ios' THEN 1 ELSE 0 END",
+    "quantile(0.9)(gmv) + arraySum([1, 2.5e3])",
+    "sumIf(gmv, platform = 'ios' AND purhase_flg = 1) / countIf(purhase_flg = 1)",
+    "uniqExact(magnit_id) || 'x'",
+]
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_to_sql_is_canonical_and_stable(expression):
+    node = parse(expression)
+    sql = to_sql(node)
+    assert parse(sql) == node
+    assert to_sql(parse(sql)) == sql
+
+
+def test_equivalent_spellings_give_equal_nodes():
+    assert parse("SUM( gmv )") == parse("sum(gmv)")
+    assert parse("(a + b) + c") == parse("a + b + c")
+    assert parse("a + (b + c)") != parse("a + b + c")
+    assert parse("x == 1") == parse("x = 1")
+    assert to_sql(parse("a - (b - c)")) == "a - (b - c)"
+    assert to_sql(parse("(a OR b) AND c")) == "(a OR b) AND c"
+
+
+@pytest.mark.parametrize("expression", ["sum(gmv", "a +", "x NOT 1", "arrayMap(x -> x, arr)", "CASE END", "a $ b"])
+def test_syntax_errors(expression):
+    with pytest.raises(ExpressionSyntaxError):
+        parse(expression)
+    assert try_parse(expression) is None
+
+
+def test_aggregate_calls_are_top_level_only():
+    node = parse("sum(gmv) / count() + max(if(sum_flag, 1, 0)) + toFloat64(avg(x))")
+    assert [to_sql(c) for c in aggregate_calls(node)] == ["sum(gmv)", "count()", "max(if(sum_flag, 1, 0))", "avg(x)"]
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("sumIf(gmv, a = 1)", "sumIf(gmv, a = 1 AND p = 1)"),
+    ("countIf(a = 1 OR b = 1)", "countIf((a = 1 OR b = 1) AND p = 1)"),
+    ("sum(gmv) / countIf(a = 1)", "sumIf(gmv, p = 1) / countIf(a = 1 AND p = 1)"),
+    ("count() + countIf()", "countIf(p = 1) + countIf(p = 1)"),
+    ("sum(if(a = 1, gmv, 0))", "sum(if(a = 1, gmv, 0))"),
+])
+def test_merge_if_condition(expression, expected):
+    assert merge_if_condition(expression, "p = 1") == expected
+    assert has_if_aggregate(expression) == (expected != expression)
+
+
+def test_share_common_aggregates():
+    columns, rewritten = share_common_aggregates([
+        "sum(gmv)",
+        "SUM(gmv) / count()",
+        "count() * 2",
+        "max(gmv)",
+        "sum(gmv",
+    ])
+    assert columns == ["sum(gmv) AS agg_0", "count() AS agg_1"]
+    assert rewritten == ["agg_0", "agg_0 / agg_1", "agg_1 * 2", "max(gmv)", "sum(gmv"]
+    assert share_common_aggregates(["sum(a)", "sum(b)"]) == ([], ["sum(a)", "sum(b)"])
+
+
+def test_canonical_sql_evaluates_like_original(chdb_executor):
+    expressions = [
+        "-2 - -3 * (4 - 1) % 5",
+        "10 / (4 / 2) - (1 - (2 - 3))",
+        "NOT (1 = 1 OR 2 = 3) OR 1 IN (1, 2) AND 'ab' LIKE 'a%'",
+        "CASE 2 WHEN 1 THEN 'one' WHEN 2 THEN 'two' ELSE 'many' END",
+        "(1, 2) IN ((1, 2), (3, 4)) AND 3 BETWEEN 1 + 1 AND 5 AND NULL IS NULL",
+    ]
+    select = ", ".join(f"{e} AS e{i}, {to_sql(parse(e))} AS c{i}" for i, e in enumerate(expressions))
+    (row,) = chdb_executor(f"SELECT {select}")
+    for i in range(len(expressions)):
+        assert row[f"c{i}"] == row[f"e{i}"]
+
+
+def test_nodes_are_hashable_values():
+    node = Call("sum", (Identifier("gmv"),))
+    assert parse("sum(gmv)") == node
+    assert {node: 1}[parse("sum(gmv)")] == 1
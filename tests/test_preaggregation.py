@@ -0,0 +1,55 @@
+import pytest
+
+from preaggregation import build_preaggregated_view, source_dimension_types
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+PURCHASE = {"field": "purhase_flg", "operator": "=", "value": "1", "value_type": "число"}
+
+PRESETS = [
+    {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+    {"name": "aov", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)"},
+    {"name": "purchase_gmv", "type": "basic", "expression": "sum(gmv)", "where_filters": [PURCHASE]},
+    {"name": "items_per_order", "type": "ratio", "numerator": "sumIf(items_cnt, orders_cnt > 0)",
+     "denominator": "countIf(orders_cnt > 0)"},
+    {"name": "active_days", "type": "basic", "expression": "uniq(event_date)"},
+    {"name": "max_order", "type": "basic", "expression": "quantile(0.9)(gmv)"},
+]
+DIMENSION_TYPES = {"event_date": "Date", "magnit_id": "UInt64", "ab": "Array(String)"}
+TABLE = "ft_pa_prod.delivery_abtest_preagg"
+
+EXPERIMENT = {
+    "experiment_name": "exp0",
+    "control_group_id": "exp0_c",
+    "test_group_id": "exp0_t",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-14",
+    "filters": {"where": [], "having": [{"expression": "sum(orders_cnt) > 0"}]},
+    "metrics": PRESETS,
+}
+
+
+def test_ddl(golden):
+    view = build_preaggregated_view(PRESETS, TABLE, dimension_types=DIMENSION_TYPES)
+    statements = view.ddl() + [view.backfill_sql("2024-01-01", "2024-01-31")]
+    golden("preaggregation_ddl.sql", ";\n\n".join(statements) + ";\n")
+
+
+def test_routed_queries(golden):
+    view = build_preaggregated_view(PRESETS, TABLE)
+    queries = generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE, preaggregated=view)
+    golden("preaggregation_routed.sql", "".join(f"-- {name}\n{sql};\n\n" for name, sql in queries))
+
+
+def test_ddl_requires_source_types():
+    view = build_preaggregated_view(PRESETS, TABLE)
+    with pytest.raises(ValueError):
+        view.ddl()
+    view.dimension_types = dict(DIMENSION_TYPES, magnit_id="Nullable(String)")
+    with pytest.raises(ValueError):
+        view.ddl()
+
+
+def test_dimension_types_from_source_table(chdb_executor):
+    types = source_dimension_types(chdb_executor)
+    assert types["magnit_id"] == "String"
+    assert types["ab"] == "Array(String)"
@@ -0,0 +1,129 @@
+import json
+import threading
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def enabled():
+    was_enabled = profiling.is_enabled()
+    profiling.reset()
+    profiling.enable()
+    yield
+    profiling.reset()
+    if not was_enabled:
+        profiling.disable()
+
+
+def test_disabled_profiling_records_nothing():
+    was_enabled = profiling.is_enabled()
+    profiling.disable()
+    profiling.reset()
+    try:
+        with profiling.timer("block"):
+            pass
+        profiling.timed("fn")(lambda: None)()
+        profiling.count("counter")
+        profiling.log_query("exp0", "gmv", 1.0)
+        assert profiling.timer("a") is profiling.timer("b")
+        assert profiling.snapshot() == {"timers": {}, "counters": {}, "queries": []}
+    finally:
+        if was_enabled:
+            profiling.enable()
+
+
+def test_timers_counters_and_query_log(enabled, monkeypatch):
+    clock = iter([0.0, 0.5, 1.0, 3.0, 10.0, 10.25])
+    monkeypatch.setattr(profiling.time, "perf_counter", lambda: next(clock))
+
+    @profiling.timed()
+    def fail():
+        raise ValueError
+
+    with profiling.timer("block"):
+        pass
+    with profiling.timer("block"):
+        pass
+    with pytest.raises(ValueError):
+        fail()
+    profiling.count("bytes", 10)
+    profiling.count("bytes", 5)
+    monkeypatch.setattr(profiling, "_query_log", profiling.deque(maxlen=2))
+    for name in ("a", "b", "c"):
+        profiling.log_query("exp0", name, 1.0, rows=3)
+
+    data = profiling.snapshot()
+    assert data["timers"] == {
+        "block": {"calls": 2, "seconds": 2.5, "max_seconds": 2.0},
+        "fail": {"calls": 1, "seconds": 0.25, "max_seconds": 0.25},
+    }
+    assert data["counters"] == {"bytes": 15}
+    assert [q["query_name"] for q in data["queries"]] == ["b", "c"]
+
+
+def test_counters_are_thread_safe(enabled):
+    def work():
+        for _ in range(1000):
+            profiling.count("calls")
+            profiling.record("block", 0.001)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data = profiling.snapshot()
+    assert data["counters"]["calls"] == 8000
+    assert data["timers"]["block"]["calls"] == 8000
+
+
+def test_prometheus_export(enabled):
+    profiling.record("s3_get_object", 0.5)
+    profiling.count("s3_bytes_read", 100)
+    profiling.log_query("exp0", 'gmv "net"', 1.5)
+    profiling.log_query("exp0", 'gmv "net"', 0.5)
+    profiling.log_query("exp0", 'gmv "net"', 2.0, status="error")
+    lines = profiling.to_prometheus().splitlines()
+    assert "# TYPE ab_timer_seconds_total counter" in lines
+    assert "# TYPE ab_timer_seconds_max gauge" in lines
+    assert 'ab_timer_calls_total{name="s3_get_object"} 1' in lines
+    assert 'ab_counter_total{name="s3_bytes_read"} 100' in lines
+    assert 'ab_query_runs_total{experiment="exp0",query="gmv \\"net\\"",status="ok"} 2' in lines
+    assert 'ab_query_seconds_total{experiment="exp0",query="gmv \\"net\\"",status="ok"} 2.0' in lines
+    assert 'ab_query_runs_total{experiment="exp0",query="gmv \\"net\\"",status="error"} 1' in lines
+    # Каждая строка — комментарий или «метрика{метки} число»
+    for line in lines:
+        assert line.startswith("# ") or float(line.rsplit(" ", 1)[1]) >= 0
+    assert profiling.to_prometheus({"timers": {}, "counters": {}, "queries": []}) == "\n"
+
+
+def test_write_metrics_chooses_format_by_extension(enabled, tmp_path):
+    profiling.count("s3_get_object")
+    profiling.write_metrics(str(tmp_path / "profile.json"))
+    profiling.write_metrics(str(tmp_path / "profile.prom"))
+    assert json.loads((tmp_path / "profile.json").read_text(encoding="utf-8"))["counters"] == {"s3_get_object": 1}
+    assert 'ab_counter_total{name="s3_get_object"} 1' in (tmp_path / "profile.prom").read_text(encoding="utf-8")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["profile.json", "profile.prom"]
+
+
+def test_batch_runner_cli_writes_profile(enabled, synthetic_parquet, tmp_path):
+    import yaml
+
+    import batch_runner
+
+    config = tmp_path / "config.yaml"
+    config.write_text(yaml.dump({"experiments": [{
+        "experiment_name": "exp0", "control_group_id": "exp0_c", "test_group_id": "exp0_t",
+        "start_date": "2024-01-01", "end_date": "2024-01-14", "filters": {"where": [], "having": []},
+        "metrics": [{"name": "gmv", "type": "basic", "expression": "sum(gmv)"}],
+    }]}), encoding="utf-8")
+    profile = tmp_path / "profile.json"
+    assert batch_runner.main(["--config", str(config), "--executor", "chdb", "--parquet", synthetic_parquet,
+                              "--output-dir", str(tmp_path / "results"), "--profile", str(profile)]) == 0
+    data = json.loads(profile.read_text(encoding="utf-8"))
+    assert data["timers"]["plan_queries"]["calls"] == 1
+    (query,) = data["queries"]
+    assert (query["experiment_name"], query["query_name"], query["status"]) == ("exp0", "gmv", "ok")
+    assert query["rows"] > 0 and query["seconds"] > 0
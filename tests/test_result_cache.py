@@ -0,0 +1,96 @@
+from datetime import date
+
+import pytest
+
+from batch_runner import MemorySink, run_daily_refresh
+from result_cache import DailyResultCache, fetch_metric_totals
+from sql_generator import SOURCE_TABLE
+
+EXPERIMENT = {
+    "experiment_name": "exp0",
+    "control_group_id": "exp0_c",
+    "test_group_id": "exp0_t",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-14",
+    "filters": {"where": [], "having": []},
+    "metrics": [
+        {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+        {"name": "aov", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)"},
+        {"name": "median_gmv", "type": "quantile", "expression": "gmv"},
+    ],
+}
+TODAY = date(2024, 2, 1)
+
+
+class CountingExecutor:
+    def __init__(self, execute):
+        self.execute = execute
+        self.table_queries = 0
+
+    def __call__(self, sql):
+        if SOURCE_TABLE in sql:
+            self.table_queries += 1
+        return self.execute(sql)
+
+
+def test_totals_match_exact_and_reuse_cached_days(chdb_executor, tmp_path):
+    execute = CountingExecutor(chdb_executor)
+    cache = DailyResultCache(str(tmp_path))
+    metric = EXPERIMENT["metrics"][0]
+    first = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, execute, cache, TODAY)
+    assert execute.table_queries == 1
+    second = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, execute, cache, TODAY)
+    assert execute.table_queries == 1
+    assert second == first
+
+    exact = chdb_executor(
+        f"SELECT if(has(ab, 'exp0_c'), 'control', 'test') AS group_label, uniqExact(magnit_id) AS users, "
+        f"sum(gmv) AS gmv FROM {SOURCE_TABLE} WHERE hasAny(ab, ['exp0_c', 'exp0_t']) GROUP BY group_label"
+    )
+    for row in exact:
+        totals = first[row["group_label"]]
+        assert totals["users"] == float(row["users"])
+        assert totals["numerator"] == pytest.approx(float(row["gmv"]))
+
+
+def test_users_stay_exact_when_days_are_fetched_incrementally(chdb_executor, tmp_path):
+    cache = DailyResultCache(str(tmp_path / "incremental"))
+    metric = EXPERIMENT["metrics"][0]
+    fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, chdb_executor, cache, date(2024, 1, 6))
+    incremental = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, chdb_executor, cache, TODAY)
+    full_cache = DailyResultCache(str(tmp_path / "full"))
+    full = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, chdb_executor, full_cache, TODAY)
+    assert incremental == full
+
+    later = dict(EXPERIMENT, start_date="2024-01-03")
+    shifted = fetch_metric_totals(later, metric, SOURCE_TABLE, chdb_executor, cache, TODAY)
+    exact = chdb_executor(
+        f"SELECT if(has(ab, 'exp0_c'), 'control', 'test') AS group_label, uniqExact(magnit_id) AS users "
+        f"FROM {SOURCE_TABLE} WHERE hasAny(ab, ['exp0_c', 'exp0_t']) AND event_date >= '2024-01-03' "
+        f"GROUP BY group_label"
+    )
+    assert {row["group_label"]: float(row["users"]) for row in exact} == {
+        group: totals["users"] for group, totals in shifted.items()
+    }
+
+
+def test_daily_refresh_skips_metrics_not_split_by_day(chdb_executor, tmp_path):
+    sink = MemorySink()
+    summary = run_daily_refresh({"experiments": [EXPERIMENT]}, chdb_executor, [sink],
+                                DailyResultCache(str(tmp_path)), today=TODAY)
+    status = {s["query_name"]: s["status"] for s in summary}
+    assert status == {"gmv": "ok", "aov": "ok", "median_gmv": "skipped"}
+    rows = sink.results["exp0"]["daily_totals"]
+    assert sorted((r["metric_name"], r["group_label"]) for r in rows) == [
+        ("aov", "control"), ("aov", "test"), ("gmv", "control"), ("gmv", "test"),
+    ]
+
+
+def test_uniq_states_merge_in_several_rounds(chdb_executor, tmp_path, monkeypatch):
+    import result_cache
+
+    metric = EXPERIMENT["metrics"][0]
+    expected = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, chdb_executor, DailyResultCache(str(tmp_path)), TODAY)
+    monkeypatch.setattr(result_cache, "MERGE_QUERY_BYTES", 1)
+    merged = fetch_metric_totals(EXPERIMENT, metric, SOURCE_TABLE, chdb_executor, DailyResultCache(str(tmp_path)), TODAY)
+    assert merged == expected
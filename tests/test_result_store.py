@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from result_store import ResultStore, columns_from_rows
+
+ROWS = [
+    {"exp_name": "exp0", "metric_name": "gmv", "group_label": "control", "numerator": 10.5, "denominator": 1},
+    {"exp_name": "exp0", "metric_name": "gmv", "group_label": "test", "numerator": 12.0, "denominator": 1},
+    {"exp_name": "exp0", "metric_name": "gmv", "group_label": None, "numerator": 3.0, "denominator": 1},
+]
+SQL = "SELECT 1"
+
+
+def _put(store, sql=SQL, query_name="gmv"):
+    store.put("exp0", "hash", query_name, sql, columns_from_rows(ROWS), "2024-01-01", "2024-01-14")
+
+
+def test_round_trip_and_sql_change_invalidates(tmp_path):
+    store = ResultStore(str(tmp_path))
+    assert store.get("exp0", "hash", "gmv", SQL) is None
+    _put(store)
+    columns = store.get("exp0", "hash", "gmv", SQL)
+    assert list(columns["group_label"]) == ["control", "test", None]
+    np.testing.assert_array_equal(columns["numerator"], [10.5, 12.0, 3.0])
+    assert store.metadata("exp0", "hash", "gmv")["end_date"] == "2024-01-14"
+    assert store.get("exp0", "hash", "gmv", "SELECT 2") is None
+
+
+def test_get_closes_memory_map(tmp_path, monkeypatch):
+    import pyarrow
+
+    opened = []
+    memory_map = pyarrow.memory_map
+
+    def spy(*args, **kwargs):
+        opened.append(memory_map(*args, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(pyarrow, "memory_map", spy)
+    store = ResultStore(str(tmp_path))
+    _put(store)
+    columns = store.get("exp0", "hash", "gmv", SQL)
+    assert store.get("exp0", "hash", "gmv", "SELECT 2") is None
+    assert len(opened) == 2 and all(source.closed for source in opened)
+    # Колонки без копирования остаются читаемыми после закрытия файла
+    assert columns["numerator"].sum() == pytest.approx(25.5)
+
+
+def test_evict_removes_least_recently_used_files(tmp_path):
+    store = ResultStore(str(tmp_path))
+    _put(store, query_name="old")
+    _put(store, query_name="new")
+    old_path = store._path("exp0", "hash", "old")
+    os.utime(old_path, (0, 0))
+    store.max_bytes = os.path.getsize(store._path("exp0", "hash", "new"))
+    store.evict()
+    assert store.get("exp0", "hash", "old", SQL) is None
+    assert store.get("exp0", "hash", "new", SQL) is not None
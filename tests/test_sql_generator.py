@@ -0,0 +1,316 @@
+import numpy as np
+import pytest
+
+from sql_generator import SOURCE_TABLE, generate_sql_queries_for_metrics
+
+PURCHASE = {"field": "purhase_flg", "operator": "=", "value": "1", "value_type": "число"}
+
+EXPERIMENT = {
+    "experiment_name": "exp0",
+    "control_group_id": "exp0_c",
+    "test_group_id": "exp0_t",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-14",
+    "filters": {"where": [], "having": [{"expression": "sum(orders_cnt) > 2"}]},
+    "metrics": [
+        {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+        {"name": "gmv_purchase", "type": "basic", "expression": "sum(gmv)", "where_filters": [PURCHASE]},
+        {"name": "aov_purchase", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)",
+         "where_filters": [PURCHASE]},
+        {"name": "purchases", "type": "basic", "expression": "countIf(purhase_flg = 1)", "where_filters": [PURCHASE]},
+    ],
+}
+
+
+def _user_values(execute, queries):
+    values = {}
+    for _, sql in queries:
+        for row in execute(sql):
+            key = (row["metric_name"], row["magnit_id"], row["group_label"])
+            values[key] = (round(float(row["numerator"]), 6), round(float(row["denominator"]), 6))
+    return values
+
+
+def _assert_modes_match(execute, experiment):
+    separate = _user_values(execute, generate_sql_queries_for_metrics(experiment, SOURCE_TABLE))
+    fused = _user_values(execute, generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, fused=True))
+    assert separate
+    assert fused == separate
+
+
+def test_fused_matches_separate_queries(chdb_executor):
+    _assert_modes_match(chdb_executor, EXPERIMENT)
+
+
+def test_fused_matches_separate_queries_without_having(chdb_executor):
+    _assert_modes_match(chdb_executor, dict(EXPERIMENT, filters={"where": [], "having": []}))
+
+
+def test_fused_keeps_query_level_having_without_metric_filters():
+    experiment = dict(EXPERIMENT, metrics=EXPERIMENT["metrics"][:1])
+    (_, sql), = generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, fused=True)
+    assert "HAVING sum(orders_cnt) > 2" in sql
+
+
+def test_cuped_having_uses_experiment_period_only(chdb_executor):
+    experiment = dict(EXPERIMENT, start_date="2024-01-08", cuped={"pre_period_days": 7},
+                      metrics=EXPERIMENT["metrics"][:2])
+    cuped = _user_values(chdb_executor, generate_sql_queries_for_metrics(experiment, SOURCE_TABLE))
+    regular = _user_values(chdb_executor, generate_sql_queries_for_metrics(dict(experiment, cuped=None), SOURCE_TABLE))
+    assert regular
+    assert cuped == regular
+
+
+def test_cuped_aggregate_covariate_is_zero_without_pre_period_rows(chdb_executor):
+    from analysis import analyze_cuped, sufficient_statistics_from_rows
+
+    experiment = dict(EXPERIMENT, start_date="2024-01-03", cuped={"pre_period_days": 2},
+                      filters={"where": [], "having": []},
+                      metrics=[{"name": "avg_gmv", "type": "basic", "expression": "avg(gmv)"}])
+    (_, rows_sql), = generate_sql_queries_for_metrics(experiment, SOURCE_TABLE)
+    (_, aggregate_sql), = generate_sql_queries_for_metrics(experiment, SOURCE_TABLE, output="aggregate")
+    rows = chdb_executor(rows_sql)
+    assert any(row["covariate"] == 0 for row in rows)
+    columns = {key: np.array([row[key] for row in rows]) for key in rows[0]}
+    expected = sufficient_statistics_from_rows(columns)
+
+    aggregate = chdb_executor(aggregate_sql)
+    order = [list(expected["group_label"]).index(row["group_label"]) for row in aggregate]
+    for column in ("n", "sum_c", "sum_c2", "sum_xc"):
+        np.testing.assert_allclose([row[column] for row in aggregate], expected[column][order])
+    stats = {key: np.array([row[key] for row in aggregate]) for key in aggregate[0]}
+    assert np.isfinite(analyze_cuped(stats)["theta"]).all()
+
+
+def _assert_shared_scan_matches_separate(execute, experiments):
+    from shared_scan import generate_shared_scan_queries, split_results_by_experiment
+
+    shared = {e["experiment_name"]: {} for e in experiments}
+    for _, sql, names in generate_shared_scan_queries(experiments, SOURCE_TABLE):
+        for name, rows in split_results_by_experiment(execute(sql), names).items():
+            for row in rows:
+                key = (row["metric_name"], row["magnit_id"], row["group_label"])
+                shared[name][key] = (round(float(row["numerator"]), 6), round(float(row["denominator"]), 6))
+    for e in experiments:
+        separate = _user_values(execute, generate_sql_queries_for_metrics(e, SOURCE_TABLE))
+        assert separate
+        assert shared[e["experiment_name"]] == separate
+
+
+def test_shared_scan_matches_separate_queries(chdb_executor):
+    experiments = [EXPERIMENT, dict(EXPERIMENT, experiment_name="exp0_late", start_date="2024-01-05")]
+    _assert_shared_scan_matches_separate(chdb_executor, experiments)
+
+
+def test_shared_scan_keeps_experiment_sample(chdb_executor):
+    experiments = [
+        dict(EXPERIMENT, sample=0.3),
+        dict(EXPERIMENT, experiment_name="exp0_late", start_date="2024-01-05", sample=0.3),
+        dict(EXPERIMENT, experiment_name="exp0_full"),
+    ]
+    _assert_shared_scan_matches_separate(chdb_executor, experiments)
+
+    from shared_scan import generate_shared_scan_queries
+    aggregate = generate_shared_scan_queries(experiments, SOURCE_TABLE, output="aggregate")
+    fractions = {tuple(names): "AS sample_fraction" in sql for _, sql, names in aggregate}
+    assert fractions == {("exp0", "exp0_late"): True, ("exp0_full",): False}
+
+
+def test_quantile_having_in_single_scan(chdb_executor):
+    from sql_generator import build_quantile_sketch_query
+
+    metric = {"name": "median_gmv", "type": "quantile", "expression": "gmv", "where_filters": [PURCHASE]}
+    sql = build_quantile_sketch_query(EXPERIMENT, metric, SOURCE_TABLE, output="aggregate")
+    assert sql.count(SOURCE_TABLE) == 1
+    n = {row["group_label"]: int(row["n"]) for row in chdb_executor(sql)}
+    expected = chdb_executor(
+        f"SELECT group_label, sum(rows) AS n FROM ("
+        f"SELECT magnit_id, if(has(ab, 'exp0_c'), 'control', 'test') AS group_label, count() AS rows "
+        f"FROM {SOURCE_TABLE} WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' "
+        f"AND hasAny(ab, ['exp0_c', 'exp0_t']) AND purhase_flg = 1 "
+        f"GROUP BY magnit_id, group_label HAVING sum(orders_cnt) > 2) GROUP BY group_label"
+    )
+    assert n == {row["group_label"]: int(row["n"]) for row in expected}
+
+
+def _stratified_values(execute, queries):
+    values = {}
+    for _, sql in queries:
+        for row in execute(sql):
+            values[(row["metric_name"], row["magnit_id"], row["group_label"])] = (
+                row["stratum"], round(float(row["numerator"]), 6), round(float(row["denominator"]), 6)
+            )
+    return values
+
+
+def test_strata_do_not_change_sample(chdb_executor):
+    stratified = dict(EXPERIMENT, strata="max(launch_flg)")
+    separate = _stratified_values(chdb_executor, generate_sql_queries_for_metrics(stratified, SOURCE_TABLE))
+    fused = _stratified_values(chdb_executor, generate_sql_queries_for_metrics(stratified, SOURCE_TABLE, fused=True))
+    plain = _user_values(chdb_executor, generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE))
+    assert {key: value[1:] for key, value in separate.items()} == plain
+    assert fused == separate
+
+
+def _columns(rows):
+    return {key: np.array([row[key] for row in rows]) for key in rows[0]}
+
+
+def _statistics_by_key(stats):
+    keys = zip(stats["metric_name"], stats["group_label"])
+    return {key: [float(stats[c][i]) for c in ("n", "sum_x", "sum_x2", "sum_y", "sum_y2", "sum_xy")]
+            for i, key in enumerate(keys)}
+
+
+def test_aggregate_output_matches_statistics_of_rows(chdb_executor):
+    from analysis import analyze_rows, analyze_sufficient_statistics, sufficient_statistics_from_rows
+
+    for fused in (False, True):
+        rows = [row for _, sql in generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE, fused=fused)
+                for row in chdb_executor(sql)]
+        aggregate = [row for _, sql in generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE, fused=fused,
+                                                                        output="aggregate")
+                     for row in chdb_executor(sql)]
+        assert "magnit_id" not in aggregate[0]
+        expected = _statistics_by_key(sufficient_statistics_from_rows(_columns(rows)))
+        actual = _statistics_by_key(_columns(aggregate))
+        assert actual.keys() == expected.keys()
+        for key, values in expected.items():
+            assert actual[key] == pytest.approx(values, rel=1e-9)
+
+        by_rows = analyze_rows(_columns(rows))
+        by_stats = analyze_sufficient_statistics(_columns(aggregate))
+        p_values = dict(zip(by_stats["metric_name"], by_stats["p_value"]))
+        for name, p_value in zip(by_rows["metric_name"], by_rows["p_value"]):
+            assert p_values[name] == pytest.approx(p_value, rel=1e-6)
+
+
+def test_poisson_bootstrap_matches_numpy_reweighting(chdb_executor):
+    import math
+
+    from analysis import analyze_bootstrap_replicates
+
+    replicates = 20
+    metric = {"name": "gmv", "type": "basic", "expression": "sum(gmv)"}
+    experiment = dict(EXPERIMENT, filters={"where": [], "having": []},
+                      metrics=[dict(metric, bootstrap={"replicates": replicates, "seed": 3})])
+    (_, sql), = generate_sql_queries_for_metrics(experiment, SOURCE_TABLE)
+    (_, rows_sql), = generate_sql_queries_for_metrics(dict(experiment, metrics=[metric]), SOURCE_TABLE)
+    rows = chdb_executor(
+        f"SELECT group_label, numerator, "
+        f"arrayMap(r -> cityHash64(magnit_id, r, 3) / 18446744073709551616, range({replicates + 1})) AS u "
+        f"FROM ({rows_sql})"
+    )
+
+    # Обратная функция распределения Poisson(1), как в poisson_weight_sql
+    cdf = np.cumsum([math.exp(-1) / math.factorial(k) for k in range(10)])
+    u = np.array([row["u"] for row in rows])
+    weights = np.searchsorted(cdf, u, side="right").astype(np.float64)
+    weights[:, 0] = 1
+    assert weights[:, 1:].mean() == pytest.approx(1, abs=0.02)
+    assert weights[:, 1:].var() == pytest.approx(1, abs=0.05)
+
+    x = np.array([float(row["numerator"]) for row in rows])
+    labels = np.array([row["group_label"] for row in rows])
+    result = chdb_executor(sql)
+    assert len(result) == 2 * (replicates + 1)
+    for row in result:
+        w = weights[labels == row["group_label"], int(row["replicate"])]
+        assert float(row["n"]) == pytest.approx(w.sum())
+        assert float(row["sum_x"]) == pytest.approx((w * x[labels == row["group_label"]]).sum())
+
+    intervals = analyze_bootstrap_replicates(_columns(result))
+    assert intervals["ci_low"][0] < intervals["diff"][0] < intervals["ci_high"][0]
+
+
+def test_sample_fraction_rounds_to_buckets():
+    from sql_generator import SAMPLE_BUCKETS, sample_condition, sample_fraction
+
+    assert sample_condition(None) == sample_condition(1) == ""
+    assert sample_condition(0.01) == f"cityHash64(magnit_id) % {SAMPLE_BUCKETS} < 100"
+    assert sample_fraction(dict(EXPERIMENT, sample=0.01234)) == 0.0123
+    assert sample_fraction(dict(EXPERIMENT, sample=1e-9)) == 1 / SAMPLE_BUCKETS
+    assert sample_fraction(EXPERIMENT) == 1.0
+    for fraction in (0, 1.5, -0.1):
+        with pytest.raises(ValueError):
+            generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE, sample=fraction)
+
+
+def test_sample_is_deterministic_hash_subset(chdb_executor):
+    from sql_generator import SAMPLE_BUCKETS
+
+    full = _user_values(chdb_executor, generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE))
+    buckets = {row["magnit_id"]: int(row["bucket"]) for row in chdb_executor(
+        f"SELECT DISTINCT magnit_id, cityHash64(magnit_id) % {SAMPLE_BUCKETS} AS bucket FROM {SOURCE_TABLE}"
+    )}
+    expected = {key: value for key, value in full.items() if buckets[key[1]] < 0.3 * SAMPLE_BUCKETS}
+    for fused in (False, True):
+        sampled = _user_values(chdb_executor, generate_sql_queries_for_metrics(
+            EXPERIMENT, SOURCE_TABLE, fused=fused, sample=0.3))
+        assert sampled == expected
+    assert 0.2 < len(expected) / len(full) < 0.4
+
+
+def test_sample_scales_group_sizes_to_full_audience(chdb_executor):
+    from analysis import analyze_sufficient_statistics
+
+    def analyze(**kwargs):
+        rows = [row for _, sql in generate_sql_queries_for_metrics(EXPERIMENT, SOURCE_TABLE, output="aggregate",
+                                                                   **kwargs)
+                for row in chdb_executor(sql)]
+        return analyze_sufficient_statistics(_columns(rows))
+
+    full, sampled = analyze(), analyze(sample=0.3)
+    assert "n_control_total" not in full
+    np.testing.assert_array_equal(sampled["sample_fraction"], 0.3)
+    np.testing.assert_allclose(sampled["n_control_total"], sampled["n_control"] / 0.3)
+    np.testing.assert_allclose(sampled["n_test_total"], sampled["n_test"] / 0.3)
+    order = [list(full["metric_name"]).index(name) for name in sampled["metric_name"]]
+    np.testing.assert_allclose(sampled["n_control_total"], full["n_control"][order], rtol=0.15)
+    np.testing.assert_allclose(sampled["n_test_total"], full["n_test"][order], rtol=0.15)
+    assert (sampled["n_control"] < full["n_control"][order]).all()
+
+
+def test_cap_quantile_clips_numerator_at_common_threshold(chdb_executor):
+    metrics = [
+        {"name": "gmv", "type": "basic", "expression": "sum(gmv)"},
+        {"name": "aov", "type": "ratio", "numerator": "sum(gmv)", "denominator": "sum(orders_cnt)"},
+    ]
+    experiment = dict(EXPERIMENT, metrics=metrics)
+    capped = dict(experiment, metrics=[dict(m, cap_quantile=0.9) for m in metrics])
+    stats = _statistics_by_key(_columns([
+        row for _, sql in generate_sql_queries_for_metrics(capped, SOURCE_TABLE) for row in chdb_executor(sql)
+    ]))
+    replicate = {}
+    bootstrapped = dict(experiment, metrics=[dict(m, cap_quantile=0.9, bootstrap={"replicates": 2}) for m in metrics])
+    for name, sql in generate_sql_queries_for_metrics(bootstrapped, SOURCE_TABLE):
+        for row in chdb_executor(sql):
+            if int(row["replicate"]) == 0:
+                replicate[(name, row["group_label"])] = float(row["sum_x"])
+
+    for name, sql in generate_sql_queries_for_metrics(experiment, SOURCE_TABLE):
+        rows = chdb_executor(sql)
+        x = np.array([float(row["numerator"]) for row in rows])
+        y = np.array([float(row["denominator"]) for row in rows])
+        labels = np.array([row["group_label"] for row in rows])
+        # quantileExact — элемент отсортированной выборки с индексом floor(q·n), один порог на все группы
+        threshold = np.sort(x)[int(0.9 * len(x))]
+        assert threshold == pytest.approx(np.quantile(x, 0.9), rel=0.05)
+        clipped = np.minimum(x, threshold)
+        assert (clipped < x).any()
+        for label in ("control", "test"):
+            group = labels == label
+            n, sum_x, sum_x2, sum_y, sum_y2, sum_xy = stats[(name, label)]
+            assert n == group.sum()
+            assert sum_x == pytest.approx(clipped[group].sum())
+            assert sum_x2 == pytest.approx((clipped[group] ** 2).sum())
+            assert sum_y == pytest.approx(y[group].sum())
+            assert sum_xy == pytest.approx((clipped[group] * y[group]).sum())
+            assert replicate[(name, label)] == pytest.approx(clipped[group].sum())
+
+
+@pytest.mark.parametrize("cap_quantile", [1, 1.5, -0.1])
+def test_cap_quantile_outside_unit_interval_is_rejected(cap_quantile):
+    metric = dict(EXPERIMENT["metrics"][0], cap_quantile=cap_quantile)
+    with pytest.raises(ValueError):
+        generate_sql_queries_for_metrics(dict(EXPERIMENT, metrics=[metric]), SOURCE_TABLE)
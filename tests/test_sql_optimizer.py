@@ -0,0 +1,95 @@
+import pytest
+
+from sql_optimizer import optimize_query
+
+CASES = {
+    "prewhere": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sum(gmv) AS numerator\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t']) AND platform = 'ios'\n"
+        "GROUP BY magnit_id"
+    ),
+    # Условие по колонке вне PREWHERE_COLUMNS (в том числе внутри OR) остаётся в WHERE
+    "prewhere_not_eligible": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sum(gmv) AS numerator\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "WHERE (event_date = '2024-01-01' OR platform = 'ios') AND toFloat64(gmv) > 0\n"
+        "GROUP BY magnit_id"
+    ),
+    # WHERE над подзапросом не трогается, WHERE по таблице внутри него — оптимизируется
+    "subquery_where": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    numerator\n"
+        "FROM (\n"
+        "    SELECT\n"
+        "        magnit_id,\n"
+        "        sum(gmv) AS numerator\n"
+        "    FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "    WHERE event_date = '2024-01-01' AND event_date = '2024-01-01'\n"
+        "    GROUP BY magnit_id\n"
+        ")\n"
+        "WHERE numerator > 0 AND numerator > 0"
+    ),
+    "has_to_has_any": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sum(gmv) AS numerator\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "WHERE (has(ab, 'exp0_c') OR has(ab, 'exp0_t') OR hasAny(ab, ['exp0_b'])) AND platform = 'ios'\n"
+        "GROUP BY magnit_id"
+    ),
+    # has по разным массивам и has с неконстантным значением не сворачиваются
+    "has_not_collapsed": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sum(gmv) AS numerator\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "WHERE (has(ab, 'exp0_c') OR has(segments, 'new')) AND (has(ab, 'exp0_t') OR has(ab, city))\n"
+        "GROUP BY magnit_id"
+    ),
+    # HAVING не переписывается, даже если его -If условие гарантирует WHERE;
+    # не следующие из WHERE условия -If агрегатов остаются
+    "redundant_filters": (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sumIf(gmv, platform = 'ios') AS numerator,\n"
+        "    countIf(orders_cnt > 5 AND purhase_flg = 1) AS denominator,\n"
+        "    sumIf(gmv, orders_cnt >= 6) AS capped\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "WHERE platform IN ('ios', 'android') AND platform = 'ios' AND orders_cnt > 3 AND orders_cnt > 5 "
+        "AND platform = 'ios'\n"
+        "GROUP BY magnit_id\n"
+        "HAVING sumIf(gmv, platform = 'ios') > 0 AND countIf(orders_cnt > 5) > 0"
+    ),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_rewrite(name, golden):
+    before = CASES[name]
+    golden(f"sql_optimizer_{name}.sql", f"-- before\n{before}\n\n-- after\n{optimize_query(before)}\n")
+
+
+def test_prewhere_disabled_keeps_all_conditions_in_where():
+    optimized = optimize_query(CASES["prewhere"], prewhere=False)
+    assert "PREWHERE" not in optimized
+    assert "WHERE event_date BETWEEN '2024-01-01' AND '2024-01-14' AND hasAny(ab, ['exp0_c', 'exp0_t']) " \
+           "AND platform = 'ios'" in optimized
+
+
+def test_no_prewhere_with_array_join():
+    sql = (
+        "SELECT\n"
+        "    magnit_id,\n"
+        "    sum(gmv) AS numerator\n"
+        "FROM ft_pa_prod.delivery_abtest_metrics_daily\n"
+        "ARRAY JOIN arms AS arm\n"
+        "WHERE event_date = '2024-01-01' AND platform = 'ios'\n"
+        "GROUP BY magnit_id"
+    )
+    assert optimize_query(sql) == sql
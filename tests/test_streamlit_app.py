@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pytest
+
+import config_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "streamlit.py")
+
+# Приложение лежит в корне под именем streamlit.py и заслоняет пакет: импортируем пакет без корня в sys.path
+_path = sys.path[:]
+sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != ROOT]
+try:
+    st = pytest.importorskip("streamlit")
+    AppTest = pytest.importorskip("streamlit.testing.v1").AppTest
+finally:
+    sys.path[:] = _path
+
+EXPERIMENT = {
+    "experiment_name": "exp0",
+    "control_group_id": "exp0_c",
+    "test_group_id": "exp0_t",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-14",
+    "metrics": [{"name": "gmv", "type": "basic", "expression": "sum(gmv)"}],
+    "filters": {"where": [], "having": []},
+}
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    """Локальный конфиг с одним экспериментом; считает обращения к хранилищу"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config_store, "get_object_storage_session", lambda: None)
+    config_store.save_experiment(EXPERIMENT)
+    st.cache_data.clear()
+
+    counts = {}
+    for name in ("list_experiment_names", "load_experiment", "save_experiment"):
+        original = getattr(config_store, name)
+
+        def counted(*args, _name=name, _original=original, **kwargs):
+            result = _original(*args, **kwargs)
+            counts.setdefault(_name, []).append((args, kwargs, result))
+            return result
+
+        monkeypatch.setattr(config_store, name, counted)
+    return counts
+
+
+def _app():
+    at = AppTest.from_file(APP, default_timeout=30).run()
+    assert not at.exception
+    return at
+
+
+def _button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+
+def test_reruns_reuse_cached_names_and_loaded_experiment(calls):
+    at = _app()
+    at.selectbox[0].select("exp0").run()
+    assert [field.value for field in at.text_input][:3] == ["exp0", "exp0_c", "exp0_t"]
+    at.text_input(key="extra_test_ids").input("exp0_t2").run()
+    at.checkbox(key="use_cuped").check().run()
+    assert not at.exception
+    assert len(calls["list_experiment_names"]) == 1
+    assert len(calls["load_experiment"]) == 1
+
+
+def test_save_uses_loaded_etag_and_refreshes_names(calls):
+    at = _app()
+    at.selectbox[0].select("exp0").run()
+    at.text_input(key="extra_test_ids").input("exp0_t2").run()
+    _button(at, "💾 Сохранить эксперимент").click().run()
+    assert not at.exception and at.success
+
+    (_, _, (_, loaded_etag)), = calls["load_experiment"]
+    (saved, *_), kwargs, _ = calls["save_experiment"][-1]
+    assert kwargs["expected_etag"] == loaded_etag
+    assert [arm["group_id"] for arm in saved["arms"]] == ["exp0_c", "exp0_t", "exp0_t2"]
+    # Кэш имён сброшен: следующий прогон страницы перечитывает список, дальше снова из кэша
+    at.run()
+    at.run()
+    assert len(calls["list_experiment_names"]) == 2
+
+
+def test_save_reports_conflict_with_concurrent_edit(calls):
+    at = _app()
+    at.selectbox[0].select("exp0").run()
+    config_store.save_experiment(dict(EXPERIMENT, end_date="2024-01-21"))
+    _button(at, "💾 Сохранить эксперимент").click().run()
+    assert not at.exception and not at.success
+    assert "изменил кто-то другой" in at.error[0].value
+    assert config_store.load_experiment("exp0")[0]["end_date"] == "2024-01-21"
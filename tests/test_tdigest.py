@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from tdigest import decode_sketch, sketch_quantiles
+
+LEVELS = [0.1, 0.5, 0.9, 0.99]
+SKETCHES_SQL = (
+    "SELECT number % 3 AS g, hex(CAST(quantileTDigestState(x) AS String)) AS sketch, "
+    "quantilesTDigest(0.1, 0.5, 0.9, 0.99)(x) AS q "
+    "FROM (SELECT number, exp(3 + (number * 7919 % 1000) / 250) AS x FROM numbers(200000)) "
+    "GROUP BY g ORDER BY g"
+)
+
+
+def _quantiles(sketches, levels):
+    decoded = [decode_sketch(s) for s in sketches]
+    means = np.concatenate([m for m, _ in decoded])
+    counts = np.concatenate([c for _, c in decoded])
+    return np.array([sketch_quantiles(np.zeros(len(means)), means, counts, [level], 1)[0] for level in levels])
+
+
+def test_decode_matches_clickhouse_state(chdb_executor):
+    rows = chdb_executor(SKETCHES_SQL)
+    assert len(rows) == 3
+    for row in rows:
+        means, counts = decode_sketch(row["sketch"])
+        assert counts.sum() == pytest.approx(200000 / 3, abs=1)
+        np.testing.assert_allclose(_quantiles([row["sketch"]], LEVELS), row["q"], rtol=1e-5)
+
+
+def test_merged_sketches_match_quantile_over_all_rows(chdb_executor):
+    rows = chdb_executor(SKETCHES_SQL)
+    (total,) = chdb_executor(
+        "SELECT quantilesExact(0.1, 0.5, 0.9)(x) AS q "
+        "FROM (SELECT exp(3 + (number * 7919 % 1000) / 250) AS x FROM numbers(200000))"
+    )
+    np.testing.assert_allclose(_quantiles([row["sketch"] for row in rows], LEVELS[:3]), total["q"], rtol=0.01)